@@ -12,14 +12,19 @@ import django
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-# from chats.routing import websocket_urlpatterns  # Import WebSocket URLs
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "silver_watch.settings")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "facialRecognition.settings")
 django.setup()
 
+# Load the dlib models before the server forks its workers
+from recognition.engine import preload_if_configured  # noqa: E402
+preload_if_configured()
+
+from recognition.routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    # "websocket": AuthMiddlewareStack(
-    #     URLRouter(websocket_urlpatterns)
-    # ),
+    "websocket": AuthMiddlewareStack(
+        URLRouter(websocket_urlpatterns)
+    ),
 })
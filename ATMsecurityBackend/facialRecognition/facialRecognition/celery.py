@@ -0,0 +1,10 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "facialRecognition.settings")
+
+app = Celery("facialRecognition")
+# Read CELERY_* settings from Django and pick up every app's tasks.py
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
@@ -0,0 +1,278 @@
+"""
+Latency histograms and queue gauges in the Prometheus text format.
+
+Every process records observations in memory, so an observation never waits
+on the network, and adds them to totals in the shared ``METRICS_CACHE``: a
+background thread, started by the first observation, flushes every
+``METRICS_FLUSH_INTERVAL`` seconds, the process serving a scrape flushes
+first, and a process flushes what is left when it exits. ``/metrics`` serves
+the totals of all web, inference and Celery processes. Histogram buckets and label values
+are fixed when a metric is declared, so a scrape knows every key up front and
+reads them with one ``get_many``.
+
+Gauges (queue depths) are sampled by each process when it flushes and kept
+under a per-process key that expires after a few flush intervals; a scrape
+sums the processes that reported recently. Processes only add up through a
+shared cache (``REDIS_URL``); with the local-memory cache each process
+reports only itself.
+
+Metrics are best effort: if the cache is unreachable the pending counts are
+dropped and a warning is logged. Outside ``DEBUG`` the endpoint is refused
+until ``METRICS_TOKEN`` is set.
+"""
+import atexit
+import bisect
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+
+logger = logging.getLogger(__name__)
+
+CACHE_ALIAS = getattr(settings, "METRICS_CACHE", "default")
+FLUSH_INTERVAL = getattr(settings, "METRICS_FLUSH_INTERVAL", 10)
+GAUGE_TTL = 3 * FLUSH_INTERVAL
+
+KEY = "metrics:{name}:{labels}:{field}"
+PROCESSES_KEY = "metrics:processes"
+GAUGES_KEY = "metrics:gauges:{process}"
+
+# Seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MICROSECONDS = 1_000_000
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=None, buckets=DEFAULT_BUCKETS):
+        """``labels`` maps each label name to every value it can take."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels or ())
+        self.label_values = tuple(tuple(values) for values in (labels or {}).values())
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> (bucket keys, sum key)
+        self._series_keys = {
+            values: (
+                [self._key(_labels(self.label_names, values), bucket) for bucket in range(len(self.buckets) + 1)],
+                self._key(_labels(self.label_names, values), "sum"),
+            )
+            for values in itertools.product(*self.label_values)
+        }
+        registry.register(self)
+
+    def _key(self, series, field):
+        return KEY.format(name=self.name, labels=series, field=field)
+
+    def observe(self, seconds, **labels):
+        values = tuple(str(labels[name]) for name in self.label_names)
+        try:
+            bucket_keys, sum_key = self._series_keys[values]
+        except KeyError:
+            raise ValueError(f"{self.name}: {labels} are not declared label values")
+        # The sum is kept in whole microseconds: cache counters only add integers
+        registry.add({
+            bucket_keys[bisect.bisect_left(self.buckets, seconds)]: 1,
+            sum_key: int(seconds * MICROSECONDS),
+        })
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def keys(self):
+        for bucket_keys, sum_key in self._series_keys.values():
+            yield from bucket_keys
+            yield sum_key
+
+    def render(self, totals, gauges):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, (bucket_keys, sum_key) in self._series_keys.items():
+            series = _labels(self.label_names, values)
+            prefix = f"{series}," if series else ""
+            count = 0
+            for key, bound in zip(bucket_keys, [*self.buckets, "+Inf"]):
+                count += totals.get(key, 0)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            series = f"{{{series}}}" if series else ""
+            lines.append(f"{self.name}_sum{series} {totals.get(sum_key, 0) / MICROSECONDS}")
+            lines.append(f"{self.name}_count{series} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, sample, labels=(), per_process=True):
+        """
+        ``sample()`` returns the current value, or with ``labels`` a dict from
+        label value tuples to values. ``per_process`` gauges are summed over
+        every process; the others are sampled by the process serving the scrape.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.sample = sample
+        self.label_names = tuple(labels)
+        self.per_process = per_process
+        registry.register(self)
+
+    def read(self):
+        value = self.sample()
+        return value if self.label_names else {(): value}
+
+    def keys(self):
+        return []
+
+    def render(self, totals, gauges):
+        if self.per_process:
+            values = defaultdict(float)
+            for process in gauges:
+                for series, value in process.get(self.name, {}).items():
+                    values[series] += value
+        else:
+            try:
+                values = self.read()
+            except Exception as e:
+                logger.warning(f"Could not sample {self.name}: {e}")
+                values = {}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for series, value in sorted(values.items()):
+            series = _labels(self.label_names, series)
+            lines.append(f"{self.name}{{{series}}} {value}" if series else f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # A forked child must not flush the parent's pending counts a second time, and has no flush thread
+        self.lock = threading.Lock()
+        self.pending = defaultdict(int)
+        self.process = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def add(self, deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.pending[key] += delta
+            if self._flusher is None and not self._stopped.is_set():
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically, args=(self._stopped,), name="metrics-flush", daemon=True,
+                )
+                self._flusher.start()
+
+    def _flush_periodically(self, stopped):
+        # Keeps flushing while the process is idle, which also keeps its gauges from expiring
+        while not stopped.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and flush what is pending; runs at exit."""
+        self._stopped.set()
+        with self.lock:
+            pending = bool(self.pending)
+        if pending:
+            self.flush()
+
+    def flush(self):
+        """Add this process's pending counts to the shared totals and report its gauges."""
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(int)
+        cache = caches[CACHE_ALIAS]
+        try:
+            for key, delta in pending.items():
+                try:
+                    cache.incr(key, delta)
+                except ValueError:
+                    if not cache.add(key, delta, timeout=None):
+                        cache.incr(key, delta)
+
+            gauges = {
+                metric.name: metric.read()
+                for metric in self.metrics.values()
+                if isinstance(metric, Gauge) and metric.per_process
+            }
+            cache.set(GAUGES_KEY.format(process=self.process), gauges, GAUGE_TTL)
+            # Concurrent flushes may drop each other from the list; both re-add themselves next time
+            now = time.time()
+            processes = {
+                process: seen
+                for process, seen in (cache.get(PROCESSES_KEY) or {}).items()
+                if seen > now - GAUGE_TTL
+            }
+            processes[self.process] = now
+            cache.set(PROCESSES_KEY, processes, timeout=None)
+        except Exception as e:
+            logger.warning(f"Could not flush metrics: {e}")
+
+    def render(self):
+        self.flush()
+        cache = caches[CACHE_ALIAS]
+        totals = cache.get_many([key for metric in self.metrics.values() for key in metric.keys()])
+        processes = cache.get(PROCESSES_KEY) or {}
+        gauges = cache.get_many([GAUGES_KEY.format(process=process) for process in processes]).values()
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render(totals, gauges)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+atexit.register(registry.close)
+
+
+def _celery_queue_lengths():
+    from redis import Redis
+
+    client = Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=1, socket_connect_timeout=1)
+    queues = getattr(settings, "METRICS_CELERY_QUEUES", [])
+    pipeline = client.pipeline()
+    for queue in queues:
+        pipeline.llen(queue)
+    return {(queue,): length for queue, length in zip(queues, pipeline.execute())}
+
+
+CELERY_QUEUE_LENGTH = Gauge(
+    "celery_queue_length", "Tasks waiting in each Celery broker queue.",
+    _celery_queue_lengths, labels=("queue",), per_process=False,
+)
+
+
+@require_GET
+def metrics_view(request):
+    """
+    Every registered metric in the Prometheus text format. Requires
+    ``METRICS_TOKEN`` as a bearer token; only ``DEBUG`` serves it without one.
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden("Set METRICS_TOKEN to serve metrics outside DEBUG.")
+    elif not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
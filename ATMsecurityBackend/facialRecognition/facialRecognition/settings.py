@@ -14,6 +14,7 @@ import os
 from pathlib import Path
 from re import A
 from decouple import config
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -108,6 +109,113 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels.layers.InMemoryChannelLayer",  # Temporary, replace with Redis
     }
 }
+# Cache shared by all worker processes (face gallery versioning, face descriptors).
+# Without REDIS_URL each process gets its own local-memory cache, which is only
+# suitable for a single-process development server.
+# Face descriptors go to their own alias. Every descriptor entry has a TTL and the gallery
+# keys have none, so on Redis run with maxmemory and a volatile-lru policy to bound the size:
+# old descriptors are evicted first and gallery versions never are.
+REDIS_URL = config('REDIS_URL', default='')
+FACE_DESCRIPTOR_CACHE_MAX_ENTRIES = config('FACE_DESCRIPTOR_CACHE_MAX_ENTRIES', default=10000, cast=int)
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_URL,
+            "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+        },
+        "face_descriptors": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_URL,
+            "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        "face_descriptors": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "face_descriptors",
+            "OPTIONS": {"MAX_ENTRIES": FACE_DESCRIPTOR_CACHE_MAX_ENTRIES},
+        },
+    }
+# Celery (background tasks such as registration emails and face enrolment).
+# Run a worker with `celery -A facialRecognition worker`.
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=REDIS_URL or 'redis://localhost:6379/0')
+# Run tasks inline in the calling process, e.g. for local development without a broker
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+# Periodic tasks; django_celery_beat copies these into its database schedule (editable in the admin)
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    # Repairs daily account summaries for yesterday and today (transactions.aggregates)
+    'reconcile-daily-summaries': {
+        'task': 'transactions.tasks.reconcile_daily_summaries',
+        'schedule': crontab(hour=1, minute=30),
+    },
+    # Rewrites closed withdrawal limit buckets from Withdrawal rows (transactions.limits)
+    'reconcile-withdrawal-limits': {
+        'task': 'transactions.tasks.reconcile_withdrawal_limits',
+        'schedule': timedelta(minutes=10),
+    },
+}
+# Mass registration (/api/users/mass_register/): registration emails per Celery task.
+MASS_REGISTER_EMAIL_CHUNK_SIZE = config('MASS_REGISTER_EMAIL_CHUNK_SIZE', default=200, cast=int)
+# Sheet + photo archive imports (`python manage.py import_users` and the admin "Import users" page):
+# rows per transaction and processes encoding face photos (default: one per CPU).
+USER_IMPORT_BATCH_SIZE = config('USER_IMPORT_BATCH_SIZE', default=500, cast=int)
+USER_IMPORT_WORKERS = config('USER_IMPORT_WORKERS', default=os.cpu_count() or 1, cast=int)
+# Imports started from the admin run in a Celery task, and prefork pool children are daemonic and
+# cannot start processes of their own, so those encode photos in the task itself (0). Only raise
+# this for workers started with --pool=solo or --pool=threads.
+USER_IMPORT_TASK_WORKERS = config('USER_IMPORT_TASK_WORKERS', default=0, cast=int)
+
+# Ledger postings (transactions.ledger): times a posting is retried after a deadlock, lock timeout or
+# serialization failure before the error reaches the client.
+LEDGER_RETRIES = config('LEDGER_RETRIES', default=5, cast=int)
+
+# Withdrawal velocity limits (transactions.limits), checked against rolling per-account counters
+# before a withdrawal is posted: window length in seconds, maximum amount and count (0 = no limit).
+# Each window is split into WITHDRAWAL_LIMIT_BUCKETS buckets. Counters live in Redis when REDIS_URL is
+# set, otherwise in process memory ("local", for tests and single-process development only).
+WITHDRAWAL_LIMITS = [
+    {
+        'window': 24 * 60 * 60,
+        'amount': config('WITHDRAWAL_LIMIT_DAILY_AMOUNT', default='0'),
+        'count': config('WITHDRAWAL_LIMIT_DAILY_COUNT', default=0, cast=int),
+    },
+    {
+        'window': 60 * 60,
+        'amount': config('WITHDRAWAL_LIMIT_HOURLY_AMOUNT', default='0'),
+        'count': config('WITHDRAWAL_LIMIT_HOURLY_COUNT', default=0, cast=int),
+    },
+]
+WITHDRAWAL_LIMIT_BUCKETS = config('WITHDRAWAL_LIMIT_BUCKETS', default=24, cast=int)
+WITHDRAWAL_LIMIT_COUNTERS = 'redis' if REDIS_URL else 'local'
+WITHDRAWAL_LIMIT_CACHE = 'default'
+
+# Fraud scoring of withdrawals before authorization (transactions.fraud): accounts whose recent
+# activity each process keeps in memory, the per-assessment latency budget, the risk logged for
+# review and the risk at which a withdrawal is refused (0 = never refuse, only record the score).
+FRAUD_SCORING = config('FRAUD_SCORING', default=True, cast=bool)
+FRAUD_MAX_ACCOUNTS = config('FRAUD_MAX_ACCOUNTS', default=20000, cast=int)
+FRAUD_BUDGET_MS = config('FRAUD_BUDGET_MS', default=5, cast=float)
+FRAUD_REVIEW_THRESHOLD = config('FRAUD_REVIEW_THRESHOLD', default=0.7, cast=float)
+FRAUD_BLOCK_THRESHOLD = config('FRAUD_BLOCK_THRESHOLD', default=0, cast=float)
+
+# Geo-velocity check of withdrawals (transactions.geo) against the coordinates of registered ATMs:
+# consecutive withdrawals at least GEO_VELOCITY_MIN_KM apart that imply travelling faster than
+# GEO_VELOCITY_MAX_KMH are logged and scored as fraud, and refused if GEO_VELOCITY_BLOCK is set.
+GEO_VELOCITY_MAX_KMH = config('GEO_VELOCITY_MAX_KMH', default=900, cast=float)
+GEO_VELOCITY_MIN_KM = config('GEO_VELOCITY_MIN_KM', default=50, cast=float)
+GEO_VELOCITY_BLOCK = config('GEO_VELOCITY_BLOCK', default=False, cast=bool)
+
+# Account statements (CSV streamed, PDF built by a Celery task): rows fetched per database round trip,
+# and the most rows a PDF may have (reportlab keeps every page in memory until the file is written;
+# longer periods are refused as PDF and must be downloaded as CSV).
+STATEMENT_CHUNK_SIZE = config('STATEMENT_CHUNK_SIZE', default=2000, cast=int)
+STATEMENT_PDF_MAX_ROWS = config('STATEMENT_PDF_MAX_ROWS', default=10000, cast=int)
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -116,6 +224,66 @@ DATABASES = {
 }
 
 
+# Face recognition
+# dlib model files (shape_predictor_68_face_landmarks.dat, dlib_face_recognition_resnet_model_v1.dat)
+DLIB_MODELS_DIR = os.path.join(BASE_DIR, "dlib")
+# Load the dlib models when wsgi.py/asgi.py is imported instead of on first use, so a
+# pre-forking server master loads them once and workers share the pages copy-on-write.
+FACE_ENGINE_PRELOAD = config('FACE_ENGINE_PRELOAD', default=False, cast=bool)
+# Distance below which a probe is accepted as the closest enrolled face
+FACE_MATCH_THRESHOLD = 0.5
+# Nearest-neighbour backend for the face gallery: recognition.indexes.BruteForceIndex (exact),
+# recognition.indexes.IVFIndex (pure NumPy k-means partitions) or recognition.indexes.HNSWIndex (needs hnswlib).
+# Rebuild with `python manage.py rebuild_face_index`, which also reports recall against the exact scan.
+FACE_INDEX = {
+    "BACKEND": config('FACE_INDEX_BACKEND', default="recognition.indexes.BruteForceIndex"),
+    "OPTIONS": {},
+}
+# Directory of the memory-mapped gallery snapshot written by `python manage.py export_face_gallery`
+# (disabled when unset). Workers map it at startup and replay the changes published since it was taken;
+# re-export at least daily, since older changes expire. Workers only check file sizes and timestamps;
+# the export checksums what it wrote, `export_face_gallery --verify` re-checks a deployed copy and
+# FACE_GALLERY_SNAPSHOT_VERIFY makes every worker checksum the whole snapshot on load.
+FACE_GALLERY_SNAPSHOT_DIR = config('FACE_GALLERY_SNAPSHOT_DIR', default='') or None
+FACE_GALLERY_SNAPSHOT_VERIFY = config('FACE_GALLERY_SNAPSHOT_VERIFY', default=False, cast=bool)
+# Descriptors computed for identical image content are reused from this cache alias for
+# FACE_DESCRIPTOR_CACHE_TTL seconds (0 disables it). Hit/miss counts: /api/recognition/descriptor-cache/.
+FACE_DESCRIPTOR_CACHE = "face_descriptors"
+FACE_DESCRIPTOR_CACHE_TTL = config('FACE_DESCRIPTOR_CACHE_TTL', default=60 * 60 * 24, cast=int)
+# Face detection and descriptors run in a pool of worker processes (0 = inline in the request thread).
+# At most FACE_INFERENCE_QUEUE_SIZE jobs are in flight; beyond that the recognize endpoint answers
+# 503 with Retry-After. Callers give up on a job after FACE_INFERENCE_TIMEOUT seconds.
+FACE_INFERENCE_WORKERS = config('FACE_INFERENCE_WORKERS', default=2, cast=int)
+FACE_INFERENCE_QUEUE_SIZE = config('FACE_INFERENCE_QUEUE_SIZE', default=8, cast=int)
+FACE_INFERENCE_TIMEOUT = config('FACE_INFERENCE_TIMEOUT', default=10, cast=float)
+# Most frames accepted by /api/recognition/recognize/batch/
+FACE_BATCH_MAX_FRAMES = config('FACE_BATCH_MAX_FRAMES', default=16, cast=int)
+# WebSocket streaming (ws/recognition/stream/): frames in a row that must agree before a
+# "recognized" event is pushed. Between detections the face is followed with a correlation tracker;
+# the detector runs again every FACE_STREAM_REDETECT_EVERY frames, or as soon as the tracker's
+# confidence falls below FACE_STREAM_TRACK_MIN_CONFIDENCE.
+FACE_STREAM_STABLE_FRAMES = config('FACE_STREAM_STABLE_FRAMES', default=5, cast=int)
+FACE_STREAM_REDETECT_EVERY = config('FACE_STREAM_REDETECT_EVERY', default=10, cast=int)
+FACE_STREAM_TRACK_MIN_CONFIDENCE = config('FACE_STREAM_TRACK_MIN_CONFIDENCE', default=7.0, cast=float)
+# Longest side, in pixels, of the downscaled copy the face detector runs on (0 = full resolution).
+# Landmarks and descriptors are always computed on the full-resolution frame.
+FACE_DETECTION_MAX_SIDE = config('FACE_DETECTION_MAX_SIDE', default=640, cast=int)
+# Debug aid: keep frames that fail recognition in this directory (disabled when unset),
+# deleting the oldest once the directory exceeds RECOGNITION_FAILED_FRAMES_MAX_BYTES.
+RECOGNITION_FAILED_FRAMES_DIR = config('RECOGNITION_FAILED_FRAMES_DIR', default='') or None
+RECOGNITION_FAILED_FRAMES_MAX_BYTES = config('RECOGNITION_FAILED_FRAMES_MAX_BYTES', default=50 * 1024 * 1024, cast=int)
+# Share of gallery match results logged at DEBUG level (the lines are skipped entirely above DEBUG).
+RECOGNITION_MATCH_LOG_SAMPLE_RATE = config('RECOGNITION_MATCH_LOG_SAMPLE_RATE', default=0.01, cast=float)
+
+# Prometheus metrics at /metrics (facialRecognition.metrics): every process adds its counts to the
+# shared cache every METRICS_FLUSH_INTERVAL seconds and at exit. Scrapers must send
+# "Authorization: Bearer <METRICS_TOKEN>"; without a token the endpoint only answers when DEBUG is on.
+METRICS_CACHE = 'default'
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=10, cast=int)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+# Celery broker queues whose length is reported:
+METRICS_CELERY_QUEUES = ['celery'] if REDIS_URL else []
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
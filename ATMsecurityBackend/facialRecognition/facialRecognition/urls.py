@@ -21,6 +21,7 @@ from django.conf import settings
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
 )
+from .metrics import metrics_view
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/recognition/', include('recognition.urls')),
@@ -31,6 +32,7 @@ urlpatterns = [
     path('', include('dj_rest_auth.urls')),
     path('register/', include('dj_rest_auth.registration.urls')),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('metrics', metrics_view, name='metrics'),
 ]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'facialRecognition.settings')
 
 application = get_wsgi_application()
+
+# Load the dlib models before a pre-forking server (e.g. gunicorn --preload) forks its workers
+from recognition.engine import preload_if_configured  # noqa: E402
+preload_if_configured()
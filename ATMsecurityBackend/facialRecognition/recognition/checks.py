@@ -0,0 +1,19 @@
+from django.core.checks import Warning, register
+
+from .gallery import cache_is_shared
+
+
+@register()
+def check_gallery_cache(app_configs, **kwargs):
+    if cache_is_shared():
+        return []
+    return [
+        Warning(
+            "The default cache is local to each process, so face gallery changes are not shared.",
+            hint=(
+                "Enrolments made by Celery workers or other web processes never reach this process's "
+                "gallery. Set REDIS_URL for any deployment with more than one process."
+            ),
+            id="recognition.W001",
+        )
+    ]
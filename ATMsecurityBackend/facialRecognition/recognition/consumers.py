@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from userManager.models import CustomUser
+from .gallery import get_gallery
+from .inference import InferenceUnavailable, describe_stream_frame, get_inference_service
+from .metrics import RECOGNITION_PHASE_SECONDS
+from .models import face_recognized
+from .tracking import FaceTracker, tracking_frame
+
+logger = logging.getLogger(__name__)
+
+STABLE_FRAMES = getattr(settings, "FACE_STREAM_STABLE_FRAMES", 5)
+
+
+def match_encoding(encoding):
+    with RECOGNITION_PHASE_SECONDS.time(phase="match"):
+        return get_gallery().match(encoding)
+
+
+def track_face(tracker, frame):
+    """Decode ``frame`` for tracking; returns ``(gray, scale, face)`` with ``face`` ``None`` if detection must run."""
+    with RECOGNITION_PHASE_SECONDS.time(phase="track"):
+        gray, scale = tracking_frame(frame)
+        return gray, scale, tracker.track(gray, scale) if gray is not None else None
+
+
+def find_user(user_id):
+    with RECOGNITION_PHASE_SECONDS.time(phase="db"):
+        return CustomUser.objects.filter(id=user_id).first()
+
+
+class FaceStreamConsumer(AsyncWebsocketConsumer):
+    """
+    Continuous recognition over a WebSocket.
+
+    The ATM camera sends JPEG/PNG frames as binary messages. Only the newest
+    frame is kept: if inference falls behind, older unprocessed frames are
+    dropped rather than queued. Once a face is detected it is followed with a
+    correlation tracker (``recognition.tracking``), and the detector only runs
+    again every ``FACE_STREAM_REDETECT_EVERY`` frames or when tracking
+    confidence drops; every frame still gets landmarks and a descriptor, which
+    are matched against the gallery. A ``recognized`` event is
+    pushed once the same identity has matched ``FACE_STREAM_STABLE_FRAMES``
+    frames in a row, and ``lost`` when a stable identity stops matching.
+
+    A failure while handling one frame is reported as an ``error`` event and
+    the stream goes on; if the frame loop itself dies, the socket is closed.
+    """
+
+    async def connect(self):
+        self.latest_frame = None
+        self.frame_ready = asyncio.Event()
+        self.tracker = FaceTracker()
+        self.recent = deque(maxlen=STABLE_FRAMES)
+        self.identity = None
+        self.received = self.processed = self.dropped = 0
+        await self.accept()
+        self.worker = asyncio.create_task(self.process_frames())
+        self.worker.add_done_callback(self.worker_stopped)
+
+    def worker_stopped(self, worker):
+        if worker.cancelled() or worker.exception() is None:
+            return
+        logger.error(f"Face stream worker died, closing the socket: {worker.exception()!r}")
+        asyncio.ensure_future(self.close(code=1011))
+
+    async def disconnect(self, code):
+        worker = getattr(self, "worker", None)
+        if worker is not None:
+            worker.cancel()
+        logger.info(
+            f"Face stream closed: {self.received} frames received, "
+            f"{self.processed} processed, {self.dropped} dropped"
+        )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            await self.send_event("error", error="Send frames as binary messages")
+            return
+        self.received += 1
+        if self.latest_frame is not None:
+            self.dropped += 1  # Superseded before inference got to it
+        self.latest_frame = bytes_data
+        self.frame_ready.set()
+
+    async def process_frames(self):
+        service = get_inference_service()
+        while True:
+            await self.frame_ready.wait()
+            self.frame_ready.clear()
+            frame, self.latest_frame = self.latest_frame, None
+            if frame is None:
+                continue
+            try:
+                await self.process_frame(service, frame)
+            except Exception as e:
+                logger.error(f"Error in face stream: {e}")
+                await self.send_event("error", error=str(e))
+
+    async def process_frame(self, service, frame):
+        loop = asyncio.get_running_loop()
+        # The tracker is CPU work too, so it runs off the event loop; frames are handled one at a time
+        gray, scale, face = await loop.run_in_executor(None, track_face, self.tracker, frame)
+        try:
+            if service.workers:
+                pending = asyncio.wrap_future(service.submit(describe_stream_frame, frame, face))
+            else:
+                # Inline inference would block every other connection on this event loop
+                pending = loop.run_in_executor(None, describe_stream_frame, frame, face)
+            error, encoding, rectangle = await asyncio.wait_for(pending, service.timeout)
+        except (InferenceUnavailable, asyncio.TimeoutError):
+            # Drop this frame; the next one will be the freshest available
+            self.dropped += 1
+            return
+
+        self.processed += 1
+        if error is not None:
+            self.tracker.reset()
+        elif face is None and gray is not None:
+            await loop.run_in_executor(None, self.tracker.start, gray, scale, rectangle)
+        user_id = distance = None
+        if error is None:
+            user_id, distance = await sync_to_async(match_encoding)(encoding)
+        await self.observe(user_id, distance)
+
+    async def observe(self, user_id, distance):
+        self.recent.append((user_id, distance))
+        ids = {match for match, _ in self.recent}
+        stable = len(self.recent) == STABLE_FRAMES and len(ids) == 1 and user_id is not None
+
+        if stable and user_id != self.identity:
+            self.identity = user_id
+            user = await sync_to_async(find_user)(user_id)
+            if user is None:
+                self.identity = None
+                return
+            mean_distance = sum(d for _, d in self.recent) / len(self.recent)
+            await sync_to_async(face_recognized.send)(sender=CustomUser, user_id=user.id, confidence=1 - mean_distance)
+            await self.send_event(
+                "recognized",
+                user_id=str(user.id),
+                username=user.username,
+                email=user.email,
+                name=f"{user.first_name} {user.last_name}".strip(),
+                confidence=1 - mean_distance,
+                frames=STABLE_FRAMES,
+            )
+        elif self.identity is not None and self.identity not in ids:
+            await self.send_event("lost", user_id=str(self.identity))
+            self.identity = None
+
+    async def send_event(self, event, **payload):
+        await self.send(text_data=json.dumps({"type": event, **payload}))
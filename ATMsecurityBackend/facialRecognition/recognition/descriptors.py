@@ -0,0 +1,94 @@
+"""
+Cache of face descriptors keyed by image content.
+
+The same pixels come through the inference pool again and again: retried
+recognize requests resend the frame, and admin edits or imports re-submit the
+same enrolment photo. Results are stored under the SHA-256 of the decoded
+pixels plus the descriptor model version, so a hit skips detection, landmarks
+and the ResNet forward pass entirely.
+
+Entries live in the ``FACE_DESCRIPTOR_CACHE`` cache alias for
+``FACE_DESCRIPTOR_CACHE_TTL`` seconds (0 disables the cache). Hit and miss
+counters are kept in the same cache so they add up across worker processes.
+"""
+import hashlib
+import logging
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from userManager.fields import MODEL_DLIB_RESNET_V1
+from .imaging import DETECTION_MAX_SIDE
+
+logger = logging.getLogger(__name__)
+
+CACHE_ALIAS = getattr(settings, "FACE_DESCRIPTOR_CACHE", "default")
+TTL = getattr(settings, "FACE_DESCRIPTOR_CACHE_TTL", 60 * 60 * 24)
+
+KEY = "recognition:descriptor:{kind}:{model}:{digest}"
+HITS_KEY = "recognition:descriptor:hits"
+MISSES_KEY = "recognition:descriptor:misses"
+
+
+def image_digest(pixels):
+    """SHA-256 of a decoded image's shape and pixel bytes."""
+    pixels = np.ascontiguousarray(pixels)
+    digest = hashlib.sha256(f"{pixels.dtype.str}{pixels.shape}".encode())
+    digest.update(memoryview(pixels).cast("B"))
+    return digest.hexdigest()
+
+
+def _count(key):
+    cache = caches[CACHE_ALIAS]
+    try:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception:
+        pass  # Counters are best effort, e.g. evicted between add() and incr()
+
+
+def cached_descriptor(kind, pixels, compute):
+    """
+    Return ``compute(pixels)`` -- an ``(error, encoding)`` pair -- through the
+    cache. ``kind`` separates pipelines that give different results for the
+    same pixels (e.g. probe frames versus enrolment photos).
+    """
+    if not TTL:
+        return compute(pixels)
+
+    cache = caches[CACHE_ALIAS]
+    # Probes are detected on a downscaled copy, so the detection size is part of the result
+    key = KEY.format(kind=kind, model=f"{MODEL_DLIB_RESNET_V1}.{DETECTION_MAX_SIDE}", digest=image_digest(pixels))
+    try:
+        cached = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Face descriptor cache unavailable: {e}")
+        return compute(pixels)
+
+    if cached is not None:
+        _count(HITS_KEY)
+        error, data = cached
+        return error, None if data is None else np.frombuffer(data, dtype=np.float32)
+
+    _count(MISSES_KEY)
+    error, encoding = compute(pixels)
+    data = None if encoding is None else np.asarray(encoding, dtype=np.float32).tobytes()
+    try:
+        cache.set(key, (error, data), TTL)
+    except Exception as e:
+        logger.warning(f"Face descriptor cache unavailable: {e}")
+    return error, encoding
+
+
+def cache_stats():
+    """Hit and miss counts since the counters were last reset or evicted."""
+    counts = caches[CACHE_ALIAS].get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else None,
+        "ttl": TTL,
+    }
@@ -0,0 +1,91 @@
+"""
+Lazily loaded dlib face models.
+
+Nothing is read from disk at import time, so management commands, migrations,
+Celery workers and the admin only pay for the models if they actually detect
+or encode a face. Servers that fork workers can call ``preload()`` in the
+master process (see ``FACE_ENGINE_PRELOAD``) so every worker shares the loaded
+model pages copy-on-write instead of loading its own copy.
+"""
+import logging
+import os
+import resource
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FaceEngine:
+    """Holds the dlib detector, landmark predictor and ResNet descriptor model."""
+
+    def __init__(self, shape_predictor_path, face_recognition_model_path):
+        self.shape_predictor_path = shape_predictor_path
+        self.face_recognition_model_path = face_recognition_model_path
+        self._lock = threading.Lock()
+        self._models = None
+
+    @property
+    def loaded(self):
+        return self._models is not None
+
+    def load(self):
+        """Load every model now; later calls are free."""
+        if self._models is not None:
+            return self._models
+        with self._lock:
+            if self._models is None:
+                for path in [self.shape_predictor_path, self.face_recognition_model_path]:
+                    if not os.path.exists(path):
+                        raise RuntimeError(f"Missing file: {path}")
+
+                import dlib
+
+                started = time.perf_counter()
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                models = (
+                    dlib.get_frontal_face_detector(),
+                    dlib.shape_predictor(self.shape_predictor_path),
+                    dlib.face_recognition_model_v1(self.face_recognition_model_path),
+                )
+                rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                logger.info(
+                    f"Loaded dlib face models in {time.perf_counter() - started:.2f}s "
+                    f"(peak RSS +{(rss_after - rss_before) / 1024:.1f} MB, pid {os.getpid()})"
+                )
+                self._models = models
+        return self._models
+
+    @property
+    def face_detector(self):
+        return self.load()[0]
+
+    @property
+    def shape_predictor(self):
+        return self.load()[1]
+
+    @property
+    def face_rec_model(self):
+        return self.load()[2]
+
+
+def _model_path(name):
+    return os.path.join(getattr(settings, "DLIB_MODELS_DIR", os.path.join(settings.BASE_DIR, "dlib")), name)
+
+
+engine = FaceEngine(
+    _model_path("shape_predictor_68_face_landmarks.dat"),
+    _model_path("dlib_face_recognition_resnet_model_v1.dat"),
+)
+
+
+def preload():
+    """Load the models in this process, typically a server master before it forks."""
+    engine.load()
+
+
+def preload_if_configured():
+    if getattr(settings, "FACE_ENGINE_PRELOAD", False):
+        preload()
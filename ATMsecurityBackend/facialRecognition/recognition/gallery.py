@@ -0,0 +1,515 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from .indexes import load_index, squared_distances
+from .snapshot import SnapshotError, read_snapshot, snapshot_dir
+
+logger = logging.getLogger(__name__)
+
+ENCODING_SIZE = 128
+MATCH_THRESHOLD = getattr(settings, "FACE_MATCH_THRESHOLD", 0.5)
+
+# Shared across worker processes through the configured cache
+VERSION_KEY = "recognition:gallery:version"
+CHANGE_KEY = "recognition:gallery:change:{}"
+CHANGE_TTL = 60 * 60 * 24
+# Recorded as the change of a version whose readers must rebuild from scratch
+REBUILD = "*"
+# Past this many pending changes a full rebuild is cheaper than replaying them
+MAX_REPLAY = 1000
+# How long a publisher waits for the holder of the next change slot to bump the version
+CLAIM_TIMEOUT = 1.0
+
+
+class FaceGallery:
+    """
+    Process-level gallery of enrolled face encodings.
+
+    Encodings are kept in a contiguous float32 (N x 128) matrix with a parallel
+    array of user ids, so matching a probe is one batched distance computation
+    instead of a Python loop over every enrolled user.
+
+    Every enrolment change records the affected user id under the next
+    version in the shared cache and then bumps the version counter (see
+    ``publish_change``). Before matching, each process replays the ids it has
+    not seen yet, reloading only those rows.
+
+    Lookups go through the index backend configured in ``FACE_INDEX``, whose
+    candidates are re-ranked here with exact distances.
+
+    Rows live in two segments: a fixed-size base, which is the memory-mapped
+    snapshot when ``FACE_GALLERY_SNAPSHOT_DIR`` has one, and a growable tail
+    for rows appended afterwards. Row ``r`` is in the base iff
+    ``r < len(base)``. Base vectors and ids (sorted, so finding a user's row is
+    a binary search) are never written: removing or re-enrolling a base user
+    only marks its row dead and a re-enrolment appends to the tail, so every
+    process keeps sharing the mapped pages. Dead rows are dropped on the next
+    load.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._base = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._base_norms = np.empty(0, dtype=np.float32)
+        self._base_ids = np.empty(0, dtype="<U1")
+        self._dead = set()
+        self._dead_rows = np.empty(0, dtype=np.intp)
+        self._tail = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._tail_norms = np.empty(0, dtype=np.float32)
+        self._tail_ids = []
+        self._tail_rows = {}
+        self.index = None
+        self.version = None
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._base) - len(self._dead) + len(self._tail_ids)
+
+    def _size(self):
+        """Rows in use, dead base rows included."""
+        return len(self._base) + len(self._tail_ids)
+
+    @property
+    def matrix(self):
+        """Every row in use; dead base rows are still in it."""
+        if not self._tail_ids:
+            return self._base
+        return np.concatenate([self._base, self._tail[:len(self._tail_ids)]])
+
+    @property
+    def user_ids(self):
+        """The user id of every row of ``matrix``, ``None`` for dead rows."""
+        ids = np.empty(self._size(), dtype=object)
+        ids[:len(self._base)] = [self._pk(user_id) for user_id in self._base_ids.tolist()]
+        ids[len(self._base):] = self._tail_ids
+        ids[self._dead_rows] = None
+        return ids
+
+    @staticmethod
+    def _queryset():
+        from userManager.models import CustomUser
+
+        return CustomUser.objects.filter(face_encoding__isnull=False, is_active=True)
+
+    @classmethod
+    def _pk(cls, user_id):
+        """Ids published through the cache or stored in the base are strings; return the primary key."""
+        return cls._queryset().model._meta.pk.to_python(str(user_id))
+
+    @staticmethod
+    def _to_vector(user_id, encoding):
+        try:
+            vector = np.asarray(encoding, dtype=np.float32)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Skipping unreadable face encoding for user {user_id}: {e}")
+            return None
+        if vector.shape != (ENCODING_SIZE,):
+            return None
+        return vector
+
+    @classmethod
+    def scan_database(cls):
+        """Yield ``(user_id, vector)`` for every active user with a usable encoding."""
+        rows = cls._queryset().values_list("id", "face_encoding")
+        for user_id, encoding in rows.iterator(chunk_size=2000):
+            vector = cls._to_vector(user_id, encoding)
+            if vector is not None:
+                yield user_id, vector
+
+    def load(self):
+        """
+        Build the gallery from the snapshot in ``FACE_GALLERY_SNAPSHOT_DIR`` plus
+        the changes published since it was taken, or else from every active
+        user with a stored face encoding.
+        """
+        # Read the version first so changes committed during the scan are replayed afterwards
+        version = current_version()
+        warn_if_cache_is_local()
+        with self._lock:
+            if snapshot_dir() and self._load_snapshot(version):
+                return
+            ids = []
+            encodings = []
+            for user_id, vector in self.scan_database():
+                ids.append(str(user_id))
+                encodings.append(vector)
+            ids = np.array(ids, dtype=str)
+            order = np.argsort(ids)
+            matrix = np.vstack(encodings)[order] if encodings else np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            self._install(ids[order], matrix, np.einsum("ij,ij->i", matrix, matrix), version)
+        logger.info(f"Loaded face gallery with {len(ids)} encodings at version {version}")
+
+    def _install(self, ids, matrix, sq_norms, version):
+        """Make ``matrix`` the base; ``ids`` are its rows' user ids as sorted strings."""
+        index = load_index()
+        index.build(matrix)
+        self._base, self._base_norms, self._base_ids = matrix, sq_norms, ids
+        self._dead = set()
+        self._dead_rows = np.empty(0, dtype=np.intp)
+        self._tail = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._tail_norms = np.empty(0, dtype=np.float32)
+        self._tail_ids = []
+        self._tail_rows = {}
+        self.index = index
+        self.version = version
+        self.loaded = True
+
+    def _load_snapshot(self, version):
+        """Map the snapshot and replay changes up to ``version``; False if it cannot be used."""
+        started = time.perf_counter()
+        try:
+            snapshot = read_snapshot()
+        except SnapshotError as e:
+            logger.warning(f"Not using face gallery snapshot: {e}")
+            return False
+        if version is None or snapshot.version > version or version - snapshot.version > MAX_REPLAY:
+            logger.warning(
+                f"Face gallery snapshot at version {snapshot.version} is too far from "
+                f"version {version}; loading from the database"
+            )
+            return False
+        changes = {}
+        if version > snapshot.version:
+            keys = [CHANGE_KEY.format(v) for v in range(snapshot.version + 1, version + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) != len(keys):
+                logger.warning("Changes since the face gallery snapshot have expired; loading from the database")
+                return False
+
+        if REBUILD in changes.values():
+            return False
+        self._install(snapshot.ids, snapshot.matrix, snapshot.sq_norms, version)
+        if changes:
+            self.refresh_users(changes.values())
+        logger.info(
+            f"Mapped face gallery snapshot with {len(snapshot.ids)} encodings at version "
+            f"{snapshot.version}, replayed {len(changes)} changes to version {version} "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+        return True
+
+    def upsert(self, user_id, encoding):
+        """Insert or replace a single user's encoding."""
+        vector = self._to_vector(user_id, encoding)
+        if vector is None:
+            self.remove(user_id)
+            return
+        with self._lock:
+            row = self._tail_rows.get(user_id)
+            if row is None:
+                base_row = self._base_row(user_id)
+                if base_row is not None:
+                    self._kill(base_row)
+                row = self._size()
+                tail_row = row - len(self._base)
+                if tail_row == len(self._tail):
+                    # Grow geometrically so repeated enrolments stay amortised O(1)
+                    capacity = max(16, 2 * len(self._tail))
+                    tail = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+                    tail[:tail_row] = self._tail[:tail_row]
+                    tail_norms = np.empty(capacity, dtype=np.float32)
+                    tail_norms[:tail_row] = self._tail_norms[:tail_row]
+                    self._tail, self._tail_norms = tail, tail_norms
+                self._tail_ids.append(user_id)
+                self._tail_rows[user_id] = row
+            offset = row - len(self._base)
+            self._tail[offset] = vector
+            self._tail_norms[offset] = vector @ vector
+            self.index.add(row, vector)
+
+    def _base_row(self, user_id):
+        """The live base row of ``user_id``, or ``None``."""
+        key = str(user_id)
+        row = int(np.searchsorted(self._base_ids, key))
+        if row < len(self._base_ids) and self._base_ids[row] == key and row not in self._dead:
+            return row
+        return None
+
+    def _kill(self, row):
+        """Mark base ``row`` dead without writing to the mapped pages."""
+        self._dead.add(row)
+        self._dead_rows = np.array(sorted(self._dead), dtype=np.intp)
+        self.index.remove(row)
+
+    def _dead_in(self, start, stop):
+        """Offsets from ``start`` of the dead rows in ``[start, stop)``."""
+        dead = self._dead_rows
+        return dead[(dead >= start) & (dead < stop)] - start
+
+    def _user_id(self, row):
+        if row < len(self._base):
+            return self._pk(self._base_ids[row])
+        return self._tail_ids[row - len(self._base)]
+
+    def _gather(self, rows):
+        """Vectors and squared norms of arbitrary ``rows``, across both segments."""
+        split = len(self._base)
+        in_base = rows < split
+        vectors = np.empty((len(rows), ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.empty(len(rows), dtype=np.float32)
+        vectors[in_base] = self._base[rows[in_base]]
+        sq_norms[in_base] = self._base_norms[rows[in_base]]
+        vectors[~in_base] = self._tail[rows[~in_base] - split]
+        sq_norms[~in_base] = self._tail_norms[rows[~in_base] - split]
+        return vectors, sq_norms
+
+    def _blocks(self, chunk_size=None):
+        """Yield ``(start_row, vectors, sq_norms)`` blocks covering every row in order, dead ones included."""
+        segments = [
+            (0, self._base, self._base_norms, len(self._base)),
+            (len(self._base), self._tail, self._tail_norms, len(self._tail_ids)),
+        ]
+        for offset, vectors, sq_norms, count in segments:
+            step = chunk_size or max(count, 1)
+            for start in range(0, count, step):
+                stop = min(start + step, count)
+                yield offset + start, vectors[start:stop], sq_norms[start:stop]
+
+    def remove(self, user_id):
+        """Drop a user's row: a base row is marked dead, a tail row gets the last tail row moved into it."""
+        with self._lock:
+            row = self._tail_rows.pop(user_id, None)
+            if row is None:
+                base_row = self._base_row(user_id)
+                if base_row is not None:
+                    self._kill(base_row)
+                return
+            last = self._size() - 1
+            self.index.remove(last)
+            if row != last:
+                offset, last_offset = row - len(self._base), last - len(self._base)
+                moved = self._tail_ids[last_offset]
+                self._tail[offset] = self._tail[last_offset]
+                self._tail_norms[offset] = self._tail_norms[last_offset]
+                self._tail_ids[offset] = moved
+                self._tail_rows[moved] = row
+                self.index.add(row, self._tail[offset])
+            self._tail_ids.pop()
+
+    def refresh_users(self, user_ids):
+        """Reload only the given users' rows from the database."""
+        queryset = self._queryset()
+        user_ids = {self._pk(user_id) for user_id in user_ids}
+        found = dict(queryset.filter(id__in=user_ids).values_list("id", "face_encoding"))
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in found:
+                    self.upsert(user_id, found[user_id])
+                else:
+                    # Deleted, deactivated or no longer enrolled
+                    self.remove(user_id)
+
+    def sync(self):
+        """Load the gallery or replay changes published by other processes."""
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load()
+            return
+
+        shared = cache.get(VERSION_KEY)
+        if shared == self.version:
+            return
+
+        with self._lock:
+            local = self.version
+            if shared == local:
+                return
+            if shared is None or local is None or shared < local or shared - local > MAX_REPLAY:
+                self.load()
+                return
+            keys = [CHANGE_KEY.format(v) for v in range(local + 1, shared + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) != len(keys) or REBUILD in changes.values():
+                # A change expired or a rebuild was requested: never guess, rebuild
+                self.load()
+                return
+            self.refresh_users(changes.values())
+            self.version = shared
+
+    def distances(self, encoding):
+        """Euclidean distance from ``encoding`` to every gallery row; ``inf`` for dead rows."""
+        query = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        with self._lock:
+            sq = []
+            for start, vectors, sq_norms in self._blocks():
+                sq.append(squared_distances(vectors, sq_norms, query))
+                sq[-1][self._dead_in(start, start + len(vectors))] = np.inf
+        return np.sqrt(np.concatenate(sq)) if sq else np.empty(0, dtype=np.float32)
+
+    def nearest(self, encoding, exact=False):
+        """
+        Return ``(row, distance)`` of the closest gallery row, or ``(None, inf)``.
+        ``exact=True`` bypasses the index and scans every row.
+        """
+        query = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        with self._lock:
+            if not len(self):
+                return None, float("inf")
+            rows = None if exact else self.index.search(query)
+            if rows is None:
+                best_row, best_sq = None, np.inf
+                for start, vectors, sq_norms in self._blocks():
+                    sq = squared_distances(vectors, sq_norms, query)
+                    sq[self._dead_in(start, start + len(vectors))] = np.inf
+                    best = int(np.argmin(sq))
+                    if sq[best] < best_sq:
+                        best_row, best_sq = start + best, sq[best]
+                return best_row, float(np.sqrt(max(best_sq, 0.0)))
+            if not len(rows):
+                return None, float("inf")
+            sq = squared_distances(*self._gather(rows), query)
+            best = int(np.argmin(sq))
+            return int(rows[best]), float(np.sqrt(sq[best]))
+
+    def nearest_many(self, encodings, exact=False, chunk_size=65536):
+        """
+        Closest gallery row for every row of an M x 128 block of probes.
+
+        With an exact index the whole block is matched in one matrix product per
+        chunk of gallery rows. Returns ``(rows, distances)``; rows are -1 where
+        the gallery (or the index's candidate set) is empty.
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        rows = np.full(len(queries), -1, dtype=np.intp)
+        best = np.full(len(queries), np.inf, dtype=np.float32)
+        with self._lock:
+            if not len(self) or not len(queries):
+                return rows, best
+            if not exact and not self.index.exact:
+                for i, query in enumerate(queries):
+                    row, distance = self.nearest(query)
+                    if row is not None:
+                        rows[i], best[i] = row, distance
+                return rows, best
+
+            q_norms = np.einsum("ij,ij->i", queries, queries)
+            everyone = np.arange(len(queries))
+            for start, vectors, sq_norms in self._blocks(chunk_size):
+                sq = sq_norms[None, :] - 2.0 * (queries @ vectors.T) + q_norms[:, None]
+                sq[:, self._dead_in(start, start + len(vectors))] = np.inf
+                block_rows = np.argmin(sq, axis=1)
+                block_best = sq[everyone, block_rows]
+                better = block_best < best
+                best[better] = block_best[better]
+                rows[better] = block_rows[better] + start
+        return rows, np.sqrt(np.maximum(best, 0.0))
+
+    def match_many(self, encodings, threshold=MATCH_THRESHOLD):
+        """``match`` for an M x 128 block: a list of ``(user_id or None, distance)``."""
+        with self._lock:
+            rows, distances = self.nearest_many(encodings)
+            ids = [self._user_id(row) if row >= 0 else None for row in rows]
+        return [
+            (user_id if user_id is not None and distance < threshold else None, float(distance))
+            for user_id, distance in zip(ids, distances)
+        ]
+
+    def match(self, encoding, threshold=MATCH_THRESHOLD):
+        """
+        Return ``(user_id, distance)`` for the closest enrolled face, or
+        ``(None, distance)`` if nothing is closer than ``threshold``.
+        """
+        with self._lock:
+            row, best_distance = self.nearest(encoding)
+            best_id = self._user_id(row) if row is not None else None
+        if best_id is not None and best_distance < threshold:
+            return best_id, best_distance
+        return None, best_distance
+
+
+_gallery = FaceGallery()
+
+
+def get_gallery():
+    """Return the gallery shared by every request in this process, brought up to date."""
+    _gallery.sync()
+    return _gallery
+
+
+def current_version():
+    """The shared gallery version, starting a new counter if it is missing."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Not 0: change entries of an evicted counter may outlive it and must not be replayed as new ones
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _publish(change):
+    """
+    Record ``change`` as the next version, then bump the version counter.
+
+    The slot is claimed with ``cache.add``, so concurrent publishers take
+    versions one after another, and a reader never sees a version whose change
+    is not written yet. If the holder of the slot dies before bumping the
+    version, the next publisher bumps it after ``CLAIM_TIMEOUT``; readers then
+    find the gap and rebuild.
+    """
+    waited_for, deadline = None, None
+    while True:
+        version = current_version()
+        if cache.add(CHANGE_KEY.format(version + 1), change, CHANGE_TTL):
+            break
+        if version != waited_for:
+            waited_for, deadline = version, time.monotonic() + CLAIM_TIMEOUT
+        elif time.monotonic() > deadline:
+            logger.warning(f"Face gallery version {version + 1} was claimed but never published; skipping it")
+            try:
+                cache.incr(VERSION_KEY)
+            except ValueError:
+                pass  # Evicted meanwhile; the next loop starts a new counter
+            waited_for = None
+        time.sleep(0.001)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # Evicted meanwhile: a new counter has no replayable history, so everyone rebuilds
+        return current_version()
+
+
+def publish_change(user_id):
+    """Record that ``user_id``'s enrolment changed so every process refreshes that row."""
+    version = _publish(str(user_id))
+    if _gallery.loaded:
+        with _gallery._lock:
+            _gallery.refresh_users([user_id])
+            if _gallery.version == version - 1:
+                _gallery.version = version
+    return version
+
+
+def publish_rebuild():
+    """Ask every process to rebuild its gallery and index from scratch."""
+    return _publish(REBUILD)
+
+
+def cache_is_shared():
+    return not isinstance(caches["default"], (LocMemCache, DummyCache))
+
+
+_warned = False
+
+
+def warn_if_cache_is_local():
+    global _warned
+    if not cache_is_shared() and not _warned:
+        _warned = True
+        logger.warning(
+            "The face gallery's change log is in a per-process cache: enrolments made by other processes "
+            "(Celery workers, other web workers) will not reach this gallery until it restarts. Set REDIS_URL."
+        )
+
+
+def face_changed(user_id):
+    """Publish a gallery change once the surrounding transaction commits."""
+    transaction.on_commit(lambda: publish_change(user_id))
@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DETECTION_MAX_SIDE = getattr(settings, "FACE_DETECTION_MAX_SIDE", 640)
+
+
+def decode_image(image_data):
+    """
+    Decode uploaded image bytes straight from memory into a BGR array.
+
+    Returns ``None`` if the bytes are not a readable image.
+    """
+    if not image_data:
+        return None
+    buffer = np.frombuffer(image_data, dtype=np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def detect_faces(detector, gray, max_side=DETECTION_MAX_SIDE):
+    """
+    Run the HOG face detector on a copy of ``gray`` downscaled so its longest
+    side is at most ``max_side`` pixels, and map the detections back onto the
+    full-resolution frame.
+
+    Landmarks and descriptors should still be computed on the original frame;
+    only the detection pass, the dominant per-request cost on 1080p+ stills,
+    runs on the small image. A falsy ``max_side`` detects at full resolution.
+    """
+    height, width = gray.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return list(detector(gray))
+
+    import dlib
+
+    scale = max_side / max(height, width)
+    small = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return [
+        dlib.rectangle(
+            max(0, int(round(face.left() / scale))),
+            max(0, int(round(face.top() / scale))),
+            min(width - 1, int(round(face.right() / scale))),
+            min(height - 1, int(round(face.bottom() / scale))),
+        )
+        for face in detector(small)
+    ]
+
+
+def retain_failed_frame(image_data, name, reason):
+    """
+    Keep a frame that failed recognition for debugging.
+
+    Disabled unless ``RECOGNITION_FAILED_FRAMES_DIR`` is set. The directory is
+    capped at ``RECOGNITION_FAILED_FRAMES_MAX_BYTES``; the oldest frames are
+    deleted first to stay under it.
+    """
+    directory = getattr(settings, "RECOGNITION_FAILED_FRAMES_DIR", None)
+    if not directory or not image_data:
+        return None
+    max_bytes = getattr(settings, "RECOGNITION_FAILED_FRAMES_MAX_BYTES", 50 * 1024 * 1024)
+    if len(image_data) > max_bytes:
+        return None
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        extension = os.path.splitext(name or "")[-1].lower() or ".jpg"
+        path = os.path.join(directory, f"{time.time_ns()}_{reason}{extension}")
+        with open(path, "wb") as f:
+            f.write(image_data)
+        _prune(directory, max_bytes)
+        return path
+    except OSError as e:
+        logger.warning(f"Could not retain failed frame: {e}")
+        return None
+
+
+def _prune(directory, max_bytes):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
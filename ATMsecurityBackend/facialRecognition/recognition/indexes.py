@@ -0,0 +1,242 @@
+"""
+Nearest-neighbour index backends for the face gallery.
+
+An index never owns the encodings: the gallery keeps the float32 matrix and
+tells the index which rows were added, replaced or removed. ``search`` returns
+candidate row numbers (or ``None`` for "every row") and the gallery re-ranks the
+candidates with exact distances, so approximate backends only ever trade recall
+for speed, never distance accuracy.
+
+The backend is chosen with the ``FACE_INDEX`` setting::
+
+    FACE_INDEX = {
+        "BACKEND": "recognition.indexes.IVFIndex",
+        "OPTIONS": {"n_lists": 1024, "n_probe": 16},
+    }
+"""
+import logging
+import math
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FACE_INDEX = {
+    "BACKEND": "recognition.indexes.BruteForceIndex",
+    "OPTIONS": {},
+}
+
+
+def squared_distances(matrix, sq_norms, query):
+    """Squared Euclidean distances from ``query`` to every row of ``matrix``."""
+    sq = sq_norms - 2.0 * (matrix @ query) + float(query @ query)
+    np.maximum(sq, 0.0, out=sq)
+    return sq
+
+
+class BaseIndex:
+    """Interface shared by every index backend."""
+
+    exact = False
+
+    def __init__(self, **options):
+        self.options = options
+
+    def build(self, matrix):
+        """Index every row of ``matrix`` (N x 128 float32)."""
+        raise NotImplementedError
+
+    def add(self, row, vector):
+        """Index ``vector`` under ``row``, replacing whatever was there."""
+        raise NotImplementedError
+
+    def remove(self, row):
+        """Forget ``row``."""
+        raise NotImplementedError
+
+    def search(self, query):
+        """Return candidate rows for ``query``, or ``None`` to scan every row."""
+        raise NotImplementedError
+
+
+class BruteForceIndex(BaseIndex):
+    """Exact search: every row is a candidate."""
+
+    exact = True
+
+    def build(self, matrix):
+        pass
+
+    def add(self, row, vector):
+        pass
+
+    def remove(self, row):
+        pass
+
+    def search(self, query):
+        return None
+
+
+class IVFIndex(BaseIndex):
+    """
+    Inverted-file index in pure NumPy.
+
+    Rows are partitioned by k-means into ``n_lists`` cells; a query only scans the
+    rows of its ``n_probe`` closest cells. Options:
+
+    - ``n_lists``: number of cells (default ``sqrt(N)``).
+    - ``n_probe``: cells scanned per query (default 8).
+    - ``train_size``: rows sampled for k-means (default 20000).
+    - ``iterations``: k-means iterations (default 10).
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.n_probe = int(options.get("n_probe", 8))
+        self.train_size = int(options.get("train_size", 20000))
+        self.iterations = int(options.get("iterations", 10))
+        self.centroids = None
+        self._centroid_norms = None
+        self.assignments = np.empty(0, dtype=np.int32)
+
+    def _n_lists(self, size):
+        n_lists = self.options.get("n_lists") or int(math.sqrt(size))
+        return max(1, min(int(n_lists), size))
+
+    def _nearest_centroid(self, matrix, chunk_size=65536):
+        labels = np.empty(len(matrix), dtype=np.int32)
+        for start in range(0, len(matrix), chunk_size):
+            block = matrix[start:start + chunk_size]
+            # ||x||^2 is constant per row, so it can be dropped from the argmin
+            scores = self._centroid_norms[None, :] - 2.0 * (block @ self.centroids.T)
+            labels[start:start + chunk_size] = np.argmin(scores, axis=1)
+        return labels
+
+    def _set_centroids(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._centroid_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+
+    def build(self, matrix):
+        size = len(matrix)
+        if size == 0:
+            self.centroids = None
+            self.assignments = np.empty(0, dtype=np.int32)
+            return
+
+        rng = np.random.default_rng(0)
+        n_lists = self._n_lists(size)
+        sample = matrix if size <= self.train_size else matrix[rng.choice(size, self.train_size, replace=False)]
+        self._set_centroids(sample[rng.choice(len(sample), n_lists, replace=False)])
+        for _ in range(self.iterations):
+            labels = self._nearest_centroid(sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            order = np.argsort(labels, kind="stable")
+            filled = counts > 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+            sums = np.zeros_like(self.centroids)
+            sums[filled] = np.add.reduceat(sample[order], starts, axis=0)
+            # Empty cells keep their previous centroid
+            centroids = self.centroids.copy()
+            centroids[filled] = sums[filled] / counts[filled, None]
+            self._set_centroids(centroids)
+
+        self.assignments = self._nearest_centroid(matrix)
+        logger.info(f"Built IVF face index with {n_lists} lists over {size} encodings")
+
+    def add(self, row, vector):
+        if self.centroids is None:
+            self._set_centroids(np.asarray(vector, dtype=np.float32)[None, :])
+        if row >= len(self.assignments):
+            grown = np.full(max(16, 2 * len(self.assignments), row + 1), -1, dtype=np.int32)
+            grown[:len(self.assignments)] = self.assignments
+            self.assignments = grown
+        self.assignments[row] = self._nearest_centroid(np.asarray(vector, dtype=np.float32)[None, :])[0]
+
+    def remove(self, row):
+        if row < len(self.assignments):
+            self.assignments[row] = -1
+
+    def search(self, query):
+        if self.centroids is None:
+            return np.empty(0, dtype=np.intp)
+        n_probe = min(self.n_probe, len(self.centroids))
+        scores = self._centroid_norms - 2.0 * (self.centroids @ query)
+        probe = np.argpartition(scores, n_probe - 1)[:n_probe]
+        # One extra, always-False slot so removed rows (assigned -1) never match
+        selected = np.zeros(len(self.centroids) + 1, dtype=bool)
+        selected[probe] = True
+        return np.flatnonzero(selected[self.assignments])
+
+
+class HNSWIndex(BaseIndex):
+    """
+    Hierarchical navigable small-world graph backed by the optional ``hnswlib``
+    package. Options: ``M`` (default 16), ``ef_construction`` (default 200),
+    ``ef`` (default 64) and ``k`` candidates returned per query (default 8).
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImproperlyConfigured("HNSWIndex requires the 'hnswlib' package.") from e
+        self._hnswlib = hnswlib
+        self.M = int(options.get("M", 16))
+        self.ef_construction = int(options.get("ef_construction", 200))
+        self.ef = int(options.get("ef", 64))
+        self.k = int(options.get("k", 8))
+        self._index = None
+        self._deleted = set()
+
+    def _new_index(self, capacity):
+        index = self._hnswlib.Index(space="l2", dim=128)
+        index.init_index(max_elements=max(capacity, 16), ef_construction=self.ef_construction, M=self.M)
+        index.set_ef(self.ef)
+        return index
+
+    def build(self, matrix):
+        self._index = self._new_index(len(matrix))
+        self._deleted = set()
+        if len(matrix):
+            self._index.add_items(matrix, np.arange(len(matrix)))
+
+    def add(self, row, vector):
+        if self._index is None:
+            self._index = self._new_index(16)
+        if self._index.get_current_count() >= self._index.get_max_elements():
+            self._index.resize_index(2 * self._index.get_max_elements())
+        if row in self._deleted:
+            self._index.unmark_deleted(row)
+            self._deleted.discard(row)
+        self._index.add_items(np.asarray(vector, dtype=np.float32)[None, :], [row])
+
+    def remove(self, row):
+        if self._index is not None and row not in self._deleted:
+            try:
+                self._index.mark_deleted(row)
+            except RuntimeError:
+                return  # never indexed
+            self._deleted.add(row)
+
+    def search(self, query):
+        if self._index is None:
+            return np.empty(0, dtype=np.intp)
+        live = self._index.get_current_count() - len(self._deleted)
+        if live <= 0:
+            return np.empty(0, dtype=np.intp)
+        labels, _ = self._index.knn_query(query[None, :], k=min(self.k, live))
+        return labels[0].astype(np.intp)
+
+
+def load_index(config=None):
+    """Instantiate the index backend configured in ``FACE_INDEX``."""
+    config = config or getattr(settings, "FACE_INDEX", DEFAULT_FACE_INDEX)
+    try:
+        backend = import_string(config["BACKEND"])
+    except (KeyError, ImportError) as e:
+        raise ImproperlyConfigured(f"Invalid FACE_INDEX backend: {e}") from e
+    return backend(**config.get("OPTIONS", {}))
@@ -0,0 +1,265 @@
+"""
+Process pool for face inference.
+
+Detection, landmarking and ResNet descriptor extraction are CPU bound and hold
+the GIL inside dlib, so running them in Django's request threads serializes a
+burst of ATM logins. Requests instead submit work to a fixed pool of worker
+processes. The number of queued plus running jobs is bounded: once the pool is
+saturated new work is rejected immediately with ``InferenceSaturated`` so the
+caller can answer 503 + Retry-After instead of piling up threads.
+
+Settings:
+
+- ``FACE_INFERENCE_WORKERS``: worker processes (0 runs inline in the caller).
+- ``FACE_INFERENCE_QUEUE_SIZE``: jobs allowed in flight across the pool.
+- ``FACE_INFERENCE_TIMEOUT``: seconds a caller waits for its result.
+
+Workers time the decode, detect, landmark and descriptor phases into
+``recognition_phase_seconds``; jobs in flight are reported as a gauge.
+"""
+import io
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from facialRecognition.metrics import Gauge
+
+from .descriptors import cached_descriptor
+from .engine import engine
+from .imaging import decode_image, detect_faces
+from .metrics import RECOGNITION_PHASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+RETRY_AFTER = 1
+
+
+class InferenceUnavailable(Exception):
+    """The face inference pool cannot take or finish this job right now."""
+
+    retry_after = RETRY_AFTER
+
+
+class InferenceSaturated(InferenceUnavailable):
+    pass
+
+
+class InferenceTimeout(InferenceUnavailable):
+    pass
+
+
+# ======================== WORKER FUNCTIONS ========================
+def describe_probe(image_data):
+    """
+    Decode an ATM frame and compute the descriptor of the first face in it.
+    Returns ``(error, encoding)`` where ``error`` is ``None`` on success.
+    """
+    with RECOGNITION_PHASE_SECONDS.time(phase="decode"):
+        image = decode_image(image_data)
+    if image is None:
+        return "undecodable", None
+    # Retried requests resend identical frames
+    return cached_descriptor("probe", image, _describe_image)
+
+
+def _describe_image(image):
+    with RECOGNITION_PHASE_SECONDS.time(phase="detect"):
+        # Convert to grayscale for better detection; detect on a downscaled copy
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        faces = detect_faces(engine.face_detector, gray)
+    if not faces:
+        return "no_face", None
+
+    with RECOGNITION_PHASE_SECONDS.time(phase="landmark"):
+        face_shape = engine.shape_predictor(gray, faces[0])
+    with RECOGNITION_PHASE_SECONDS.time(phase="descriptor"):
+        face_encoding = np.array(engine.face_rec_model.compute_face_descriptor(image, face_shape))
+    if face_encoding.shape[0] != 128:
+        return "no_encoding", None
+    return None, face_encoding
+
+
+def describe_stream_frame(image_data, face=None):
+    """
+    ``describe_probe`` for a video stream. ``face`` is the rectangle
+    ``(left, top, right, bottom)`` the consumer's tracker followed the face to
+    (see ``recognition.tracking``); when given, detection is skipped and only
+    landmarks and the descriptor are computed. Returns
+    ``(error, encoding, rectangle)``.
+    """
+    import dlib
+
+    with RECOGNITION_PHASE_SECONDS.time(phase="decode"):
+        image = decode_image(image_data)
+    if image is None:
+        return "undecodable", None, None
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if face is not None:
+        faces = [dlib.rectangle(*face)]
+    else:
+        with RECOGNITION_PHASE_SECONDS.time(phase="detect"):
+            faces = detect_faces(engine.face_detector, gray)
+    if not faces:
+        return "no_face", None, None
+
+    face = faces[0]
+    with RECOGNITION_PHASE_SECONDS.time(phase="landmark"):
+        face_shape = engine.shape_predictor(gray, face)
+    with RECOGNITION_PHASE_SECONDS.time(phase="descriptor"):
+        face_encoding = np.array(engine.face_rec_model.compute_face_descriptor(image, face_shape))
+    if face_encoding.shape[0] != 128:
+        return "no_encoding", None, None
+    return None, face_encoding, (face.left(), face.top(), face.right(), face.bottom())
+
+
+def describe_enrolment(image_data):
+    """
+    Compute the descriptor of an enrolment photo, which must contain exactly one face.
+    Returns ``(error, encoding)`` with a user-facing error message on failure.
+    """
+    img_array = np.array(Image.open(io.BytesIO(image_data)).convert("RGB"))
+    return cached_descriptor("enrolment", img_array, _describe_enrolment_image)
+
+
+def _describe_enrolment_image(img_array):
+    detections = engine.face_detector(img_array)
+
+    if len(detections) == 0:
+        return "No face detected in the image.", None
+    elif len(detections) > 1:
+        return "Multiple faces detected. Please upload a clear image with one face.", None
+
+    shape = engine.shape_predictor(img_array, detections[0])
+    return None, np.array(engine.face_rec_model.compute_face_descriptor(img_array, shape))
+
+
+def _init_worker():
+    # Forked workers inherit a configured Django (and preloaded models);
+    # spawned ones have to set it up themselves.
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+# ======================== SERVICE ========================
+class FaceInferenceService:
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.queue_size = max(queue_size, workers, 1)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self.in_flight = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        # Outside the lock: cancelling the queued jobs runs their _release callbacks
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _future=None):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args, wait=0):
+        """
+        Queue ``fn(*args)`` in the pool and return its future.
+
+        If the pool is saturated, wait up to ``wait`` seconds for a free slot
+        before raising ``InferenceSaturated``.
+        """
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        acquired = self._slots.acquire(timeout=wait) if wait else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise InferenceSaturated("Face inference pool is saturated")
+        with self._lock:
+            self.in_flight += 1
+
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            self._release()
+            self._reset_executor()
+            raise InferenceUnavailable("Face inference pool restarted")
+        except Exception:
+            self._release()
+            raise
+        # The slot is only freed once the worker is done, even if the caller gave up
+        future.add_done_callback(self._release)
+        return future
+
+    def result(self, future, timeout=None):
+        """
+        Wait for a submitted job. Raises ``InferenceTimeout`` if it does not
+        finish within ``timeout`` (default ``FACE_INFERENCE_TIMEOUT``) seconds.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeout:
+            future.cancel()
+            raise InferenceTimeout(f"Face inference did not finish within {timeout}s")
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise InferenceUnavailable("Face inference worker crashed")
+
+    def run(self, fn, *args, wait=0):
+        """Run ``fn(*args)`` in the pool and return its result."""
+        return self.result(self.submit(fn, *args, wait=wait))
+
+    def close(self):
+        """Stop the worker processes; the pool restarts on the next submit."""
+        self._reset_executor()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_inference_service():
+    """Return this process's inference pool, created on first use."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = FaceInferenceService(
+                    workers=getattr(settings, "FACE_INFERENCE_WORKERS", 2),
+                    queue_size=getattr(settings, "FACE_INFERENCE_QUEUE_SIZE", 8),
+                    timeout=getattr(settings, "FACE_INFERENCE_TIMEOUT", 10),
+                )
+    return _service
+
+
+INFERENCE_IN_FLIGHT = Gauge(
+    "face_inference_in_flight", "Face inference jobs queued or running in the pool.",
+    lambda: _service.in_flight if _service is not None else 0,
+)
+INFERENCE_CAPACITY = Gauge(
+    "face_inference_capacity", "Face inference jobs the pool admits before answering 503.",
+    lambda: _service.queue_size if _service is not None and _service.workers else 0,
+)
@@ -0,0 +1,78 @@
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from recognition.engine import engine
+from recognition.imaging import DETECTION_MAX_SIDE, detect_faces
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare full-resolution face detection with detection on a downscaled copy: "
+        "reports detection latency for both and how far the resulting descriptors drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("images", nargs="+", help="Image files to benchmark with.")
+        parser.add_argument("--max-side", type=int, default=DETECTION_MAX_SIDE,
+                            help="Longest side of the downscaled detection image.")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per image and mode.")
+        parser.add_argument("--tolerance", type=float, default=0.06,
+                            help="Largest acceptable descriptor distance between the two modes.")
+
+    def handle(self, *args, **options):
+        full_times, small_times, drifts = [], [], []
+        for path in options["images"]:
+            image = cv2.imread(path)
+            if image is None:
+                self.stderr.write(f"Skipping unreadable image {path}")
+                continue
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+            full_faces, full_time = self.time_detection(gray, 0, options["repeat"])
+            small_faces, small_time = self.time_detection(gray, options["max_side"], options["repeat"])
+            full_times.append(full_time)
+            small_times.append(small_time)
+
+            if not full_faces or not small_faces:
+                self.stdout.write(
+                    f"{path}: {len(full_faces)} face(s) at full resolution, "
+                    f"{len(small_faces)} downscaled"
+                )
+                continue
+
+            drift = np.linalg.norm(self.descriptor(image, gray, full_faces[0]) - self.descriptor(image, gray, small_faces[0]))
+            drifts.append(drift)
+            self.stdout.write(
+                f"{path} ({image.shape[1]}x{image.shape[0]}): detect {1000 * full_time:.1f} ms -> "
+                f"{1000 * small_time:.1f} ms, descriptor drift {drift:.4f}"
+            )
+
+        if not full_times:
+            raise CommandError("No readable images.")
+
+        full_mean, small_mean = np.mean(full_times), np.mean(small_times)
+        self.stdout.write(
+            f"Mean detection latency: {1000 * full_mean:.1f} ms full resolution, "
+            f"{1000 * small_mean:.1f} ms at max side {options['max_side']} "
+            f"({full_mean / small_mean:.1f}x faster)"
+        )
+        if drifts:
+            worst = max(drifts)
+            message = f"Max descriptor drift {worst:.4f} (tolerance {options['tolerance']})"
+            if worst > options["tolerance"]:
+                raise CommandError(message)
+            self.stdout.write(self.style.SUCCESS(message))
+
+    def time_detection(self, gray, max_side, repeat):
+        faces = detect_faces(engine.face_detector, gray, max_side=max_side)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            detect_faces(engine.face_detector, gray, max_side=max_side)
+        return faces, (time.perf_counter() - started) / repeat
+
+    def descriptor(self, image, gray, face):
+        shape = engine.shape_predictor(gray, face)
+        return np.array(engine.face_rec_model.compute_face_descriptor(image, shape))
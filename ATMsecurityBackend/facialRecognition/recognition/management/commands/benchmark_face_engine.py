@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so each mode starts from a cold process
+PROBE = """
+import json, resource, time
+started = time.perf_counter()
+import django
+django.setup()
+import recognition.views
+from recognition.engine import engine
+ready = time.perf_counter() - started
+rss_ready = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if {preload}:
+    engine.load()
+startup = time.perf_counter() - started
+rss_startup = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+first_use = time.perf_counter()
+engine.load()
+first_use = time.perf_counter() - first_use
+print(json.dumps({{
+    "import": ready, "startup": startup, "first_use": first_use,
+    "rss_import_kb": rss_ready, "rss_startup_kb": rss_startup,
+    "rss_loaded_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Measure process startup time and peak RSS with lazy and preloaded dlib face models."
+
+    def handle(self, *args, **options):
+        for mode, preload in [("lazy", False), ("preload", True)]:
+            result = subprocess.run(
+                [sys.executable, "-c", PROBE.format(preload=preload)],
+                capture_output=True, text=True, env=os.environ.copy(),
+            )
+            if result.returncode != 0:
+                raise CommandError(f"{mode} probe failed:\n{result.stderr}")
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            self.stdout.write(
+                f"{mode:>8}: startup {stats['startup']:.2f}s "
+                f"(Django + recognition import {stats['import']:.2f}s), "
+                f"peak RSS at startup {stats['rss_startup_kb'] / 1024:.1f} MB, "
+                f"first face request pays {stats['first_use']:.2f}s, "
+                f"peak RSS with models {stats['rss_loaded_kb'] / 1024:.1f} MB"
+            )
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recognition.snapshot import SnapshotError, export_gallery, read_snapshot, snapshot_dir
+
+
+class Command(BaseCommand):
+    help = (
+        "Export every enrolled face encoding to a memory-mapped gallery snapshot that "
+        "recognition workers map at startup instead of reading the users table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default=None,
+                            help="Snapshot directory (defaults to FACE_GALLERY_SNAPSHOT_DIR).")
+        parser.add_argument("--verify", action="store_true",
+                            help="Only check the checksums of the snapshot already there, e.g. after a deploy.")
+
+    def handle(self, *args, **options):
+        directory = options["dir"] or snapshot_dir()
+        if not directory:
+            raise CommandError("Set FACE_GALLERY_SNAPSHOT_DIR or pass --dir.")
+
+        if options["verify"]:
+            try:
+                snapshot = read_snapshot(directory, verify=True)
+            except SnapshotError as e:
+                raise CommandError(f"Snapshot failed verification: {e}")
+            self.stdout.write(self.style.SUCCESS(
+                f"Snapshot of {len(snapshot.ids)} encodings at gallery version {snapshot.version} is intact"
+            ))
+            return
+
+        started = time.perf_counter()
+        manifest = export_gallery(directory)
+        elapsed = time.perf_counter() - started
+
+        try:
+            # Read it back exactly as a worker would, checksums included
+            read_snapshot(directory, verify=True)
+        except SnapshotError as e:
+            raise CommandError(f"Snapshot failed verification: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {manifest['count']} encodings at gallery version {manifest['version']} "
+            f"to {directory} in {elapsed:.2f}s"
+        ))
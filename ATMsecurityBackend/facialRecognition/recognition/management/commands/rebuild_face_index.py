@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from recognition.gallery import MATCH_THRESHOLD, FaceGallery, publish_rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the face gallery index configured in FACE_INDEX, report its recall "
+        "against an exact scan and tell running workers to rebuild theirs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sample", type=int, default=1000,
+                            help="Number of probe queries used to measure recall (0 to skip).")
+        parser.add_argument("--noise", type=float, default=0.03,
+                            help="Per-dimension Gaussian noise added to enrolled encodings to make probes.")
+        parser.add_argument("--threshold", type=float, default=MATCH_THRESHOLD,
+                            help="Distance threshold to evaluate decisions at.")
+        parser.add_argument("--no-publish", action="store_true",
+                            help="Only measure; do not ask workers to rebuild.")
+
+    def handle(self, *args, **options):
+        gallery = FaceGallery()
+        started = time.perf_counter()
+        gallery.load()
+        self.stdout.write(
+            f"Built {type(gallery.index).__name__} over {len(gallery)} encodings "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+
+        if options["sample"] and len(gallery):
+            self.report_recall(gallery, options["sample"], options["noise"], options["threshold"])
+
+        if not options["no_publish"]:
+            version = publish_rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Workers will rebuild at gallery version {version}"))
+
+    def report_recall(self, gallery, sample, noise, threshold):
+        rng = np.random.default_rng()
+        rows = rng.integers(0, len(gallery), size=sample)
+        queries = gallery.matrix[rows] + rng.normal(0.0, noise, size=(sample, gallery.matrix.shape[1])).astype(np.float32)
+
+        exact_time = approx_time = 0.0
+        hits = agreements = false_rejects = 0
+        exact_distances = np.empty(sample)
+        for i, query in enumerate(queries):
+            started = time.perf_counter()
+            exact_row, exact_distance = gallery.nearest(query, exact=True)
+            exact_time += time.perf_counter() - started
+
+            started = time.perf_counter()
+            row, distance = gallery.nearest(query)
+            approx_time += time.perf_counter() - started
+
+            exact_distances[i] = exact_distance
+            hits += row == exact_row
+            exact_accept = exact_distance < threshold
+            accept = row == exact_row and distance < threshold
+            agreements += exact_accept == accept
+            false_rejects += exact_accept and not accept
+
+        self.stdout.write(f"Recall@1 vs exact scan: {hits / sample:.4f} over {sample} probes")
+        self.stdout.write(
+            f"Decision agreement at threshold {threshold}: {agreements / sample:.4f} "
+            f"({false_rejects} accepts lost to the index)"
+        )
+        p50, p95, p99 = np.percentile(exact_distances, [50, 95, 99])
+        self.stdout.write(f"Exact best-match distance p50={p50:.3f} p95={p95:.3f} p99={p99:.3f}")
+        self.stdout.write(
+            f"Mean latency: exact {1000 * exact_time / sample:.3f} ms, "
+            f"index {1000 * approx_time / sample:.3f} ms"
+        )
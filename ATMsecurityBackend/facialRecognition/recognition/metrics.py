@@ -0,0 +1,10 @@
+from facialRecognition.metrics import Histogram
+
+PHASES = ("decode", "detect", "track", "landmark", "descriptor", "match", "db")
+
+RECOGNITION_PHASE_SECONDS = Histogram(
+    "recognition_phase_seconds",
+    "Time spent in each phase of recognizing a face: decoding, detection, landmarks and descriptor in the "
+    "inference pool, face tracking in streams, gallery matching and user lookups.",
+    labels={"phase": PHASES},
+)
@@ -1,3 +1,7 @@
 from django.db import models
+from django.dispatch import Signal
 
 # Create your models here.
+
+# Sent with ``user_id`` and ``confidence`` (1 - distance) when a probe is matched to a user
+face_recognized = Signal()
@@ -0,0 +1,29 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from userManager.models import CustomUser, face_encoding_updated
+from .gallery import face_changed
+
+# Fields that decide whether a user belongs in the recognition gallery
+GALLERY_FIELDS = {"face_encoding", "is_active"}
+
+
+@receiver(post_save, sender=CustomUser)
+def refresh_gallery_on_save(sender, instance, created, update_fields=None, **kwargs):
+    """Refresh the user's gallery row on enrolment, re-enrolment or deactivation."""
+    if update_fields is not None and not GALLERY_FIELDS & set(update_fields):
+        return  # e.g. last_login updates
+    if created and instance.face_encoding is None:
+        return  # A brand-new user without a face cannot be in the gallery yet
+    face_changed(instance.pk)
+
+
+@receiver(face_encoding_updated, sender=CustomUser)
+def refresh_gallery_on_encoding(sender, instance, **kwargs):
+    """Catch encodings written with QuerySet.update()."""
+    face_changed(instance.pk)
+
+
+@receiver(post_delete, sender=CustomUser)
+def refresh_gallery_on_delete(sender, instance, **kwargs):
+    """Drop deleted users from the gallery."""
+    face_changed(instance.pk)
@@ -0,0 +1,218 @@
+"""
+Memory-mapped snapshots of the face gallery.
+
+``python manage.py export_face_gallery`` writes every enrolled encoding to
+``FACE_GALLERY_SNAPSHOT_DIR``:
+
+- ``gallery-<version>.npy``: the N x 128 float32 encoding matrix,
+- ``gallery-<version>.norms.npy``: squared norms of its rows,
+- ``gallery-<version>.ids.npy``: user ids, as sorted fixed-width strings, in
+  row order,
+- ``manifest.json``: the gallery version the export started at, the row count,
+  the encoding model, and the size, modification time and SHA-256 checksum of
+  each file.
+
+Workers map all three arrays read-only, so every process on the host shares
+one page-cache copy. Changes published after the snapshot version are
+replayed on top by ``FaceGallery.load``.
+
+The export reads the files back and checks their checksums; workers only
+compare sizes and modification times, so a restart does not read the whole
+snapshot. Copy snapshots between hosts with their timestamps (``rsync -a``)
+and check them with ``export_face_gallery --verify``.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+
+from userManager.fields import MODEL_DLIB_RESNET_V1
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+PREFIX = "gallery-"
+ENCODING_SIZE = 128
+
+
+class SnapshotError(Exception):
+    """The snapshot on disk is missing, stale, from another model or corrupt."""
+
+
+@dataclass
+class Snapshot:
+    version: int
+    exported_at: float
+    ids: np.ndarray
+    matrix: np.ndarray
+    sq_norms: np.ndarray
+
+
+def snapshot_dir():
+    return getattr(settings, "FACE_GALLERY_SNAPSHOT_DIR", None)
+
+
+def _checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _save_atomic(directory, name, array):
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(temp, os.path.join(directory, name))
+
+
+def write_snapshot(directory, version, rows):
+    """
+    Write ``rows`` (an iterable of ``(user_id, vector)``) as the snapshot for
+    gallery ``version`` and atomically replace the manifest. Files of older
+    snapshots are removed; processes still mapping them keep their pages.
+    """
+    os.makedirs(directory, exist_ok=True)
+    exported_at = time.time()
+    ids = []
+    # Spool rows to a raw file first: the row count is only known at the end
+    with tempfile.TemporaryFile(dir=directory) as spool:
+        for user_id, vector in rows:
+            ids.append(str(user_id))
+            spool.write(np.asarray(vector, dtype="<f4").tobytes())
+        spool.flush()
+        count = len(ids)
+        width = max((len(user_id) for user_id in ids), default=1)
+        ids = np.array(ids, dtype=f"<U{width}")
+        # Rows are written in id order, so a worker finds a user's row by binary search
+        order = np.argsort(ids)
+        if count:
+            raw = np.memmap(spool, dtype="<f4", mode="r", shape=(count, ENCODING_SIZE))
+        else:
+            raw = np.empty((0, ENCODING_SIZE), dtype="<f4")
+
+        files = {
+            "matrix": f"{PREFIX}{version}.npy",
+            "norms": f"{PREFIX}{version}.norms.npy",
+            "ids": f"{PREFIX}{version}.ids.npy",
+        }
+        norms = np.empty(count, dtype="<f4")
+        if count:
+            fd, temp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            os.close(fd)
+            matrix = np.lib.format.open_memmap(temp, mode="w+", dtype="<f4", shape=(count, ENCODING_SIZE))
+            for start in range(0, count, 65536):
+                block = raw[order[start:start + 65536]]
+                matrix[start:start + len(block)] = block
+                norms[start:start + len(block)] = np.einsum("ij,ij->i", block, block)
+            matrix.flush()
+            del matrix, raw
+            os.replace(temp, os.path.join(directory, files["matrix"]))
+        else:
+            _save_atomic(directory, files["matrix"], raw)
+
+    _save_atomic(directory, files["norms"], norms)
+    _save_atomic(directory, files["ids"], ids[order])
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "model": MODEL_DLIB_RESNET_V1,
+        "version": version,
+        "exported_at": exported_at,
+        "count": count,
+        "files": files,
+        "stat": {key: _stat(os.path.join(directory, name)) for key, name in files.items()},
+        "sha256": {key: _checksum(os.path.join(directory, name)) for key, name in files.items()},
+    }
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp, os.path.join(directory, MANIFEST))
+
+    current = set(files.values())
+    for name in os.listdir(directory):
+        if name.startswith(PREFIX) and name not in current:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError as e:
+                logger.warning(f"Could not remove old gallery snapshot file {name}: {e}")
+    return manifest
+
+
+def export_gallery(directory=None):
+    """Snapshot every enrolled encoding in the database at the current gallery version."""
+    from .gallery import FaceGallery, current_version
+
+    directory = directory or snapshot_dir()
+    # Read the version before scanning so changes committed during the export are replayed on load
+    version = current_version()
+    return write_snapshot(directory, version, FaceGallery.scan_database())
+
+
+def read_snapshot(directory=None, verify=None):
+    """
+    Map the current snapshot into memory. Raises ``SnapshotError`` if it cannot
+    be used. File sizes and modification times are always checked against the
+    manifest; ``verify`` also compares the checksums, which reads every file.
+    """
+    directory = directory or snapshot_dir()
+    if verify is None:
+        verify = getattr(settings, "FACE_GALLERY_SNAPSHOT_VERIFY", False)
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise SnapshotError(f"No gallery snapshot in {directory}")
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Unreadable gallery snapshot manifest: {e}")
+
+    if manifest.get("format") != FORMAT_VERSION or manifest.get("model") != MODEL_DLIB_RESNET_V1:
+        raise SnapshotError("Gallery snapshot was written in another format or by another model")
+
+    try:
+        paths = {key: os.path.join(directory, manifest["files"][key]) for key in ("matrix", "norms", "ids")}
+        count = int(manifest["count"])
+        version = int(manifest["version"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise SnapshotError(f"Incomplete gallery snapshot manifest: {e}")
+    for key, path in paths.items():
+        try:
+            stat = _stat(path)
+        except OSError as e:
+            raise SnapshotError(f"Missing gallery snapshot file: {e}")
+        if stat != manifest.get("stat", {}).get(key):
+            raise SnapshotError(f"Gallery snapshot file {path} changed since it was exported")
+        if verify and _checksum(path) != manifest.get("sha256", {}).get(key):
+            raise SnapshotError(f"Checksum mismatch in gallery snapshot file {path}")
+
+    # np.memmap cannot map a zero-length array
+    mmap_mode = "r" if count else None
+    try:
+        matrix = np.load(paths["matrix"], mmap_mode=mmap_mode, allow_pickle=False)
+        sq_norms = np.load(paths["norms"], mmap_mode=mmap_mode, allow_pickle=False)
+        ids = np.load(paths["ids"], mmap_mode=mmap_mode, allow_pickle=False)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Unreadable gallery snapshot: {e}")
+
+    if matrix.shape != (count, ENCODING_SIZE) or sq_norms.shape != (count,) or ids.shape != (count,):
+        raise SnapshotError("Gallery snapshot files do not match the manifest")
+    return Snapshot(
+        version=version,
+        exported_at=manifest.get("exported_at"),
+        ids=ids,
+        matrix=matrix,
+        sq_norms=sq_norms,
+    )
@@ -1,3 +1,731 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import threading
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import dlib
+import numpy as np
+from django.core.cache import cache, caches
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from userManager.models import CustomUser
+from . import consumers, descriptors, gallery as gallery_module, imaging, inference, tracking, views
+from .gallery import CHANGE_KEY, ENCODING_SIZE, VERSION_KEY, FaceGallery, publish_change, publish_rebuild
+from .inference import FaceInferenceService
+from .snapshot import SnapshotError, export_gallery, read_snapshot
+from .views import vote
+
+
+def unit_vectors(count, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, ENCODING_SIZE)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def at_distance(vector, distance, seed=1):
+    """A probe exactly ``distance`` away from ``vector``."""
+    direction = np.random.default_rng(seed).normal(size=ENCODING_SIZE).astype(np.float32)
+    return vector + distance * direction / np.linalg.norm(direction)
+
+
+def enrol(number, encoding, **fields):
+    return CustomUser.objects.create(
+        username=f"face{number}", email=f"face{number}@example.com", face_encoding=encoding, **fields
+    )
+
+
+class FaceGalleryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.vectors = unit_vectors(5)
+        self.users = [enrol(i, vector) for i, vector in enumerate(self.vectors)]
+        self.gallery = FaceGallery()
+        self.gallery.load()
+
+    def test_probe_matches_the_closest_user(self):
+        for user, vector in zip(self.users, self.vectors):
+            user_id, distance = self.gallery.match(at_distance(vector, 0.1))
+            self.assertEqual(user_id, user.id)
+            self.assertAlmostEqual(distance, 0.1, places=4)
+
+    def test_match_requires_a_distance_below_the_threshold(self):
+        user_id, distance = self.gallery.match(at_distance(self.vectors[0], 0.45))
+        self.assertEqual(user_id, self.users[0].id)
+
+        user_id, distance = self.gallery.match(at_distance(self.vectors[0], 0.55))
+        self.assertIsNone(user_id)
+        self.assertAlmostEqual(distance, 0.55, places=4)
+
+        user_id, _ = self.gallery.match(at_distance(self.vectors[0], 0.3), threshold=0.25)
+        self.assertIsNone(user_id)
+
+    def test_match_many_agrees_with_match(self):
+        distances = [0.1, 0.6, 0.2, 0.49, 0.51]
+        probes = [at_distance(vector, d, seed=i) for i, (vector, d) in enumerate(zip(self.vectors, distances))]
+        self.assertEqual(
+            [user_id for user_id, _ in self.gallery.match_many(probes)],
+            [user_id for user_id, _ in (self.gallery.match(probe) for probe in probes)],
+        )
+        self.assertEqual(
+            [user_id for user_id, _ in self.gallery.match_many(probes)],
+            [self.users[0].id, None, self.users[2].id, self.users[3].id, None],
+        )
+
+    def test_empty_gallery_matches_nothing(self):
+        CustomUser.objects.update(face_encoding=None)
+        gallery = FaceGallery()
+        gallery.load()
+        self.assertEqual(len(gallery), 0)
+        self.assertEqual(gallery.match(self.vectors[0]), (None, float("inf")))
+        self.assertEqual(gallery.match_many([self.vectors[0]]), [(None, float("inf"))])
+
+    def test_inactive_users_are_not_loaded(self):
+        CustomUser.objects.filter(pk=self.users[1].pk).update(is_active=False)
+        gallery = FaceGallery()
+        gallery.load()
+        self.assertEqual(len(gallery), 4)
+        self.assertNotIn(self.users[1].id, set(gallery.user_ids))
+        self.assertIsNone(gallery.match(self.vectors[1])[0])
+
+    def test_rows_stay_mapped_to_their_users_through_churn(self):
+        newcomer = uuid.uuid4()
+        base = self.gallery.matrix.copy()
+        self.gallery.remove(self.users[1].id)
+        self.gallery.upsert(self.users[2].id, at_distance(self.vectors[2], 0.3))
+        self.gallery.upsert(newcomer, self.vectors[1])
+        # The last tail row (the newcomer) moves into the re-enrolled user's slot
+        self.gallery.remove(self.users[2].id)
+        self.assertEqual(len(self.gallery), 4)
+
+        expected = {self.users[i].id: self.vectors[i] for i in (0, 3, 4)}
+        expected[newcomer] = self.vectors[1]
+        user_ids = list(self.gallery.user_ids)
+        self.assertEqual({user_id for user_id in user_ids if user_id is not None}, set(expected))
+        for user_id, vector in expected.items():
+            self.assertEqual(self.gallery.match(vector)[0], user_id)
+            np.testing.assert_allclose(self.gallery.matrix[user_ids.index(user_id)], vector, atol=1e-6)
+        self.assertIsNone(self.gallery.match(self.vectors[2])[0])
+        # Removed and re-enrolled base users were only marked dead
+        np.testing.assert_array_equal(self.gallery.matrix[:len(base)], base)
+
+
+class GalleryReplayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.vectors = unit_vectors(4)
+        self.users = [enrol(i, vector) for i, vector in enumerate(self.vectors[:3])]
+        # Two processes' galleries
+        self.here, self.there = FaceGallery(), FaceGallery()
+        self.here.load()
+        self.there.load()
+
+    def test_enrolment_is_replayed_in_other_processes(self):
+        user = enrol(3, self.vectors[3])
+        publish_change(user.pk)
+        self.there.sync()
+        self.assertEqual(self.there.match(self.vectors[3])[0], user.id)
+        self.assertEqual(self.there.version, cache.get(VERSION_KEY))
+
+    def test_re_enrolment_and_removal_are_replayed(self):
+        CustomUser.objects.filter(pk=self.users[0].pk).update(face_encoding=self.vectors[3])
+        CustomUser.objects.filter(pk=self.users[1].pk).update(is_active=False)
+        publish_change(self.users[0].pk)
+        publish_change(self.users[1].pk)
+        with mock.patch.object(self.there, "load") as load:
+            self.there.sync()
+        load.assert_not_called()
+        self.assertEqual(len(self.there), 2)
+        self.assertEqual(self.there.match(self.vectors[3])[0], self.users[0].id)
+        self.assertIsNone(self.there.match(self.vectors[0])[0])
+        self.assertIsNone(self.there.match(self.vectors[1])[0])
+
+    def test_change_is_written_before_the_version_moves(self):
+        version = publish_change(self.users[0].pk)
+        self.assertEqual(cache.get(VERSION_KEY), version)
+        self.assertEqual(cache.get(CHANGE_KEY.format(version)), str(self.users[0].pk))
+
+    def test_slot_claimed_by_a_dead_publisher_is_skipped(self):
+        before = cache.get(VERSION_KEY)
+        cache.add(CHANGE_KEY.format(before + 1), str(self.users[1].pk))
+        with mock.patch.object(gallery_module, "CLAIM_TIMEOUT", 0.01):
+            version = publish_change(self.users[0].pk)
+        self.assertEqual(version, before + 2)
+        self.assertEqual(cache.get(CHANGE_KEY.format(version)), str(self.users[0].pk))
+
+    def test_expired_change_forces_a_rebuild(self):
+        CustomUser.objects.filter(pk=self.users[2].pk).update(face_encoding=self.vectors[3])
+        lost = publish_change(self.users[2].pk)
+        publish_change(self.users[0].pk)
+        cache.delete(CHANGE_KEY.format(lost))
+        with mock.patch.object(self.there, "load", wraps=self.there.load) as load:
+            self.there.sync()
+        load.assert_called_once()
+        self.assertEqual(self.there.match(self.vectors[3])[0], self.users[2].id)
+
+    def test_requested_rebuild_reloads_everything(self):
+        publish_rebuild()
+        with mock.patch.object(self.there, "load", wraps=self.there.load) as load:
+            self.there.sync()
+        load.assert_called_once()
+        self.assertEqual(self.there.version, cache.get(VERSION_KEY))
+
+
+
+class GallerySnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.vectors = unit_vectors(6, seed=3)
+        self.users = [enrol(i, vector) for i, vector in enumerate(self.vectors[:4])]
+        self.manifest = export_gallery(self.directory)
+
+    def load(self, **settings):
+        with override_settings(FACE_GALLERY_SNAPSHOT_DIR=self.directory, **settings):
+            gallery = FaceGallery()
+            gallery.load()
+        return gallery
+
+    def test_export_and_load_round_trip(self):
+        snapshot = read_snapshot(self.directory)
+        self.assertEqual(snapshot.version, self.manifest["version"])
+        self.assertIsInstance(snapshot.ids, np.memmap)
+        self.assertEqual(snapshot.ids.tolist(), sorted(str(user.pk) for user in self.users))
+
+        with mock.patch.object(FaceGallery, "scan_database") as scan:
+            gallery = self.load()
+        scan.assert_not_called()
+        self.assertEqual(len(gallery), 4)
+        user_ids = list(gallery.user_ids)
+        for user, vector in zip(self.users, self.vectors):
+            self.assertEqual(gallery.match(vector)[0], user.id)
+            np.testing.assert_allclose(gallery.matrix[user_ids.index(user.id)], vector, atol=1e-6)
+
+    def test_changes_after_the_snapshot_are_replayed(self):
+        newcomer = enrol(4, self.vectors[4])
+        publish_change(newcomer.pk)
+        CustomUser.objects.filter(pk=self.users[0].pk).update(face_encoding=self.vectors[5])
+        publish_change(self.users[0].pk)
+        CustomUser.objects.filter(pk=self.users[1].pk).update(is_active=False)
+        publish_change(self.users[1].pk)
+
+        with mock.patch.object(FaceGallery, "scan_database") as scan:
+            gallery = self.load()
+        scan.assert_not_called()
+        self.assertEqual(gallery.version, cache.get(VERSION_KEY))
+        self.assertEqual(len(gallery), 4)
+        self.assertEqual(gallery.match(self.vectors[4])[0], newcomer.id)
+        self.assertEqual(gallery.match(self.vectors[5])[0], self.users[0].id)
+        self.assertEqual(gallery.match(self.vectors[2])[0], self.users[2].id)
+        self.assertIsNone(gallery.match(self.vectors[0])[0])
+        self.assertIsNone(gallery.match(self.vectors[1])[0])
+        # Replaying never wrote to the read-only mapping
+        self.assertFalse(gallery._base.flags.writeable)
+
+    def test_expired_changes_fall_back_to_the_database(self):
+        newcomer = enrol(4, self.vectors[4])
+        cache.delete(CHANGE_KEY.format(publish_change(newcomer.pk)))
+        with self.assertLogs("recognition.gallery", "WARNING"):
+            gallery = self.load()
+        self.assertEqual(len(gallery), 5)
+        self.assertEqual(gallery.match(self.vectors[4])[0], newcomer.id)
+
+    def test_changed_files_are_refused(self):
+        path = os.path.join(self.directory, self.manifest["files"]["norms"])
+        stat = os.stat(path)
+        with open(path, "r+b") as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b"\0\0\0\0")
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        # Same size and timestamp: only the checksums notice
+        read_snapshot(self.directory)
+        with self.assertRaises(SnapshotError):
+            read_snapshot(self.directory, verify=True)
+        with self.assertRaises(CommandError):
+            call_command("export_face_gallery", dir=self.directory, verify=True, stdout=StringIO())
+
+        with open(path, "ab") as f:
+            f.write(b"\0")
+        with self.assertRaises(SnapshotError):
+            read_snapshot(self.directory)
+        with self.assertLogs("recognition.gallery", "WARNING"):
+            gallery = self.load()
+        self.assertEqual(gallery.match(self.vectors[3])[0], self.users[3].id)
+
+
+class IndexConsistencyMixin:
+    """Index backends must stay in step with the gallery through upserts and removals."""
+
+    # FACE_INDEX under which search covers every row, so results must equal the exact scan
+    exhaustive = None
+    # FACE_INDEX under which search only returns some candidates
+    approximate = None
+
+    def setUp(self):
+        cache.clear()
+        self.vectors = unit_vectors(300, seed=7)
+        users = CustomUser.objects.bulk_create([
+            CustomUser(username=f"index{i}", email=f"index{i}@example.com", face_encoding=vector)
+            for i, vector in enumerate(self.vectors[:200])
+        ])
+        self.ids = [user.pk for user in users]
+
+    def gallery(self, config):
+        with override_settings(FACE_INDEX=config):
+            gallery = FaceGallery()
+            gallery.load()
+        return gallery
+
+    def churn(self, gallery):
+        """Re-enrol, add and remove users the way replayed changes do."""
+        for i in range(0, 40, 2):
+            gallery.upsert(self.ids[i], self.vectors[200 + i])
+        for i, vector in enumerate(self.vectors[250:], start=250):
+            gallery.upsert(uuid.UUID(int=i), vector)
+        for user_id in self.ids[100:160]:
+            gallery.remove(user_id)
+
+    def probes(self, count=50):
+        return [at_distance(vector, 0.2, seed=i) for i, vector in enumerate(self.vectors[::6][:count])]
+
+    def test_exhaustive_search_after_churn_equals_the_exact_scan(self):
+        gallery = self.gallery(self.exhaustive)
+        self.churn(gallery)
+        for probe in self.probes():
+            self.assertEqual(gallery.nearest(probe), gallery.nearest(probe, exact=True))
+        self.assertEqual(gallery.match_many(self.probes()), [gallery.match(probe) for probe in self.probes()])
+
+    def test_candidates_are_reranked_with_exact_distances(self):
+        gallery = self.gallery(self.approximate)
+        self.churn(gallery)
+        user_ids = list(gallery.user_ids)
+        for probe in self.probes():
+            row, distance = gallery.nearest(probe)
+            if row is None:
+                continue
+            self.assertAlmostEqual(distance, float(np.linalg.norm(gallery.matrix[row] - probe)), places=5)
+            candidates = gallery.index.search(np.asarray(probe, dtype=np.float32))
+            exact = min(float(np.linalg.norm(gallery.matrix[c] - probe)) for c in candidates)
+            self.assertAlmostEqual(distance, exact, places=5)
+            self.assertEqual(gallery.match(probe, threshold=10)[0], user_ids[row])
+
+    def test_removed_rows_are_never_candidates(self):
+        gallery = self.gallery(self.exhaustive)
+        self.churn(gallery)
+        for probe in self.probes():
+            candidates = gallery.index.search(np.asarray(probe, dtype=np.float32))
+            if candidates is not None:
+                self.assertNotIn(None, list(gallery.user_ids[candidates]))
+        removed = set(self.ids[100:160])
+        self.assertFalse(removed & set(gallery.user_ids))
+        for i in range(100, 160):
+            self.assertNotIn(gallery.match(self.vectors[i])[0], removed)
+
+
+class IVFIndexTests(IndexConsistencyMixin, TestCase):
+    exhaustive = {"BACKEND": "recognition.indexes.IVFIndex", "OPTIONS": {"n_lists": 8, "n_probe": 8}}
+    approximate = {"BACKEND": "recognition.indexes.IVFIndex", "OPTIONS": {"n_lists": 16, "n_probe": 2}}
+
+    def test_assignments_track_live_rows(self):
+        gallery = self.gallery(self.approximate)
+        self.churn(gallery)
+        assignments = gallery.index.assignments
+        live = np.array([user_id is not None for user_id in gallery.user_ids])
+        self.assertEqual(live.sum(), len(gallery))
+        self.assertTrue(np.all(assignments[:len(live)][live] >= 0))
+        self.assertTrue(np.all(assignments[:len(live)][~live] == -1))
+        self.assertTrue(np.all(assignments[len(live):] == -1))
+
+
+@unittest.skipUnless(importlib.util.find_spec("hnswlib"), "hnswlib is not installed")
+class HNSWIndexTests(IndexConsistencyMixin, TestCase):
+    exhaustive = {"BACKEND": "recognition.indexes.HNSWIndex", "OPTIONS": {"k": 400, "ef": 400}}
+    approximate = {"BACKEND": "recognition.indexes.HNSWIndex", "OPTIONS": {"k": 4, "ef": 16}}
+
+
+class BatchVoteTests(TestCase):
+    def frame(self, session, user_id=None, distance=0.3):
+        result = {"session": session}
+        if user_id is not None:
+            result.update(user_id=user_id, distance=distance)
+        return result
+
+    def test_each_session_votes_on_its_own_frames(self):
+        outcome = vote([
+            self.frame("atm-1", "a"), self.frame("atm-1", "a"), self.frame("atm-1", "b", 0.1),
+            self.frame("atm-2", "b"), self.frame("atm-2"),
+        ])
+        self.assertEqual(outcome["atm-1"]["user_id"], "a")
+        self.assertEqual(outcome["atm-1"]["votes"], 2)
+        self.assertEqual(outcome["atm-2"]["user_id"], "b")
+        self.assertEqual(outcome["atm-2"]["frames"], 2)
+
+    def test_ties_go_to_the_closer_identity(self):
+        outcome = vote([self.frame("s", "a", 0.4), self.frame("s", "b", 0.2)])
+        self.assertEqual(outcome["s"]["user_id"], "b")
+
+    def test_frames_without_a_session_are_not_merged(self):
+        self.assertEqual(vote([self.frame(None, "a"), self.frame(None, "b"), self.frame(None)]), {})
+
+
+def textured_frame(shift=0, seed=0, size=(480, 640)):
+    """A PNG of smooth noise, moved ``shift`` pixels right, for the correlation tracker to follow."""
+    noise = np.random.default_rng(seed).random(size) * 255
+    pixels = cv2.GaussianBlur(noise, (0, 0), 4).astype(np.uint8)
+    ok, png = cv2.imencode(".png", np.roll(pixels, shift, axis=1))
+    return png.tobytes()
+
+
+class FaceTrackerTests(SimpleTestCase):
+    FACE = (400, 300, 720, 660)
+
+    def frame(self, shift=0, seed=0):
+        # 1280x960, tracked on a 640x480 copy
+        return tracking.tracking_frame(textured_frame(shift, seed, size=(960, 1280)), max_side=640)
+
+    def test_tracked_face_follows_the_frame_in_full_resolution(self):
+        gray, scale = self.frame()
+        self.assertEqual((gray.shape, scale), ((480, 640), 0.5))
+        tracker = tracking.FaceTracker(redetect_every=10, min_confidence=7)
+        self.assertIsNone(tracker.track(gray, scale))
+        tracker.start(gray, scale, self.FACE)
+        left, top, right, bottom = self.FACE
+        for shift in (8, 16, 24):
+            # The tracker also re-estimates the face's size, so compare centres
+            found = tracker.track(*self.frame(shift))
+            centre = ((found[0] + found[2]) / 2, (found[1] + found[3]) / 2)
+            np.testing.assert_allclose(centre, ((left + right) / 2 + shift, (top + bottom) / 2), atol=8)
+        self.assertEqual(tracker.frames, 3)
+
+    def test_detection_is_due_after_redetect_every_frames(self):
+        gray, scale = self.frame()
+        tracker = tracking.FaceTracker(redetect_every=2, min_confidence=0)
+        tracker.start(gray, scale, self.FACE)
+        self.assertIsNotNone(tracker.track(gray, scale))
+        self.assertIsNotNone(tracker.track(gray, scale))
+        self.assertIsNone(tracker.track(gray, scale))
+
+    def test_low_confidence_drops_the_track(self):
+        gray, scale = self.frame()
+        tracker = tracking.FaceTracker(redetect_every=10, min_confidence=7)
+        tracker.start(gray, scale, self.FACE)
+        # Another scene altogether
+        self.assertIsNone(tracker.track(*self.frame(seed=1)))
+        self.assertIsNone(tracker.track(gray, scale))
+
+    def test_unreadable_frames_have_no_tracking_copy(self):
+        self.assertEqual(tracking.tracking_frame(b"not an image"), (None, 1.0))
+        gray, scale = tracking.tracking_frame(textured_frame(), max_side=0)
+        self.assertEqual((gray.shape, scale), ((480, 640), 1.0))
+
+
+class FaceStreamConsumerTests(SimpleTestCase):
+    def setUp(self):
+        # Inline inference, which the consumer must still keep off the event loop
+        service = FaceInferenceService(workers=0, queue_size=1, timeout=5)
+        patcher = mock.patch.object(consumers, "get_inference_service", return_value=service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stream(self, scenario):
+        async def run():
+            communicator = WebsocketCommunicator(consumers.FaceStreamConsumer.as_asgi(), "/ws/recognition/stream/")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            try:
+                await scenario(communicator)
+            finally:
+                await communicator.disconnect()
+
+        asyncio.run(run())
+
+    def test_frame_errors_are_reported_and_the_stream_goes_on(self):
+        matches = iter([RuntimeError("cache down"), ("u1", 0.2)])
+
+        def match(encoding):
+            result = next(matches)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        async def scenario(communicator):
+            await communicator.send_to(bytes_data=b"frame 1")
+            self.assertEqual(await communicator.receive_json_from(timeout=5), {"type": "error", "error": "cache down"})
+            await communicator.send_to(bytes_data=b"frame 2")
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+
+        frame = (None, np.zeros(ENCODING_SIZE), (0, 0, 10, 10))
+        with mock.patch.object(consumers, "describe_stream_frame", return_value=frame), \
+                mock.patch.object(consumers, "match_encoding", side_effect=match) as matched:
+            self.stream(scenario)
+        self.assertEqual(matched.call_count, 2)
+
+    def test_detector_only_runs_when_the_tracker_needs_it(self):
+        frames = [textured_frame(shift=2 * number) for number in range(6)]
+        faces = []
+
+        def describe(frame, face=None):
+            faces.append(face)
+            return None, np.zeros(ENCODING_SIZE), face or (200, 150, 360, 330)
+
+        async def scenario(communicator):
+            for number, frame in enumerate(frames, start=1):
+                await communicator.send_to(bytes_data=frame)
+                while len(faces) < number:
+                    await asyncio.sleep(0.01)
+
+        with mock.patch.object(tracking, "REDETECT_EVERY", 2), \
+                mock.patch.object(consumers, "describe_stream_frame", side_effect=describe), \
+                mock.patch.object(consumers, "match_encoding", return_value=(None, None)):
+            self.stream(scenario)
+        self.assertEqual([face is None for face in faces], [True, False, False, True, False, False])
+
+    def test_socket_is_closed_if_the_frame_loop_dies(self):
+        async def scenario(communicator):
+            await communicator.send_to(bytes_data=b"frame")
+            self.assertEqual((await communicator.receive_output(timeout=5))["type"], "websocket.close")
+
+        with mock.patch.object(consumers, "describe_stream_frame", side_effect=RuntimeError("boom")), \
+                mock.patch.object(consumers.FaceStreamConsumer, "send_event", side_effect=OSError("gone")):
+            self.stream(scenario)
+
+
+class ImageDecodingTests(SimpleTestCase):
+    def test_encoded_images_decode_in_memory(self):
+        pixels = np.zeros((12, 20, 3), dtype=np.uint8)
+        pixels[:, 10:] = (0, 0, 255)
+        ok, png = cv2.imencode(".png", pixels)
+        self.assertTrue(ok)
+        np.testing.assert_array_equal(imaging.decode_image(png.tobytes()), pixels)
+
+    def test_unreadable_bytes_decode_to_none(self):
+        self.assertIsNone(imaging.decode_image(b""))
+        self.assertIsNone(imaging.decode_image(None))
+        self.assertIsNone(imaging.decode_image(b"not an image at all"))
+        ok, jpeg = cv2.imencode(".jpg", np.zeros((8, 8, 3), dtype=np.uint8))
+        self.assertIsNone(imaging.decode_image(jpeg.tobytes()[:20]))
+
+
+class FailedFrameTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def retained(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_frames_are_only_kept_when_enabled(self):
+        with override_settings(RECOGNITION_FAILED_FRAMES_DIR=None):
+            self.assertIsNone(imaging.retain_failed_frame(b"frame", "atm.png", "no_face"))
+        with override_settings(RECOGNITION_FAILED_FRAMES_DIR=self.directory):
+            path = imaging.retain_failed_frame(b"frame", "atm.PNG", "no_face")
+        self.assertTrue(path.endswith("_no_face.png"))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"frame")
+
+    def test_oldest_frames_are_pruned_to_stay_under_the_cap(self):
+        with override_settings(RECOGNITION_FAILED_FRAMES_DIR=self.directory, RECOGNITION_FAILED_FRAMES_MAX_BYTES=25):
+            paths = []
+            for number in range(4):
+                path = imaging.retain_failed_frame(b"x" * 10, f"{number}.jpg", "no_match")
+                # Ages the frames explicitly: writes within one clock tick can share an mtime
+                os.utime(path, ns=(number * 10**9, number * 10**9))
+                paths.append(os.path.basename(path))
+            # Larger than the whole cap: never written
+            self.assertIsNone(imaging.retain_failed_frame(b"x" * 26, "big.jpg", "no_match"))
+        self.assertEqual(self.retained(), sorted(paths[-2:]))
+
+
+class DownscaledDetectionTests(SimpleTestCase):
+    def detector(self, *faces):
+        """A stub HOG detector returning ``faces`` and recording the shape it was run on."""
+        shapes = []
+
+        def detect(gray):
+            shapes.append(gray.shape)
+            return [dlib.rectangle(*face) for face in faces]
+        return detect, shapes
+
+    def corners(self, faces):
+        return [(face.left(), face.top(), face.right(), face.bottom()) for face in faces]
+
+    def test_detections_are_mapped_back_to_full_resolution(self):
+        detect, shapes = self.detector((10, 20, 110, 120), (600, 300, 639, 359))
+        faces = imaging.detect_faces(detect, np.zeros((720, 1280), dtype=np.uint8), max_side=640)
+        self.assertEqual(shapes, [(360, 640)])
+        self.assertEqual(self.corners(faces), [(20, 40, 220, 240), (1200, 600, 1278, 718)])
+
+    def test_mapped_detections_stay_inside_the_frame(self):
+        # 1000 -> 333 pixels: the last small pixel maps just past the edge
+        detect, shapes = self.detector((0, 0, 332, 332))
+        faces = imaging.detect_faces(detect, np.zeros((1000, 1000), dtype=np.uint8), max_side=333)
+        self.assertEqual(shapes, [(333, 333)])
+        self.assertEqual(self.corners(faces), [(0, 0, 997, 997)])
+        detect, _ = self.detector((0, 0, 333, 333))
+        self.assertEqual(self.corners(imaging.detect_faces(detect, np.zeros((1000, 1000), dtype=np.uint8), max_side=333)),
+                         [(0, 0, 999, 999)])
+
+    def test_small_frames_and_disabled_downscaling_detect_at_full_resolution(self):
+        for shape, max_side in (((480, 640), 640), ((720, 1280), 0)):
+            detect, shapes = self.detector((5, 5, 50, 50))
+            faces = imaging.detect_faces(detect, np.zeros(shape, dtype=np.uint8), max_side=max_side)
+            self.assertEqual(shapes, [shape])
+            self.assertEqual(self.corners(faces), [(5, 5, 50, 50)])
+
+
+class DescriptorCacheTests(SimpleTestCase):
+    def setUp(self):
+        descriptor_cache = caches[descriptors.CACHE_ALIAS]
+        descriptor_cache.clear()
+        self.addCleanup(descriptor_cache.clear)
+        self.enterContext(mock.patch.object(descriptors, "TTL", 60))
+        self.pixels = np.arange(48, dtype=np.uint8).reshape(4, 4, 3)
+        self.computed = 0
+
+    def compute(self, pixels):
+        self.computed += 1
+        return None, unit_vectors(1)[0]
+
+    def describe(self, pixels=None, kind="probe"):
+        return descriptors.cached_descriptor(kind, self.pixels if pixels is None else pixels, self.compute)
+
+    def test_identical_pixels_hit_the_cache(self):
+        error, first = self.describe()
+        error, again = self.describe(self.pixels.copy())
+        self.assertIsNone(error)
+        self.assertEqual(self.computed, 1)
+        np.testing.assert_array_equal(again, first)
+        self.assertEqual(again.dtype, np.float32)
+        stats = descriptors.cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (1, 1, 0.5))
+
+    def test_other_pixels_or_pipelines_miss(self):
+        self.describe()
+        changed = self.pixels.copy()
+        changed[0, 0, 0] += 1
+        self.describe(changed)
+        # Same bytes, other shape
+        self.describe(self.pixels.reshape(4, 12))
+        self.describe(kind="enrolment")
+        self.assertEqual(self.computed, 4)
+        self.assertEqual(descriptors.cache_stats()["misses"], 4)
+
+    def test_model_or_detection_size_changes_miss(self):
+        self.describe()
+        with mock.patch.object(descriptors, "MODEL_DLIB_RESNET_V1", "dlib_resnet_v2"):
+            self.describe()
+        with mock.patch.object(descriptors, "DETECTION_MAX_SIDE", 320):
+            self.describe()
+        self.describe()
+        self.assertEqual(self.computed, 3)
+        self.assertEqual(descriptors.cache_stats()["hits"], 1)
+
+    def test_errors_are_cached_and_a_zero_ttl_disables_the_cache(self):
+        failing = lambda pixels: (self.compute(pixels)[0] or "no_face", None)
+        self.assertEqual(descriptors.cached_descriptor("probe", self.pixels, failing), ("no_face", None))
+        self.assertEqual(descriptors.cached_descriptor("probe", self.pixels, failing), ("no_face", None))
+        self.assertEqual(self.computed, 1)
+        with mock.patch.object(descriptors, "TTL", 0):
+            self.describe(kind="enrolment")
+            self.describe(kind="enrolment")
+        self.assertEqual(self.computed, 3)
+        self.assertEqual(descriptors.cache_stats()["hit_rate"], 0.5)
+
+
+class InferencePoolTests(SimpleTestCase):
+    """The pool's admission control, with threads standing in for the worker processes."""
+
+    def setUp(self):
+        self.executors = []
+        self.enterContext(mock.patch.object(inference, "ProcessPoolExecutor", self.executor))
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.service = FaceInferenceService(workers=2, queue_size=2, timeout=5)
+        self.addCleanup(self.service.close)
+
+    def executor(self, max_workers, initializer):
+        executor = ThreadPoolExecutor(max_workers)
+        self.executors.append(executor)
+        return executor
+
+    def blocking_job(self):
+        self.release.wait(5)
+        return "done"
+
+    def fill(self):
+        return [self.service.submit(self.blocking_job) for _ in range(self.service.queue_size)]
+
+    def test_saturated_pool_rejects_work_until_a_slot_frees(self):
+        futures = self.fill()
+        self.assertEqual(self.service.in_flight, 2)
+        with self.assertRaises(inference.InferenceSaturated):
+            self.service.submit(self.blocking_job)
+        with self.assertRaises(inference.InferenceSaturated):
+            self.service.submit(self.blocking_job, wait=0.05)
+
+        self.release.set()
+        self.assertEqual([self.service.result(future) for future in futures], ["done", "done"])
+        # The finished jobs' slots are freed by their done callbacks, which may still be running
+        self.assertEqual(self.service.run(str, 7, wait=1), "7")
+        self.assertEqual(self.service.in_flight, 0)
+
+    def test_saturated_pool_answers_503_with_retry_after(self):
+        self.fill()
+        image = SimpleUploadedFile("frame.jpg", b"jpeg bytes", content_type="image/jpeg")
+        with mock.patch.object(views, "get_inference_service", return_value=self.service), \
+                self.assertLogs(views.logger, "WARNING"):
+            response = self.client.post("/api/recognition/recognize/", {"image": image})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(inference.RETRY_AFTER))
+
+    def test_slot_is_held_until_a_timed_out_job_finishes(self):
+        future = self.service.submit(self.blocking_job)
+        with self.assertRaises(inference.InferenceTimeout):
+            self.service.result(future, timeout=0.05)
+        # The worker is still busy with it, so the caller giving up frees nothing
+        self.assertEqual(self.service.in_flight, 1)
+        self.release.set()
+        self.service.close()
+        self.executors[0].shutdown(wait=True)
+        self.assertEqual(self.service.in_flight, 0)
+        self.assertEqual(len(self.fill()), 2)
+
+    def test_closing_cancels_queued_jobs_and_frees_their_slots(self):
+        service = FaceInferenceService(workers=1, queue_size=2, timeout=5)
+        running, queued = service.submit(self.blocking_job), service.submit(self.blocking_job)
+        service.close()
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(service.in_flight, 1)
+        self.release.set()
+        self.assertEqual(running.result(timeout=5), "done")
+
+    def test_broken_pool_is_replaced(self):
+        broken = mock.Mock(**{"submit.side_effect": BrokenProcessPool("worker died")})
+        self.service._executor = broken
+        with self.assertRaises(inference.InferenceUnavailable):
+            self.service.submit(str, 1)
+        broken.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        self.assertEqual(self.service.in_flight, 0)
+
+        # A worker crashing mid-job breaks the futures of the running jobs
+        self.service._executor = broken = mock.Mock()
+        crashed = Future()
+        crashed.set_exception(BrokenProcessPool("worker died"))
+        with self.assertRaises(inference.InferenceUnavailable):
+            self.service.result(crashed)
+        broken.shutdown.assert_called_once()
+
+        self.assertEqual(self.service.run(str, 1), "1")
+        self.assertEqual(len(self.executors), 1)
@@ -0,0 +1,87 @@
+"""
+Face tracking between detections for the streaming consumer.
+
+dlib's correlation tracker follows the face found by the last detection from
+frame to frame for a fraction of the HOG detector's cost (about 8 ms against
+95 ms for a full 640x480 detection, or 28 ms for a window around the previous
+face). A stream only runs the detector every ``FACE_STREAM_REDETECT_EVERY``
+frames, or as soon as the tracker's confidence (its peak-to-sidelobe ratio)
+drops below ``FACE_STREAM_TRACK_MIN_CONFIDENCE``.
+
+The tracker carries state from one frame to the next, so it runs in the
+consumer's process on a grayscale copy downscaled like the detection pass;
+the inference pool gets the tracked rectangle in full-resolution coordinates
+and only computes landmarks and the descriptor.
+"""
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .imaging import DETECTION_MAX_SIDE
+
+REDETECT_EVERY = getattr(settings, "FACE_STREAM_REDETECT_EVERY", 10)
+MIN_CONFIDENCE = getattr(settings, "FACE_STREAM_TRACK_MIN_CONFIDENCE", 7.0)
+
+
+def tracking_frame(image_data, max_side=DETECTION_MAX_SIDE):
+    """
+    Decode a frame to grayscale with its longest side at most ``max_side``
+    pixels. Returns ``(gray, scale)``, with ``gray`` ``None`` if the bytes are
+    not a readable image.
+    """
+    if not image_data:
+        return None, 1.0
+    gray = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None, 1.0
+    height, width = gray.shape
+    if not max_side or max(height, width) <= max_side:
+        return gray, 1.0
+    scale = max_side / max(height, width)
+    small = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+class FaceTracker:
+    """Follows one face through a stream; not thread safe, one per connection."""
+
+    def __init__(self, redetect_every=None, min_confidence=None):
+        self.redetect_every = REDETECT_EVERY if redetect_every is None else redetect_every
+        self.min_confidence = MIN_CONFIDENCE if min_confidence is None else min_confidence
+        self._tracker = None
+        self.frames = 0  # Frames tracked since the last detection
+
+    def track(self, gray, scale):
+        """
+        The face's ``(left, top, right, bottom)`` in the full-resolution frame
+        behind ``gray``, or ``None`` when the detector has to run instead.
+        """
+        if self._tracker is None or self.frames >= self.redetect_every:
+            return None
+        if self._tracker.update(gray) < self.min_confidence:
+            self.reset()
+            return None
+        self.frames += 1
+        position = self._tracker.get_position()
+        height, width = gray.shape[:2]
+        right_edge, bottom_edge = int(round(width / scale)) - 1, int(round(height / scale)) - 1
+        return (
+            max(0, int(round(position.left() / scale))),
+            max(0, int(round(position.top() / scale))),
+            min(right_edge, int(round(position.right() / scale))),
+            min(bottom_edge, int(round(position.bottom() / scale))),
+        )
+
+    def start(self, gray, scale, rectangle):
+        """Track the face detected at ``rectangle`` (full-resolution coordinates) from this frame on."""
+        import dlib
+
+        left, top, right, bottom = (int(round(value * scale)) for value in rectangle)
+        self._tracker = dlib.correlation_tracker()
+        self._tracker.start_track(gray, dlib.rectangle(left, top, right, bottom))
+        self.frames = 0
+
+    def reset(self):
+        self._tracker = None
+        self.frames = 0
@@ -3,4 +3,6 @@ from . import views
 
 urlpatterns = [
     path('recognize/', views.recognize_face, name='recognize_face'),
+    path('recognize/batch/', views.recognize_faces_batch, name='recognize_faces_batch'),
+    path('descriptor-cache/', views.descriptor_cache_stats, name='descriptor_cache_stats'),
 ]
@@ -1,24 +1,59 @@
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
-import numpy as np
-from PIL import Image
-import io
+from django.conf import settings
 import os
-import cv2
 import logging
-from django.core.files.storage import default_storage
-from userManager.models import CustomUser, face_detector, shape_predictor, face_rec_model
+import random
+from collections import defaultdict
+from userManager.models import CustomUser
+from .descriptors import cache_stats
+from .gallery import get_gallery
+from .imaging import retain_failed_frame
+from .models import face_recognized
+from .inference import InferenceUnavailable, describe_probe, get_inference_service
+from .metrics import RECOGNITION_PHASE_SECONDS
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-# Ensure temp directory exists
-TEMP_DIR = os.path.join(default_storage.location, "temp")
-os.makedirs(TEMP_DIR, exist_ok=True)
+PROBE_ERRORS = {
+    "undecodable": "Invalid or corrupted image",
+    "no_face": "No face detected in the uploaded image",
+    "no_encoding": "Face encoding extraction failed",
+}
+
+ALLOWED_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+MAX_BATCH_FRAMES = getattr(settings, "FACE_BATCH_MAX_FRAMES", 16)
+MATCH_LOG_SAMPLE_RATE = getattr(settings, "RECOGNITION_MATCH_LOG_SAMPLE_RATE", 0.01)
+
+
+def log_match(user_id, distance):
+    """Debug-log a sample of ``MATCH_LOG_SAMPLE_RATE`` of match results, so log volume stays flat under load."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < MATCH_LOG_SAMPLE_RATE:
+        logger.debug(f"Best gallery match: user {user_id}, distance {distance:.4f} (sampled)")
+
+
+def user_match_payload(user, distance):
+    return {
+        'user_id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'name': f"{user.first_name} {user.last_name}".strip(),
+        'confidence': 1 - distance,
+    }
+
+
+def busy_response(e):
+    logger.warning(f"Face inference unavailable: {e}")
+    response = Response({"error": "Face recognition is busy, please retry shortly"},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response["Retry-After"] = str(e.retry_after)
+    return response
 
 @csrf_exempt
 @api_view(['POST'])
@@ -36,96 +71,161 @@ def recognize_face(request):
             file_extension = os.path.splitext(facial_image.name)[-1].lower()
 
             # Ensure valid image format
-            if file_extension not in [".jpg", ".jpeg", ".png"]:
+            if file_extension not in ALLOWED_EXTENSIONS:
                 return Response({"error": "Invalid image format. Only JPG, JPEG, PNG allowed."}, 
                                 status=status.HTTP_400_BAD_REQUEST)
             
-            # Save uploaded image temporarily
-            image_path = os.path.join(TEMP_DIR, facial_image.name)
             image_data = facial_image.read()
 
+            # Decode, detect and describe in the face inference pool, off the request thread
             try:
-                # Validate image before saving
-                img = Image.open(io.BytesIO(image_data))
-                img.verify()  # Check if image is corrupt
-            except Exception as e:
-                logger.error(f"Invalid image format: {e}")
-                return Response({"error": "Invalid or corrupted image"}, 
-                                status=status.HTTP_400_BAD_REQUEST)
-
-            # Save the verified image
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
-
-            logger.info(f"Saved image at {image_path}")
-            print(f"Saved image at {image_path}")  # Debugging print
-
-            # Read the image using OpenCV
-            image = cv2.imread(image_path)
-
-            if image is None:
-                logger.error(f"cv2.imread() failed to load image: {image_path}")
-                return Response({"error": "Failed to read image, ensure it's a valid format"}, 
-                                status=status.HTTP_400_BAD_REQUEST)
-
-            # Convert to grayscale for better detection
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            faces = face_detector(gray)
-
-            if not faces:
-                os.remove(image_path)
-                return Response({"error": "No face detected in the uploaded image"}, 
-                                status=status.HTTP_400_BAD_REQUEST)
+                error, face_encoding = get_inference_service().run(describe_probe, image_data)
+            except InferenceUnavailable as e:
+                return busy_response(e)
 
-            # Process face recognition
-            face_shape = shape_predictor(gray, faces[0])
-            face_encoding = np.array(face_rec_model.compute_face_descriptor(image, face_shape))
-
-            if face_encoding.shape[0] != 128:
-                os.remove(image_path)
-                return Response({"error": "Face encoding extraction failed"}, 
+            if error is not None:
+                retain_failed_frame(image_data, facial_image.name, error)
+                return Response({"error": PROBE_ERRORS[error]}, 
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            # Compare with stored face encodings
-            users = CustomUser.objects.filter(face_encoding__isnull=False)
-            recognized = False
+            # Compare with stored face encodings in one batched pass over the gallery
+            with RECOGNITION_PHASE_SECONDS.time(phase="match"):
+                best_match_id, best_distance = get_gallery().match(face_encoding)
             best_match_user = None
-            best_distance = float("inf")
-
-            for user in users:
-                try:
-                    stored_encoding = np.array(user.face_encoding, dtype=np.float64)
-                    if stored_encoding.shape[0] != 128:
-                        continue
-
-                    distance = np.linalg.norm(face_encoding - stored_encoding)
-                    logger.info(f"Comparing with {user.email} | Distance: {distance}")
-                    print(f"Comparing with {user.email} | Distance: {distance}")
-
-                    if distance < 0.5 and distance < best_distance:
-                        best_match_user = user
-                        best_distance = distance
-                        recognized = True
-
-                except (json.JSONDecodeError, TypeError) as e:
-                    logger.warning(f"Error decoding face encoding for user {user.email}: {e}")
-                    continue
-
-            os.remove(image_path)  # Cleanup after processing
+            if best_match_id is not None:
+                with RECOGNITION_PHASE_SECONDS.time(phase="db"):
+                    best_match_user = CustomUser.objects.filter(id=best_match_id).first()
+            recognized = best_match_user is not None
+            log_match(best_match_id, best_distance)
 
             if recognized and best_match_user:
+                face_recognized.send(sender=CustomUser, user_id=best_match_user.id, confidence=1 - best_distance)
                 return Response({
                     'message': 'Face recognized successfully',
-                    'user_id': best_match_user.id,
-                    'username': best_match_user.username,
-                    'email': best_match_user.email,
-                    'name': f"{best_match_user.first_name} {best_match_user.last_name}".strip(),
-                    'confidence': 1 - best_distance,
+                    **user_match_payload(best_match_user, best_distance),
                 }, status=status.HTTP_200_OK)
 
+            retain_failed_frame(image_data, facial_image.name, "no_match")
             return Response({"error": "Face does not match any registered profiles"}, 
                             status=status.HTTP_404_NOT_FOUND)
 
         except Exception as e:
             logger.error(f"General error in face recognition: {e}")
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+
+@csrf_exempt
+@api_view(['POST'])
+def recognize_faces_batch(request):
+    """
+    Recognize a batch of frames uploaded as multipart/form-data ``images``.
+
+    Frames are decoded and described in parallel in the inference pool, then
+    every descriptor is matched against the gallery in one matrix operation.
+    An optional ``sessions`` list (one entry per image) groups frames from the
+    same ATM session; each session's frames vote on a single identity. Without
+    it every frame stands alone and no vote is taken.
+    """
+    frames = request.FILES.getlist('images')
+    if not frames:
+        return Response({'error': 'No image files provided'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(frames) > MAX_BATCH_FRAMES:
+        return Response({'error': f'At most {MAX_BATCH_FRAMES} images per batch'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    sessions = request.data.getlist('sessions') if hasattr(request.data, 'getlist') else []
+    if sessions and len(sessions) != len(frames):
+        return Response({'error': 'Provide one session per image'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        results = [{'index': i, 'filename': frame.name, 'session': sessions[i] if sessions else None}
+                   for i, frame in enumerate(frames)]
+        service = get_inference_service()
+        pending = []
+        for result, frame in zip(results, frames):
+            if os.path.splitext(frame.name)[-1].lower() not in ALLOWED_EXTENSIONS:
+                result['error'] = "Invalid image format. Only JPG, JPEG, PNG allowed."
+                continue
+            image_data = frame.read()
+            try:
+                # Fail fast if the pool is saturated; once admitted, the rest of the batch may queue
+                wait = service.timeout if pending else 0
+                pending.append((result, image_data, service.submit(describe_probe, image_data, wait=wait)))
+            except InferenceUnavailable as e:
+                if not pending:
+                    return busy_response(e)
+                result['error'] = "Face recognition is busy, please retry shortly"
+
+        described = []
+        for result, image_data, future in pending:
+            try:
+                error, face_encoding = service.result(future)
+            except InferenceUnavailable:
+                result['error'] = "Face recognition is busy, please retry shortly"
+                continue
+            if error is not None:
+                retain_failed_frame(image_data, result['filename'], error)
+                result['error'] = PROBE_ERRORS[error]
+                continue
+            described.append((result, face_encoding))
+
+        if described:
+            with RECOGNITION_PHASE_SECONDS.time(phase="match"):
+                matches = get_gallery().match_many([encoding for _, encoding in described])
+            with RECOGNITION_PHASE_SECONDS.time(phase="db"):
+                users = CustomUser.objects.in_bulk([user_id for user_id, _ in matches if user_id is not None])
+            for (result, _), (user_id, distance) in zip(described, matches):
+                log_match(user_id, distance)
+                user = users.get(user_id)
+                result['distance'] = distance
+                if user is not None:
+                    result.update(user_match_payload(user, distance))
+                else:
+                    result['error'] = "Face does not match any registered profiles"
+
+        sessions = vote(results)
+        for outcome in sessions.values():
+            if outcome['user_id'] is not None:
+                face_recognized.send(sender=CustomUser, user_id=outcome['user_id'], confidence=outcome['confidence'])
+        for result in results:
+            if result['session'] is None and 'user_id' in result:
+                face_recognized.send(sender=CustomUser, user_id=result['user_id'], confidence=result['confidence'])
+        return Response({'results': results, 'sessions': sessions}, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        logger.error(f"General error in batch face recognition: {e}")
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def descriptor_cache_stats(request):
+    """Hit/miss counters of the face descriptor cache, across all worker processes"""
+    return Response(cache_stats(), status=status.HTTP_200_OK)
+
+
+def vote(results):
+    """Majority identity per session; ties go to the lower mean distance. Frames without a session do not vote."""
+    ballots = defaultdict(lambda: defaultdict(list))
+    frame_counts = defaultdict(int)
+    for result in results:
+        if result['session'] is None:
+            continue
+        frame_counts[result['session']] += 1
+        if 'user_id' in result:
+            ballots[result['session']][result['user_id']].append(result['distance'])
+
+    outcome = {}
+    for session, frame_count in frame_counts.items():
+        candidates = ballots.get(session)
+        if not candidates:
+            outcome[session] = {'user_id': None, 'votes': 0, 'frames': frame_count}
+            continue
+        user_id, distances = min(candidates.items(), key=lambda item: (-len(item[1]), sum(item[1]) / len(item[1])))
+        outcome[session] = {
+            'user_id': user_id,
+            'votes': len(distances),
+            'frames': frame_count,
+            'confidence': 1 - sum(distances) / len(distances),
+        }
+    return outcome
@@ -1,37 +1,66 @@
 from django.contrib import admin
-from .models import Account, Transaction, Withdrawal, Deposit, Transfer, BillPayment
+from .models import ATM, Account, DailyAccountSummary, Transaction, Withdrawal, Deposit, Transfer, BillPayment
 
 @admin.register(Account)
 class AccountAdmin(admin.ModelAdmin):
     list_display = ("user", "account_number", "balance", "created_at")
+    list_select_related = ("user",)
     search_fields = ("user__username", "account_number")
 
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
-    list_display = ("account", "transaction_type", "amount", "timestamp")
+    list_display = ("account", "transaction_type", "amount", "operation", "timestamp")
     search_fields = ("account__account_number", "transaction_type")
 
+    def get_queryset(self, request):
+        # Account.__str__ and the subtype column would otherwise cost queries per row
+        return super().get_queryset(request).with_details()
+
+    @admin.display(description="Details")
+    def operation(self, obj):
+        return str(obj.operation)
+
 
 @admin.register(Withdrawal)
 class WithdrawalAdmin(admin.ModelAdmin):
     list_display = ("account", "amount", "atm_location", "timestamp")
+    list_select_related = ("account__user",)
     search_fields = ("account__account_number", "atm_location")
 
 
 @admin.register(Deposit)
 class DepositAdmin(admin.ModelAdmin):
     list_display = ("account", "amount", "source", "timestamp")
+    list_select_related = ("account__user",)
     search_fields = ("account__account_number", "source")
 
 
 @admin.register(Transfer)
 class TransferAdmin(admin.ModelAdmin):
     list_display = ("account", "recipient_account", "amount", "timestamp")
+    list_select_related = ("account__user", "recipient_account__user")
     search_fields = ("account__account_number", "recipient_account__account_number")
 
 
 @admin.register(BillPayment)
 class BillPaymentAdmin(admin.ModelAdmin):
     list_display = ("account", "biller_name", "biller_account", "amount", "timestamp")
+    list_select_related = ("account__user",)
     search_fields = ("account__account_number", "biller_name", "biller_account")
+
+
+@admin.register(DailyAccountSummary)
+class DailyAccountSummaryAdmin(admin.ModelAdmin):
+    list_display = ("account", "day", "deposit_total", "withdrawal_count", "withdrawal_total",
+                    "transfer_out_total", "transfer_in_total", "bill_payment_total")
+    list_select_related = ("account__user",)
+    search_fields = ("account__account_number",)
+    date_hierarchy = "day"
+
+
+@admin.register(ATM)
+class ATMAdmin(admin.ModelAdmin):
+    list_display = ("code", "name", "address", "latitude", "longitude", "is_active")
+    list_filter = ("is_active",)
+    search_fields = ("code", "name", "address")
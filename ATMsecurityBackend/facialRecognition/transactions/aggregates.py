@@ -0,0 +1,203 @@
+"""
+Daily per-account aggregates (``DailyAccountSummary``).
+
+The ledger adds every posting to its day's row in the same database
+transaction, while it holds the account row locks, so the increments of one
+account never race and the aggregates commit or roll back with the posting.
+Questions about history are then answered from one row per day instead of one
+per transaction:
+
+- ``balance_at(account_id, day)``: the current balance minus the net flow of
+  the days after ``day``, in one query;
+- ``totals(account_id, start, end)``: counts and sums by type over a period,
+  e.g. the month's withdrawals or a daily limit.
+
+Statements use both (``transactions.statements``).
+
+``reconcile`` recomputes the rows from ``Transaction`` history. It backfills
+accounts and repairs drift from rows written outside the ledger; the
+``reconcile_daily_summaries`` beat task runs it nightly for recent days.
+"""
+import logging
+import operator
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Account, DailyAccountSummary, Transaction, Transfer
+
+logger = logging.getLogger(__name__)
+
+# transaction_type -> field prefix for the posting account; a transfer is also a transfer_in of the recipient
+PREFIXES = {
+    "deposit": "deposit",
+    "withdrawal": "withdrawal",
+    "transfer": "transfer_out",
+    "bill_payment": "bill_payment",
+}
+RECEIVED = "transfer_in"
+CREDITS = ("deposit", "transfer_in")
+DEBITS = ("withdrawal", "transfer_out", "bill_payment")
+FIELDS = [f"{prefix}_{kind}" for prefix in CREDITS + DEBITS for kind in ("count", "total")]
+
+NET_FLOW = (
+    reduce(operator.add, (F(f"{prefix}_total") for prefix in CREDITS))
+    - reduce(operator.add, (F(f"{prefix}_total") for prefix in DEBITS))
+)
+ZERO = Value(Decimal("0.00"), output_field=DecimalField())
+
+
+def _add(account_id, day, prefix, amount):
+    count, total = f"{prefix}_count", f"{prefix}_total"
+    updated = DailyAccountSummary.objects.filter(account_id=account_id, day=day).update(
+        **{count: F(count) + 1, total: F(total) + amount}
+    )
+    if not updated:
+        DailyAccountSummary.objects.create(account_id=account_id, day=day, **{count: 1, total: amount})
+
+
+def record_posting(record, credit_id=None):
+    """
+    Add a ledger posting to its day's aggregates. Must run inside the posting
+    transaction with the accounts locked.
+    """
+    day = timezone.localdate(record.timestamp)
+    _add(record.account_id, day, PREFIXES[record.transaction_type], record.amount)
+    if credit_id is not None:
+        _add(credit_id, day, RECEIVED, record.amount)
+
+
+def balance_at(account_id, day):
+    """Balance of the account at the end of ``day`` (a local date)."""
+    later = (
+        DailyAccountSummary.objects.filter(account_id=OuterRef("pk"), day__gt=day)
+        .values("account_id")
+        .annotate(net=Sum(NET_FLOW))
+        .values("net")
+    )
+    # One statement, so the balance and the later days come from the same snapshot
+    row = (
+        Account.objects.filter(pk=account_id)
+        .annotate(later=Coalesce(Subquery(later, output_field=DecimalField()), ZERO))
+        .values_list("balance", "later")
+        .first()
+    )
+    if row is None:
+        raise Account.DoesNotExist(f"Account {account_id} does not exist.")
+    balance, later = row
+    return balance - later
+
+
+def totals(account_id, start, end):
+    """``{field: value}`` for every count and total over ``start``..``end`` (local dates, inclusive)."""
+    return DailyAccountSummary.objects.filter(account_id=account_id, day__range=(start, end)).aggregate(
+        **{name: Coalesce(Sum(name), 0 if name.endswith("_count") else ZERO) for name in FIELDS}
+    )
+
+
+def _start_of(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _expected(account_id, since):
+    """Aggregates recomputed from ``Transaction`` rows: ``{day: {field: value}}``."""
+    posted = Transaction.objects.filter(account_id=account_id)
+    received = Transfer.objects.filter(recipient_account_id=account_id)
+    if since is not None:
+        start = _start_of(since)
+        posted, received = posted.filter(timestamp__gte=start), received.filter(timestamp__gte=start)
+
+    days = {}
+    groups = [
+        (PREFIXES.get(row["transaction_type"]), row)
+        for row in posted.annotate(day=TruncDate("timestamp"))
+        .values("day", "transaction_type")
+        .annotate(count=Count("id"), total=Sum("amount"))
+        .order_by()
+    ]
+    groups += [
+        (RECEIVED, row)
+        for row in received.annotate(day=TruncDate("timestamp"))
+        .values("day")
+        .annotate(count=Count("id"), total=Sum("amount"))
+        .order_by()
+    ]
+    for prefix, row in groups:
+        if prefix is None:
+            continue
+        values = days.setdefault(row["day"], {name: 0 for name in FIELDS})
+        values[f"{prefix}_count"] += row["count"]
+        values[f"{prefix}_total"] += row["total"]
+    return days
+
+
+def reconcile_account(account_id, since=None):
+    """
+    Make the account's rows from ``since`` (a local date, or all history)
+    match its transactions. Returns the number of rows created, changed or
+    deleted.
+    """
+    with transaction.atomic():
+        # Postings wait for the lock, so none land between the recount and the writes
+        if not Account.objects.select_for_update().filter(pk=account_id).exists():
+            return 0
+        expected = _expected(account_id, since)
+        stored = DailyAccountSummary.objects.filter(account_id=account_id)
+        if since is not None:
+            stored = stored.filter(day__gte=since)
+        stored = {row.day: row for row in stored}
+
+        fixed = 0
+        for day, values in expected.items():
+            row = stored.pop(day, None)
+            if row is None:
+                DailyAccountSummary.objects.create(account_id=account_id, day=day, **values)
+                fixed += 1
+            elif any(getattr(row, name) != value for name, value in values.items()):
+                for name, value in values.items():
+                    setattr(row, name, value)
+                row.save(update_fields=FIELDS)
+                fixed += 1
+        if stored:
+            DailyAccountSummary.objects.filter(pk__in=[row.pk for row in stored.values()]).delete()
+            fixed += len(stored)
+    return fixed
+
+
+def reconcile(since=None, account_ids=None):
+    """
+    Reconcile ``account_ids``, or every account with transactions or summary
+    rows since ``since`` (every account if ``since`` is ``None``). Returns the
+    number of rows fixed.
+    """
+    if account_ids is None:
+        if since is None:
+            account_ids = Account.objects.values_list("pk", flat=True).iterator()
+        else:
+            start = _start_of(since)
+            account_ids = sorted(
+                set(Transaction.objects.filter(timestamp__gte=start).values_list("account_id", flat=True).distinct())
+                | set(Transfer.objects.filter(timestamp__gte=start).values_list("recipient_account_id", flat=True).distinct())
+                # Rows left behind by transactions deleted or moved out of the period
+                | set(DailyAccountSummary.objects.filter(day__gte=since).values_list("account_id", flat=True).distinct())
+            )
+
+    fixed = accounts = 0
+    for account_id in account_ids:
+        fixed += reconcile_account(account_id, since)
+        accounts += 1
+    if fixed:
+        logger.warning(f"Daily account summaries: fixed {fixed} rows across {accounts} accounts")
+    else:
+        logger.info(f"Daily account summaries: {accounts} accounts checked, no drift")
+    return fixed
+
+
+def recent_days(days):
+    """The first local date of the last ``days`` days, today included."""
+    return timezone.localdate() - timedelta(days=days - 1)
@@ -0,0 +1,236 @@
+"""
+Streaming fraud scoring for withdrawals.
+
+Every posted withdrawal (``transaction_posted``) and every face match
+(``recognition.models.face_recognized``) updates a small in-memory state per
+account: ring buffers of the last ``CAPACITY`` withdrawals' times and
+locations, running amount statistics and the latest match confidence.
+Accounts are kept in LRU order and capped at ``FRAUD_MAX_ACCOUNTS``, so
+memory is bounded however many accounts transact.
+
+Before a withdrawal is authorized, ``assess`` turns that state and the request
+into a feature vector in a few numpy operations over fixed-size buffers and
+scores it with a logistic model:
+
+- velocity: withdrawals in the last ``WINDOW`` seconds,
+- spread: distinct ATM locations in that window, this one included,
+- hop: closeness in time of the last withdrawal at another location,
+- amount: how far above the account's usual withdrawal this one is,
+- low confidence: a recent face match below ``LOW_CONFIDENCE`` before an
+  unusually large withdrawal.
+
+The work per assessment is constant; one that still overruns
+``FRAUD_BUDGET_MS`` is counted, and the overruns are logged at most once every
+``BUDGET_LOG_INTERVAL`` seconds. Withdrawals scoring at or above
+``FRAUD_REVIEW_THRESHOLD`` are logged at INFO; the score itself is stored on
+the withdrawal. State is per process: behind
+several workers each sees only the events it served.
+``python manage.py replay_fraud_scoring`` pushes historical withdrawals
+through a fresh scorer to measure throughput and latency.
+"""
+import logging
+import math
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+from django.conf import settings
+
+from .models import Account
+
+logger = logging.getLogger(__name__)
+
+CAPACITY = 16
+WINDOW = 60 * 60
+HOP_SECONDS = 15 * 60
+VELOCITY_NORM = 4
+RECOGNITION_MAX_AGE = 5 * 60
+LOW_CONFIDENCE = 0.5
+MIN_HISTORY = 3
+MAX_Z = 5.0
+BUDGET_LOG_INTERVAL = 60
+
+FEATURES = ("velocity", "spread", "hop", "amount", "low_confidence")
+WEIGHTS = np.array([0.8, 1.0, 2.0, 0.6, 3.0])
+BIAS = -4.0
+
+MAX_ACCOUNTS = getattr(settings, "FRAUD_MAX_ACCOUNTS", 20000)
+BUDGET_MS = getattr(settings, "FRAUD_BUDGET_MS", 5)
+REVIEW_THRESHOLD = getattr(settings, "FRAUD_REVIEW_THRESHOLD", 0.7)
+BLOCK_THRESHOLD = getattr(settings, "FRAUD_BLOCK_THRESHOLD", 0)
+
+
+def location_id(location):
+    """Stable integer for an ATM location string."""
+    return zlib.crc32((location or "").strip().lower().encode())
+
+
+class AccountState:
+    __slots__ = ("times", "places", "size", "head", "count", "mean", "m2", "user_id")
+
+    def __init__(self):
+        self.times = np.zeros(CAPACITY)
+        self.places = np.zeros(CAPACITY, dtype=np.int64)
+        self.size = 0
+        self.head = 0
+        # Welford running mean/variance of withdrawal amounts
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.user_id = None
+
+    def add(self, now, amount, place):
+        self.times[self.head] = now
+        self.places[self.head] = place
+        self.head = (self.head + 1) % CAPACITY
+        self.size = min(self.size + 1, CAPACITY)
+        self.count += 1
+        delta = amount - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (amount - self.mean)
+
+    def features(self, now, amount, place, confidence):
+        times, places = self.times[:self.size], self.places[:self.size]
+        recent = (now - times) <= WINDOW
+        elsewhere = recent & (places != place)
+
+        velocity = np.count_nonzero(recent) / VELOCITY_NORM
+        spread = np.unique(np.append(places[recent], place)).size - 1
+        hop = 0.0
+        if elsewhere.any():
+            gap = max(now - times[elsewhere].max(), 0.0)
+            hop = math.exp(-gap / HOP_SECONDS)
+
+        z = 0.0
+        if self.count >= MIN_HISTORY:
+            std = math.sqrt(self.m2 / (self.count - 1)) or max(self.mean * 0.1, 1.0)
+            z = min(max((amount - self.mean) / std, 0.0), MAX_Z)
+
+        low_confidence = 0.0
+        if confidence is not None and confidence < LOW_CONFIDENCE and (z > 1.0 or self.count < MIN_HISTORY):
+            low_confidence = (LOW_CONFIDENCE - confidence) / LOW_CONFIDENCE
+        return np.array([velocity, spread, hop, z, low_confidence])
+
+
+@dataclass
+class Assessment:
+    risk: float
+    reasons: list = field(default_factory=list)
+    elapsed_ms: float = 0.0
+
+    @property
+    def review(self):
+        return self.risk >= REVIEW_THRESHOLD
+
+    @property
+    def blocked(self):
+        return bool(BLOCK_THRESHOLD) and self.risk >= BLOCK_THRESHOLD
+
+
+class FraudScorer:
+    def __init__(self, max_accounts=MAX_ACCOUNTS, budget_ms=BUDGET_MS):
+        self.max_accounts = max_accounts
+        self.budget_ms = budget_ms
+        self.accounts = OrderedDict()
+        self.recognitions = OrderedDict()  # user_id -> (time, confidence)
+        self.over_budget = 0
+        self._over_budget_logged = 0
+        self._budget_logged_at = -math.inf
+        self.lock = threading.Lock()
+
+    def _state(self, account_id):
+        state = self.accounts.get(account_id)
+        if state is None:
+            state = self.accounts[account_id] = AccountState()
+            if len(self.accounts) > self.max_accounts:
+                self.accounts.popitem(last=False)
+        else:
+            self.accounts.move_to_end(account_id)
+        return state
+
+    def _confidence(self, user_id, now):
+        recognition = self.recognitions.get(user_id) if user_id is not None else None
+        if recognition is None or now - recognition[0] > RECOGNITION_MAX_AGE:
+            return None
+        return recognition[1]
+
+    def assess(self, account_id, amount, location, now=None, user_id=None):
+        """Risk in [0, 1] of a withdrawal about to be authorized, with the features that drove it."""
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        with self.lock:
+            state = self._state(account_id)
+            if user_id is not None:
+                state.user_id = user_id
+            x = state.features(now, float(amount), location_id(location), self._confidence(state.user_id, now))
+        contributions = WEIGHTS * x
+        risk = 1.0 / (1.0 + math.exp(-(contributions.sum() + BIAS)))
+        reasons = [name for name, value in zip(FEATURES, contributions) if value >= 0.5]
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms > self.budget_ms:
+            self._overran(account_id, elapsed_ms)
+        return Assessment(risk, reasons, elapsed_ms)
+
+    def _overran(self, account_id, elapsed_ms):
+        # A slow or busy host overruns on most assessments: warn once per interval with the count
+        with self.lock:
+            self.over_budget += 1
+            clock = time.monotonic()
+            if clock - self._budget_logged_at < BUDGET_LOG_INTERVAL:
+                return
+            overruns = self.over_budget - self._over_budget_logged
+            self._over_budget_logged, self._budget_logged_at = self.over_budget, clock
+        logger.warning(
+            f"Fraud scoring for account {account_id} took {elapsed_ms:.2f} ms (budget {self.budget_ms} ms); "
+            f"{overruns} assessments over budget since the last warning"
+        )
+
+    def observe(self, account_id, amount, location, now=None):
+        """Add a posted withdrawal to the account's state."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._state(account_id).add(now, float(amount), location_id(location))
+
+    def recognized(self, user_id, confidence, now=None):
+        with self.lock:
+            self.recognitions[user_id] = (time.time() if now is None else now, confidence)
+            self.recognitions.move_to_end(user_id)
+            if len(self.recognitions) > self.max_accounts:
+                self.recognitions.popitem(last=False)
+
+    def knows_user(self, account_id):
+        with self.lock:
+            state = self.accounts.get(account_id)
+            return state is not None and state.user_id is not None
+
+
+_scorer = FraudScorer()
+
+
+def get_scorer():
+    return _scorer
+
+
+def assess(account_id, amount, location):
+    """Score a withdrawal with the process-wide scorer. Never raises: on error the risk is unknown (``None``)."""
+    if not getattr(settings, "FRAUD_SCORING", True):
+        return None
+    try:
+        user_id = None
+        if not _scorer.knows_user(account_id):
+            # Once per account and process: recognition events are keyed by user
+            user_id = Account.objects.filter(pk=account_id).values_list("user_id", flat=True).first()
+        assessment = _scorer.assess(account_id, amount, location, user_id=str(user_id) if user_id else None)
+    except Exception as e:
+        logger.error(f"Fraud scoring failed for account {account_id}: {e}")
+        return None
+    if assessment.review:
+        logger.info(
+            f"Withdrawal of {amount} at {location} on account {account_id} scored {assessment.risk:.2f} "
+            f"({', '.join(assessment.reasons)})"
+        )
+    return assessment
@@ -0,0 +1,165 @@
+"""
+Geo-velocity check for ATM withdrawals.
+
+The ``ATM`` registry is held in memory by every process: a dict from
+normalized ATM code and name to a row of a coordinate matrix, reloaded when
+another process publishes an ATM change (``ATM_VERSION_KEY``, as the face
+gallery does). The last ATM each account withdrew at is kept in the shared
+cache, so one ``get_many`` round trip gives both the registry version and the
+account's last position, and no geocoding happens on the hot path.
+
+A withdrawal is "impossible travel" when the great-circle distance from the
+account's last withdrawal is at least ``GEO_VELOCITY_MIN_KM`` and covering it
+in the time since would take more than ``GEO_VELOCITY_MAX_KMH``. Locations
+missing from the registry, or without coordinates, are not checked.
+"""
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ATM
+
+logger = logging.getLogger(__name__)
+
+ATM_VERSION_KEY = "transactions:atm:version"
+LAST_ATM_KEY = "transactions:last-atm:{account_id}"
+LAST_ATM_TTL = 7 * 24 * 60 * 60
+EARTH_RADIUS_KM = 6371.0088
+
+MAX_KMH = getattr(settings, "GEO_VELOCITY_MAX_KMH", 900)
+MIN_KM = getattr(settings, "GEO_VELOCITY_MIN_KM", 50)
+
+
+def normalize(location):
+    return " ".join((location or "").lower().split())
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(math.sqrt(a), 1.0))
+
+
+class ATMRegistry:
+    def __init__(self):
+        self.version = None
+        self.lookup = {}  # normalized code or name -> row
+        self.coordinates = np.empty((0, 2))  # degrees
+        self._lock = threading.Lock()
+
+    def load(self, version=None):
+        rows = list(
+            ATM.objects.filter(is_active=True, latitude__isnull=False, longitude__isnull=False)
+            .order_by("pk")
+            .values_list("code", "name", "latitude", "longitude")
+        )
+        lookup = {}
+        for row, (code, name, _, _) in enumerate(rows):
+            if name:
+                lookup.setdefault(normalize(name), row)
+        # Codes win over names that happen to match another ATM's code
+        lookup.update({normalize(code): row for row, (code, _, _, _) in enumerate(rows)})
+        self.lookup = lookup
+        self.coordinates = np.array([(lat, lon) for _, _, lat, lon in rows], dtype=float).reshape(-1, 2)
+        self.version = version
+
+    def sync(self, shared):
+        """Reload if another process published an ATM change (``shared`` is the cached version)."""
+        if shared is None:
+            shared = _initial_version()
+        if shared == self.version:
+            return
+        with self._lock:
+            if shared != self.version:
+                self.load(shared)
+
+    def locate(self, location):
+        """``(latitude, longitude)`` of a registered ATM by code or name, or ``None``."""
+        row = self.lookup.get(normalize(location))
+        if row is None:
+            return None
+        latitude, longitude = self.coordinates[row]
+        return float(latitude), float(longitude)
+
+
+_registry = ATMRegistry()
+
+
+def _initial_version():
+    # Not 0: after the cache is flushed, a process still holding an old registry must see a new version
+    cache.add(ATM_VERSION_KEY, time.time_ns(), timeout=None)
+    return cache.get(ATM_VERSION_KEY)
+
+
+def get_registry():
+    _registry.sync(cache.get(ATM_VERSION_KEY))
+    return _registry
+
+
+def publish_atm_change():
+    try:
+        cache.incr(ATM_VERSION_KEY)
+    except ValueError:
+        # Missing or evicted: a fresh version is as good as an increment
+        _initial_version()
+
+
+def atms_changed():
+    transaction.on_commit(publish_atm_change)
+
+
+@dataclass
+class Travel:
+    km: float
+    hours: float
+    kmh: float
+
+    @property
+    def impossible(self):
+        return self.km >= MIN_KM and self.kmh > MAX_KMH
+
+    def __str__(self):
+        return f"{self.km:.0f} km in {self.hours * 60:.0f} min ({self.kmh:.0f} km/h)"
+
+
+def check_travel(account_id, location, now=None):
+    """
+    Travel from the account's last withdrawal to ``location``, or ``None``
+    when either end is unknown. Costs one cache round trip.
+    """
+    now = time.time() if now is None else now
+    last_key = LAST_ATM_KEY.format(account_id=account_id)
+    try:
+        cached = cache.get_many([ATM_VERSION_KEY, last_key])
+        _registry.sync(cached.get(ATM_VERSION_KEY))
+    except Exception as e:
+        logger.error(f"Geo-velocity check unavailable: {e}")
+        return None
+    point, last = _registry.locate(location), cached.get(last_key)
+    if point is None or last is None:
+        return None
+
+    latitude, longitude, at = last
+    km = haversine_km(latitude, longitude, *point)
+    # A minute's grace, so two withdrawals in quick succession at neighbouring ATMs are not flagged
+    hours = max(now - at, 60) / 3600
+    return Travel(km, hours, km / hours)
+
+
+def remember_withdrawal(account_id, location, at):
+    """Record where and when (epoch seconds) the account last withdrew, if the ATM is registered."""
+    point = get_registry().locate(location)
+    if point is None:
+        return
+    last_key = LAST_ATM_KEY.format(account_id=account_id)
+    last = cache.get(last_key)
+    if last is not None and last[2] > at:
+        return  # A later withdrawal committed first
+    cache.set(last_key, (*point, at), LAST_ATM_TTL)
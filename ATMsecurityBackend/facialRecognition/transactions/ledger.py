@@ -0,0 +1,232 @@
+"""
+Ledger service: the only code that changes ``Account.balance``.
+
+Every operation is posted in one database transaction that
+
+1. locks the involved accounts with ``select_for_update``, always in primary
+   key order so two transfers in opposite directions cannot deadlock,
+2. returns the earlier posting if the idempotency key was already used, so an
+   ATM retrying after a timeout never double-posts,
+3. moves money with conditional ``F()`` updates (a debit only applies while
+   ``balance >= amount``), and
+4. records the Withdrawal/Deposit/Transfer/BillPayment row and adds it to
+   the accounts' daily aggregates (``transactions.aggregates``).
+
+Withdrawals are first scored for fraud (``transactions.fraud``), checked for
+impossible travel since the account's last withdrawal (``transactions.geo``)
+and checked against velocity limits (``transactions.limits``).
+
+Transient lock errors (deadlocks, lock timeouts, serialization failures)
+roll the whole posting back and retry it up to ``LEDGER_RETRIES`` times.
+Posting latency, retries included, is recorded in ``ledger_posting_seconds``.
+"""
+import logging
+import random
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F
+
+from facialRecognition.metrics import Histogram
+from . import fraud, geo, limits
+from .aggregates import record_posting
+from .models import Account, BillPayment, Deposit, Transaction, Transfer, Withdrawal, transaction_posted
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal("0.01")
+
+POSTING_SECONDS = Histogram(
+    "ledger_posting_seconds",
+    "Time to post a ledger operation, lock waits and retries included, by operation and outcome.",
+    labels={
+        "operation": ("withdrawal", "deposit", "transfer", "bill_payment"),
+        "outcome": ("posted", "replayed", "rejected", "failed"),
+    },
+)
+
+
+class LedgerError(Exception):
+    """A posting was rejected; nothing was written."""
+
+
+class InsufficientFunds(LedgerError):
+    pass
+
+
+class AccountNotFound(LedgerError):
+    pass
+
+
+class IdempotencyConflict(LedgerError):
+    """The idempotency key was already used for a different operation."""
+
+
+class LimitExceeded(LedgerError):
+    """The withdrawal would exceed a velocity limit (see transactions.limits)."""
+
+
+class LimitsUnavailable(LedgerError):
+    """The velocity limits could not be checked; retry after ``retry_after`` seconds."""
+
+    retry_after = limits.RETRY_AFTER
+
+
+class FraudSuspected(LedgerError):
+    """
+    The withdrawal scored above ``FRAUD_BLOCK_THRESHOLD`` (see
+    transactions.fraud) or, with ``GEO_VELOCITY_BLOCK``, implies impossible
+    travel (see transactions.geo).
+    """
+
+
+def _amount(amount):
+    try:
+        amount = Decimal(str(amount)).quantize(CENT)
+    except (InvalidOperation, ValueError):
+        raise LedgerError(f"Invalid amount: {amount!r}")
+    if amount <= 0:
+        raise LedgerError("Amount must be positive.")
+    return amount
+
+
+def _replay(model, idempotency_key, account_id, amount):
+    """The posting already made under ``idempotency_key``, or ``None``."""
+    existing = Transaction.objects.filter(idempotency_key=idempotency_key).first()
+    if existing is None:
+        return None
+    if existing.account_id != account_id or existing.amount != amount:
+        raise IdempotencyConflict(f"Idempotency key {idempotency_key} was used for another operation.")
+    try:
+        return model.objects.get(transaction_ptr=existing)
+    except model.DoesNotExist:
+        raise IdempotencyConflict(f"Idempotency key {idempotency_key} was used for another operation.")
+
+
+def _post_once(model, account_id, amount, debit, credit_id, idempotency_key, fields):
+    with transaction.atomic():
+        account_ids = sorted({account_id, credit_id} - {None})
+        locked = list(Account.objects.select_for_update().filter(pk__in=account_ids).order_by("pk").values_list("pk", flat=True))
+        if len(locked) != len(account_ids):
+            raise AccountNotFound("Account does not exist.")
+
+        if idempotency_key:
+            existing = _replay(model, idempotency_key, account_id, amount)
+            if existing is not None:
+                return existing, False
+
+        if debit and not Account.objects.filter(pk=account_id, balance__gte=amount).update(balance=F("balance") - amount):
+            raise InsufficientFunds("Insufficient funds.")
+        if not debit:
+            Account.objects.filter(pk=account_id).update(balance=F("balance") + amount)
+        if credit_id is not None:
+            Account.objects.filter(pk=credit_id).update(balance=F("balance") + amount)
+
+        record = model.objects.create(
+            account_id=account_id,
+            amount=amount,
+            idempotency_key=idempotency_key or None,
+            **fields,
+        )
+        record_posting(record, credit_id)
+        transaction.on_commit(lambda: transaction_posted.send(sender=model, record=record))
+        return record, True
+
+
+def post(model, account_id, amount, debit=True, credit_id=None, idempotency_key=None, **fields):
+    """
+    Post one operation and return ``(record, created)``. ``created`` is
+    ``False`` when ``idempotency_key`` matched an earlier posting, which is
+    returned unchanged.
+    """
+    amount = _amount(amount)
+    started = time.perf_counter()
+    outcome = "failed"
+    try:
+        record, created = _post(model, account_id, amount, debit, credit_id, idempotency_key, fields)
+        outcome = "posted" if created else "replayed"
+        return record, created
+    except LedgerError:
+        outcome = "rejected"
+        raise
+    finally:
+        POSTING_SECONDS.observe(time.perf_counter() - started, operation=fields["transaction_type"], outcome=outcome)
+
+
+def _post(model, account_id, amount, debit, credit_id, idempotency_key, fields):
+    # Inside a caller's transaction a failed attempt cannot be retried on its own
+    retries = 0 if connection.in_atomic_block else getattr(settings, "LEDGER_RETRIES", 5)
+    for attempt in range(retries + 1):
+        try:
+            return _post_once(model, account_id, amount, debit, credit_id, idempotency_key, fields)
+        except IntegrityError:
+            if not idempotency_key:
+                raise
+            # A concurrent retry with the same key committed first
+            with transaction.atomic():
+                existing = _replay(model, idempotency_key, account_id, amount)
+            if existing is None:
+                raise
+            return existing, False
+        except OperationalError as e:
+            if attempt == retries:
+                raise
+            logger.info(f"Retrying ledger posting after transient database error: {e}")
+            time.sleep(random.uniform(0, 0.005 * 2 ** min(attempt, 6)))
+
+
+def withdraw(account_id, amount, atm_location, idempotency_key=None):
+    amount = _amount(amount)
+    assessment = fraud.assess(account_id, amount, atm_location)
+    risk = assessment.risk if assessment is not None else None
+    travel = geo.check_travel(account_id, atm_location)
+    impossible = travel is not None and travel.impossible
+    if impossible:
+        logger.warning(f"Impossible travel to {atm_location} on account {account_id}: {travel}")
+        risk = 1.0
+    try:
+        if (assessment is not None and assessment.blocked) or (impossible and getattr(settings, "GEO_VELOCITY_BLOCK", False)):
+            raise FraudSuspected("Withdrawal held for review.")
+        reservation = limits.reserve(account_id, amount)
+    except (FraudSuspected, limits.LimitExceeded, limits.LimitsUnavailable) as e:
+        # A retry of a withdrawal that already went through still gets its original posting
+        if idempotency_key:
+            with transaction.atomic():
+                existing = _replay(Withdrawal, idempotency_key, account_id, amount)
+            if existing is not None:
+                return existing, False
+        if isinstance(e, LedgerError):
+            raise
+        if isinstance(e, limits.LimitsUnavailable):
+            raise LimitsUnavailable(str(e)) from e
+        raise LimitExceeded(str(e)) from e
+
+    try:
+        record, created = post(Withdrawal, account_id, amount, idempotency_key=idempotency_key,
+                               transaction_type="withdrawal", atm_location=atm_location,
+                               risk_score=risk)
+    except BaseException:
+        limits.release(reservation)
+        raise
+    if not created:
+        limits.release(reservation)
+    return record, created
+
+
+def deposit(account_id, amount, source, idempotency_key=None):
+    return post(Deposit, account_id, amount, debit=False, idempotency_key=idempotency_key,
+                transaction_type="deposit", source=source)
+
+
+def transfer(account_id, recipient_account_id, amount, note=None, idempotency_key=None):
+    if account_id == recipient_account_id:
+        raise LedgerError("Cannot transfer to the same account.")
+    return post(Transfer, account_id, amount, credit_id=recipient_account_id, idempotency_key=idempotency_key,
+                transaction_type="transfer", recipient_account_id=recipient_account_id, note=note)
+
+
+def pay_bill(account_id, amount, biller_name, biller_account, idempotency_key=None):
+    return post(BillPayment, account_id, amount, idempotency_key=idempotency_key,
+                transaction_type="bill_payment", biller_name=biller_name, biller_account=biller_account)
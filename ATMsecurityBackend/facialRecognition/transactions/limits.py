@@ -0,0 +1,385 @@
+"""
+Withdrawal velocity limits served from rolling counters.
+
+Each configured window (``WITHDRAWAL_LIMITS``: length in seconds, maximum
+amount and maximum count, 0 for no maximum) is split into
+``WITHDRAWAL_LIMIT_BUCKETS`` buckets per account holding the amount (in
+cents) and number of withdrawals. Authorizing a withdrawal sums the buckets
+of every window and, if all limits hold, adds it to the current buckets in one
+atomic step, so an authorization never aggregates ``Withdrawal`` rows. The
+oldest bucket is counted whole, so a window can be up to one bucket longer
+than configured, never shorter.
+
+Counters live in Redis (a Lua script on the ``WITHDRAWAL_LIMIT_CACHE``
+django-redis connection) or, with ``WITHDRAWAL_LIMIT_COUNTERS = "local"``, in
+process memory, which is meant for tests and single-process development. In
+Redis each account also has a set of its bucket keys, and a sorted set lists
+the accounts with live buckets, so reconciling reads those keys instead of
+scanning the keyspace.
+
+Reservations that were never posted (a crash between authorizing and
+posting) and withdrawals written outside the ledger make the counters drift;
+``reconcile`` rewrites every closed bucket from ``Withdrawal`` rows and runs
+periodically from celery beat. If the counters cannot be reached the
+withdrawal is refused with ``LimitsUnavailable``, for the caller to retry
+after ``RETRY_AFTER`` seconds.
+"""
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+
+from .models import Withdrawal
+
+logger = logging.getLogger(__name__)
+
+KEY = "limits:withdrawal:{{{account_id}}}:{window}:{index}"
+# The account's bucket keys; the hash tag keeps it in the same cluster slot as the buckets
+INDEX_KEY = "limits:withdrawal:{{{account_id}}}:keys"
+# Account id -> when its last reserved buckets expire
+ACCOUNTS_KEY = "limits:withdrawal:accounts"
+
+RETRY_AFTER = 5
+
+# KEYS: the account's index key, then each window's bucket keys, oldest first, current bucket last.
+# ARGV: amount, window count, index ttl, then per window: key count, max amount, max count, ttl.
+# Returns 0 after adding the withdrawal to every current bucket, or the number of the exceeded window.
+RESERVE_SCRIPT = """
+local amount = tonumber(ARGV[1])
+local current = {}
+local k, a = 2, 4
+for w = 1, tonumber(ARGV[2]) do
+    local n, max_amount, max_count = tonumber(ARGV[a]), tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2])
+    local total, count = 0, 0
+    for i = k, k + n - 1 do
+        local bucket = redis.call('HMGET', KEYS[i], 'amount', 'count')
+        total = total + (tonumber(bucket[1]) or 0)
+        count = count + (tonumber(bucket[2]) or 0)
+    end
+    if (max_amount > 0 and total + amount > max_amount) or (max_count > 0 and count + 1 > max_count) then
+        return w
+    end
+    current[w] = {KEYS[k + n - 1], ARGV[a + 3]}
+    k, a = k + n, a + 4
+end
+for _, bucket in ipairs(current) do
+    redis.call('HINCRBY', bucket[1], 'amount', amount)
+    redis.call('HINCRBY', bucket[1], 'count', 1)
+    redis.call('EXPIRE', bucket[1], bucket[2])
+    redis.call('SADD', KEYS[1], bucket[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 0
+"""
+
+
+class LimitExceeded(Exception):
+    pass
+
+
+class LimitsUnavailable(Exception):
+    retry_after = RETRY_AFTER
+
+
+@dataclass(frozen=True)
+class Window:
+    seconds: int
+    max_amount: int  # cents, 0 = no limit
+    max_count: int  # 0 = no limit
+    buckets: int
+
+    @property
+    def bucket_seconds(self):
+        return max(self.seconds // self.buckets, 1)
+
+    @property
+    def bucket_count(self):
+        return math.ceil(self.seconds / self.bucket_seconds)
+
+    @property
+    def ttl(self):
+        return self.seconds + self.bucket_seconds
+
+    def indexes(self, now):
+        """Bucket indexes covering the window at ``now``, oldest first."""
+        current = int(now // self.bucket_seconds)
+        return range(current - self.bucket_count + 1, current + 1)
+
+    def describe(self):
+        hours = self.seconds / 3600
+        return f"{hours:g} hour" if hours == 1 else f"{hours:g} hours"
+
+
+@dataclass(frozen=True)
+class Reservation:
+    account_id: int
+    amount: int
+    keys: tuple
+
+
+def _parse(key):
+    """``(window seconds, bucket index)`` of a bucket key."""
+    _, seconds, index = key.rsplit(":", 2)
+    return int(seconds), int(index)
+
+
+def cents(amount):
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
+
+class LocalCounters:
+    """In-process counters with the same semantics as the Redis script."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}  # key -> [amount, count, expires_at]
+
+    def _get(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is not None and bucket[2] <= now:
+            del self.buckets[key]
+            return None
+        return bucket
+
+    def reserve(self, account_id, windows, keys, amount, now):
+        with self.lock:
+            for number, (window, window_keys) in enumerate(zip(windows, keys), start=1):
+                buckets = [bucket for bucket in (self._get(key, now) for key in window_keys) if bucket]
+                total, count = sum(b[0] for b in buckets), sum(b[1] for b in buckets)
+                if (window.max_amount and total + amount > window.max_amount) or (
+                    window.max_count and count + 1 > window.max_count
+                ):
+                    return number
+            for window, window_keys in zip(windows, keys):
+                bucket = self._get(window_keys[-1], now) or self.buckets.setdefault(window_keys[-1], [0, 0, 0])
+                bucket[0] += amount
+                bucket[1] += 1
+                bucket[2] = now + window.ttl
+            return 0
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def add(self, keys, amount, count, now):
+        with self.lock:
+            for key in keys:
+                bucket = self._get(key, now)
+                if bucket is not None:
+                    bucket[0] += amount
+                    bucket[1] += count
+
+    def read(self, keys, now):
+        with self.lock:
+            buckets = [bucket for bucket in (self._get(key, now) for key in keys) if bucket]
+            return sum(b[0] for b in buckets), sum(b[1] for b in buckets)
+
+    def replace(self, window, closed_before, expected, now):
+        """
+        Make the buckets of ``window`` before ``closed_before`` exactly
+        ``expected``: ``{account_id: {key: (amount, count, expires_at)}}``.
+        """
+        expected = {key: bucket for buckets in expected.values() for key, bucket in buckets.items()}
+        with self.lock:
+            for key in list(self.buckets):
+                seconds, index = _parse(key)
+                if seconds == window.seconds and index < closed_before and key not in expected:
+                    del self.buckets[key]
+            for key, (amount, count, expires_at) in expected.items():
+                self.buckets[key] = [amount, count, expires_at]
+
+
+class RedisCounters:
+    def __init__(self, client):
+        self.client = client
+        self.script = self.client.register_script(RESERVE_SCRIPT)
+
+    @staticmethod
+    def index_ttl():
+        # Outlives every bucket listed in the index
+        return max((window.ttl for window in windows()), default=0)
+
+    def reserve(self, account_id, windows, keys, amount, now):
+        ttl = self.index_ttl()
+        args = [amount, len(windows), ttl]
+        for window in windows:
+            args += [window.bucket_count, window.max_amount, window.max_count, window.ttl]
+        pipeline = self.client.pipeline()
+        pipeline.zadd(ACCOUNTS_KEY, {account_id: now + ttl})
+        self.script(
+            keys=[INDEX_KEY.format(account_id=account_id), *(key for window_keys in keys for key in window_keys)],
+            args=args,
+            client=pipeline,
+        )
+        return int(pipeline.execute()[-1])
+
+    def add(self, keys, amount, count, now):
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.hincrby(key, "amount", amount)
+            pipeline.hincrby(key, "count", count)
+        pipeline.execute()
+
+    def read(self, keys, now):
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.hmget(key, "amount", "count")
+        buckets = pipeline.execute()
+        return sum(int(b[0] or 0) for b in buckets), sum(int(b[1] or 0) for b in buckets)
+
+    def replace(self, window, closed_before, expected, now, chunk_size=1000):
+        """See ``LocalCounters.replace``; only the indexed keys of accounts with live buckets are read."""
+        ttl = self.index_ttl()
+        self.client.zremrangebyscore(ACCOUNTS_KEY, "-inf", now)
+        accounts = sorted(set(expected) | {int(account_id) for account_id in self.client.zrange(ACCOUNTS_KEY, 0, -1)})
+        for start in range(0, len(accounts), chunk_size):
+            chunk = accounts[start:start + chunk_size]
+            pipeline = self.client.pipeline()
+            for account_id in chunk:
+                pipeline.smembers(INDEX_KEY.format(account_id=account_id))
+            indexed = pipeline.execute()
+
+            pipeline = self.client.pipeline()
+            for account_id, keys in zip(chunk, indexed):
+                index_key = INDEX_KEY.format(account_id=account_id)
+                buckets = expected.get(account_id, {})
+                for key in keys:
+                    key = key.decode() if isinstance(key, bytes) else key
+                    seconds, index = _parse(key)
+                    if seconds != window.seconds:
+                        continue
+                    if (index + 1) * window.bucket_seconds + window.ttl <= now:
+                        # Expired on its own
+                        pipeline.srem(index_key, key)
+                    elif index < closed_before and key not in buckets:
+                        pipeline.delete(key)
+                        pipeline.srem(index_key, key)
+                for key, (amount, count, expires_at) in buckets.items():
+                    pipeline.delete(key)
+                    pipeline.hset(key, mapping={"amount": amount, "count": count})
+                    pipeline.expireat(key, int(expires_at))
+                    pipeline.sadd(index_key, key)
+                if buckets:
+                    pipeline.expire(index_key, ttl)
+                    pipeline.zadd(ACCOUNTS_KEY, {account_id: now + ttl})
+            pipeline.execute()
+
+
+_local = LocalCounters()
+_redis = {}
+
+
+def counters():
+    backend = getattr(settings, "WITHDRAWAL_LIMIT_COUNTERS", "local")
+    if backend == "local":
+        return _local
+    alias = getattr(settings, "WITHDRAWAL_LIMIT_CACHE", "default")
+    if alias not in _redis:
+        from django_redis import get_redis_connection
+
+        _redis[alias] = RedisCounters(get_redis_connection(alias))
+    return _redis[alias]
+
+
+def windows():
+    buckets = getattr(settings, "WITHDRAWAL_LIMIT_BUCKETS", 24)
+    configured = [
+        Window(int(limit["window"]), cents(limit.get("amount") or 0), int(limit.get("count") or 0), buckets)
+        for limit in getattr(settings, "WITHDRAWAL_LIMITS", [])
+    ]
+    return [window for window in configured if window.max_amount or window.max_count]
+
+
+def _keys(account_id, window, now):
+    return tuple(KEY.format(account_id=account_id, window=window.seconds, index=index) for index in window.indexes(now))
+
+
+def reserve(account_id, amount, clock=time.time):
+    """
+    Count a withdrawal of ``amount`` against every window, or raise
+    ``LimitExceeded`` without counting it (``LimitsUnavailable`` if the
+    counters cannot be reached). Returns a reservation to
+    ``release`` if the withdrawal is not posted after all (``None`` when no
+    limits are configured).
+    """
+    active = windows()
+    if not active:
+        return None
+    now = clock()
+    amount = cents(amount)
+    keys = [_keys(account_id, window, now) for window in active]
+    try:
+        exceeded = counters().reserve(account_id, active, keys, amount, now)
+    except Exception as e:
+        logger.error(f"Withdrawal limit counters unavailable: {e}")
+        raise LimitsUnavailable("Withdrawal limits cannot be checked right now.")
+    if exceeded:
+        window = active[exceeded - 1]
+        raise LimitExceeded(f"Withdrawal limit for the last {window.describe()} exceeded.")
+    return Reservation(account_id, amount, tuple(window_keys[-1] for window_keys in keys))
+
+
+def release(reservation, clock=time.time):
+    """Take back a reservation whose withdrawal was not posted."""
+    if reservation is None:
+        return
+    try:
+        counters().add(reservation.keys, -reservation.amount, -1, clock())
+    except Exception as e:
+        # The next reconcile() drops it
+        logger.warning(f"Could not release withdrawal limit reservation: {e}")
+
+
+def usage(account_id, clock=time.time):
+    """``[{"window", "amount", "count", "max_amount", "max_count"}]`` for the account, amounts in cents."""
+    now = clock()
+    result = []
+    for window in windows():
+        amount, count = counters().read(_keys(account_id, window, now), now)
+        result.append({
+            "window": window.seconds,
+            "amount": amount,
+            "count": count,
+            "max_amount": window.max_amount,
+            "max_count": window.max_count,
+        })
+    return result
+
+
+def reconcile(clock=time.time):
+    """
+    Rewrite every closed bucket of every window from ``Withdrawal`` rows. The
+    current buckets are live and left alone; the next run fixes them.
+    Returns the number of buckets written.
+    """
+    now = clock()
+    written = 0
+    for window in windows():
+        indexes = window.indexes(now)
+        first, current = indexes[0], indexes[-1]
+        start = datetime.fromtimestamp(first * window.bucket_seconds, tz=dt_timezone.utc)
+        end = datetime.fromtimestamp(current * window.bucket_seconds, tz=dt_timezone.utc)
+
+        expected = {}
+        rows = (
+            Withdrawal.objects.filter(timestamp__gte=start, timestamp__lt=end)
+            .values_list("account_id", "amount", "timestamp")
+            .iterator(chunk_size=5000)
+        )
+        for account_id, amount, timestamp in rows:
+            index = int(timestamp.timestamp() // window.bucket_seconds)
+            key = KEY.format(account_id=account_id, window=window.seconds, index=index)
+            buckets = expected.setdefault(account_id, {})
+            bucket = buckets.setdefault(key, [0, 0, (index + 1) * window.bucket_seconds + window.seconds])
+            bucket[0] += cents(amount)
+            bucket[1] += 1
+
+        counters().replace(window, current, expected, now)
+        written += sum(len(buckets) for buckets in expected.values())
+    logger.info(f"Withdrawal limit counters reconciled: {written} buckets rewritten")
+    return written
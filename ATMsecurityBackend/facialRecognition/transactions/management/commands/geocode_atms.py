@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from geopy.extra.rate_limiter import RateLimiter
+from geopy.geocoders import Nominatim
+
+from transactions.models import ATM
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill in the coordinates of ATMs from their address with Nominatim, at most one request per second. "
+        "Withdrawals only ever read stored coordinates; this is the one place that geocodes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Geocode ATMs that already have coordinates too.")
+        parser.add_argument("--delay", type=float, default=1.0, help="Seconds between geocoding requests.")
+
+    def handle(self, *args, **options):
+        atms = ATM.objects.exclude(address="").order_by("pk")
+        if not options["all"]:
+            atms = atms.filter(latitude__isnull=True) | atms.filter(longitude__isnull=True)
+
+        geolocator = Nominatim(user_agent=f"{settings.SITENAME} ATM registry")
+        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=options["delay"], max_retries=2)
+        found = missing = 0
+        for atm in atms.iterator():
+            location = geocode(atm.address)
+            if location is None:
+                missing += 1
+                self.stderr.write(f"No match for ATM {atm.code}: {atm.address}")
+                continue
+            atm.latitude, atm.longitude = location.latitude, location.longitude
+            # save() publishes the change, so every process reloads its registry
+            atm.save(update_fields=["latitude", "longitude"])
+            found += 1
+        self.stdout.write(f"Geocoded {found} ATMs, {missing} not found.")
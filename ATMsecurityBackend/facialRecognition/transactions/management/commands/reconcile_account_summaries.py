@@ -0,0 +1,27 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from transactions.aggregates import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily account summaries from transaction history and fix rows that differ. "
+        "Without --since every account's whole history is checked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="First day to check (YYYY-MM-DD).")
+        parser.add_argument("--account", type=int, action="append", dest="accounts",
+                            help="Only this account id (repeatable).")
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            try:
+                since = date.fromisoformat(options["since"])
+            except ValueError:
+                raise CommandError("--since must be a date in YYYY-MM-DD format.")
+        fixed = reconcile(since=since, account_ids=options["accounts"])
+        self.stdout.write(self.style.SUCCESS(f"Fixed {fixed} daily summary rows."))
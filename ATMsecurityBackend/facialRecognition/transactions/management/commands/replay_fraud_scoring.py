@@ -0,0 +1,80 @@
+import heapq
+import time
+from array import array
+from datetime import date, datetime, time as day_start
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from transactions.fraud import MAX_ACCOUNTS, REVIEW_THRESHOLD, FraudScorer
+from transactions.models import Withdrawal
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay historical withdrawals, oldest first, through a fresh fraud scorer: each one is scored "
+        "as if it were being authorized and then observed. Reports throughput, per-assessment latency "
+        "and the highest-scoring withdrawals. Face matches are not stored, so that feature stays off."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="Only withdrawals from this day on (YYYY-MM-DD).")
+        parser.add_argument("--limit", type=int, default=0, help="Stop after this many withdrawals (0 = all).")
+        parser.add_argument("--threshold", type=float, default=REVIEW_THRESHOLD,
+                            help="Risk at which a withdrawal counts as flagged.")
+        parser.add_argument("--top", type=int, default=10, help="Number of highest-risk withdrawals to list.")
+        parser.add_argument("--max-accounts", type=int, default=MAX_ACCOUNTS,
+                            help="Accounts the scorer keeps state for.")
+
+    def handle(self, *args, **options):
+        rows = Withdrawal.objects.order_by("timestamp", "id")
+        if options["since"]:
+            try:
+                since = date.fromisoformat(options["since"])
+            except ValueError:
+                raise CommandError("--since must be a date in YYYY-MM-DD format.")
+            rows = rows.filter(timestamp__gte=timezone.make_aware(datetime.combine(since, day_start.min)))
+        if options["limit"]:
+            rows = rows[:options["limit"]]
+        rows = rows.values_list("id", "account_id", "amount", "atm_location", "timestamp").iterator(chunk_size=5000)
+
+        scorer = FraudScorer(max_accounts=options["max_accounts"])
+        latencies = array("f")
+        top = []
+        flagged = 0
+        scoring = 0.0
+        started = time.perf_counter()
+        for pk, account_id, amount, location, timestamp in rows:
+            now = timestamp.timestamp()
+            begin = time.perf_counter()
+            assessment = scorer.assess(account_id, amount, location, now=now)
+            scorer.observe(account_id, amount, location, now=now)
+            scoring += time.perf_counter() - begin
+
+            latencies.append(assessment.elapsed_ms)
+            if assessment.risk >= options["threshold"]:
+                flagged += 1
+            entry = (assessment.risk, pk, account_id, amount, location, ", ".join(assessment.reasons))
+            if len(top) < options["top"]:
+                heapq.heappush(top, entry)
+            elif options["top"]:
+                heapq.heappushpop(top, entry)
+        elapsed = time.perf_counter() - started
+
+        count = len(latencies)
+        if not count:
+            self.stdout.write("No withdrawals to replay.")
+            return
+        p50, p95, p99 = np.percentile(np.frombuffer(latencies, dtype=np.float32), [50, 95, 99])
+        self.stdout.write(
+            f"Replayed {count} withdrawals in {elapsed:.2f}s ({count / elapsed:,.0f}/s including the database, "
+            f"{count / scoring:,.0f}/s scoring alone) over {len(scorer.accounts)} accounts in memory"
+        )
+        self.stdout.write(
+            f"Assessment latency: p50 {p50 * 1000:.1f} us, p95 {p95 * 1000:.1f} us, p99 {p99 * 1000:.1f} us, "
+            f"max {max(latencies) * 1000:.1f} us; {scorer.over_budget} over the {scorer.budget_ms} ms budget"
+        )
+        self.stdout.write(f"Flagged at risk >= {options['threshold']}: {flagged} ({flagged / count:.2%})")
+        for risk, pk, account_id, amount, location, reasons in sorted(top, reverse=True):
+            self.stdout.write(f"  {risk:.3f}  withdrawal {pk}  account {account_id}  {amount} at {location}  [{reasons}]")
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+PREFIXES = {"deposit": "deposit", "withdrawal": "withdrawal", "transfer": "transfer_out", "bill_payment": "bill_payment"}
+
+
+def backfill_summaries(apps, schema_editor):
+    """Aggregate the existing transaction history into daily summaries."""
+    Transaction = apps.get_model("transactions", "Transaction")
+    Transfer = apps.get_model("transactions", "Transfer")
+    DailyAccountSummary = apps.get_model("transactions", "DailyAccountSummary")
+
+    rows = {}
+
+    def add(account_id, day, prefix, count, total):
+        row = rows.setdefault((account_id, day), DailyAccountSummary(account_id=account_id, day=day))
+        setattr(row, f"{prefix}_count", getattr(row, f"{prefix}_count") + count)
+        setattr(row, f"{prefix}_total", getattr(row, f"{prefix}_total") + total)
+
+    posted = (
+        Transaction.objects.annotate(day=TruncDate("timestamp"))
+        .values("account_id", "day", "transaction_type")
+        .annotate(count=Count("id"), total=Sum("amount"))
+        .order_by()
+    )
+    for group in posted.iterator():
+        if group["transaction_type"] in PREFIXES:
+            add(group["account_id"], group["day"], PREFIXES[group["transaction_type"]], group["count"], group["total"])
+    received = (
+        Transfer.objects.annotate(day=TruncDate("timestamp"))
+        .values("recipient_account_id", "day")
+        .annotate(count=Count("pk"), total=Sum("amount"))
+        .order_by()
+    )
+    for group in received.iterator():
+        add(group["recipient_account_id"], group["day"], "transfer_in", group["count"], group["total"])
+    DailyAccountSummary.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0004_transaction_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAccountSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('deposit_count', models.PositiveIntegerField(default=0)),
+                ('deposit_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('withdrawal_count', models.PositiveIntegerField(default=0)),
+                ('withdrawal_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('transfer_out_count', models.PositiveIntegerField(default=0)),
+                ('transfer_out_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('transfer_in_count', models.PositiveIntegerField(default=0)),
+                ('transfer_in_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('bill_payment_count', models.PositiveIntegerField(default=0)),
+                ('bill_payment_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_summaries', to='transactions.account')),
+            ],
+            options={
+                'ordering': ['account', '-day'],
+                'constraints': [models.UniqueConstraint(fields=('account', 'day'), name='daily_account_summary_unique_day')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0005_daily_account_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='risk_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
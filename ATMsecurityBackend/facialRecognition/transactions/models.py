@@ -1,5 +1,7 @@
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.dispatch import Signal
 
 User = get_user_model()
 
@@ -9,9 +11,30 @@ class Account(models.Model):
     balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # Last line of defence behind the ledger's conditional debits
+            models.CheckConstraint(condition=models.Q(balance__gte=0), name="account_balance_non_negative"),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.account_number}"
 
+class TransactionQuerySet(models.QuerySet):
+    def with_details(self):
+        """
+        Join everything the API and admin show, so a page of rows costs one
+        query: the account and its user and, on ``Transaction`` querysets,
+        each subtype's table (at most one of them matches a row).
+        """
+        related = ["account__user"]
+        if self.model is Transaction:
+            related += ["withdrawal", "deposit", "transfer__recipient_account__user", "billpayment"]
+        elif self.model is Transfer:
+            related.append("recipient_account__user")
+        return self.select_related(*related)
+
+
 class Transaction(models.Model):  # ✅ Must be defined before subclasses
     TRANSACTION_TYPES = [
         ("deposit", "Deposit"),
@@ -24,13 +47,46 @@ class Transaction(models.Model):  # ✅ Must be defined before subclasses
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Client-supplied key (e.g. from the ATM) that makes retried postings return the original one
+    idempotency_key = models.CharField(max_length=64, unique=True, blank=True, null=True)
+    # Fraud score in [0, 1] computed before authorization (transactions.fraud), withdrawals only
+    risk_score = models.FloatField(blank=True, null=True)
+
+    objects = TransactionQuerySet.as_manager()
+
+    # transaction_type -> reverse one-to-one accessor of the subtype's row
+    SUBTYPE_RELATIONS = {
+        "withdrawal": "withdrawal",
+        "deposit": "deposit",
+        "transfer": "transfer",
+        "bill_payment": "billpayment",
+    }
 
     class Meta:
-        ordering = ["-timestamp"]
+        # id breaks ties between rows posted in the same microsecond
+        ordering = ["-timestamp", "-id"]
+        indexes = [
+            # Serves per-account history pages (TransactionCursorPagination) as index range scans
+            models.Index(fields=["account", "-timestamp", "-id"], name="transaction_account_time_idx"),
+        ]
 
     def __str__(self):
         return f"{self.transaction_type} - {self.amount}"
 
+    @property
+    def operation(self):
+        """
+        The Withdrawal/Deposit/Transfer/BillPayment behind this row, or the row
+        itself if it has none. Free on ``with_details()`` querysets, one query
+        per row otherwise.
+        """
+        if type(self) is not Transaction:
+            return self
+        try:
+            return getattr(self, self.SUBTYPE_RELATIONS[self.transaction_type])
+        except (KeyError, ObjectDoesNotExist):
+            return self
+
 # ✅ Define subclasses AFTER Transaction
 class Withdrawal(Transaction):
     atm_location = models.CharField(max_length=255)
@@ -57,3 +113,55 @@ class BillPayment(Transaction):
 
     def __str__(self):
         return f"Bill Payment - {self.amount} to {self.biller_name}"
+
+class DailyAccountSummary(models.Model):
+    """
+    Per-account, per-day counts and sums by transaction type, maintained by
+    the ledger inside each posting transaction (see transactions.aggregates).
+    ``transfer_out`` is what the account sent, ``transfer_in`` what it received.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="daily_summaries")
+    day = models.DateField()
+    deposit_count = models.PositiveIntegerField(default=0)
+    deposit_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    withdrawal_count = models.PositiveIntegerField(default=0)
+    withdrawal_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    transfer_out_count = models.PositiveIntegerField(default=0)
+    transfer_out_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    transfer_in_count = models.PositiveIntegerField(default=0)
+    transfer_in_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    bill_payment_count = models.PositiveIntegerField(default=0)
+    bill_payment_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ["account", "-day"]
+        constraints = [
+            models.UniqueConstraint(fields=["account", "day"], name="daily_account_summary_unique_day"),
+        ]
+
+    def __str__(self):
+        return f"{self.account.account_number} - {self.day}"
+
+
+class ATM(models.Model):
+    """
+    A registered ATM. Withdrawals name it in ``atm_location`` by its code or
+    name; coordinates come from the admin or ``manage.py geocode_atms``.
+    """
+    code = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=255, blank=True)
+    address = models.CharField(max_length=255, blank=True)
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        verbose_name = "ATM"
+        verbose_name_plural = "ATMs"
+
+    def __str__(self):
+        return f"{self.code} - {self.name}" if self.name else self.code
+
+
+# Sent with ``record`` once a ledger posting has committed
+transaction_posted = Signal()
@@ -0,0 +1,17 @@
+from rest_framework.permissions import BasePermission
+
+from .models import Account
+
+
+class IsAccountHolderOrStaff(BasePermission):
+    """
+    Signed-in users may act on their own account, or on a posting made from
+    it; staff may act on any account.
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated)
+
+    def has_object_permission(self, request, view, obj):
+        account = obj if isinstance(obj, Account) else obj.account
+        return request.user.is_staff or account.user_id == request.user.pk
@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 from .models import Account, Transaction, Withdrawal, Deposit, Transfer, BillPayment
 
@@ -5,33 +7,78 @@ class AccountSerializer(serializers.ModelSerializer):
     class Meta:
         model = Account
         fields = "__all__"
+        # Balances only change through the ledger (transactions.ledger)
+        read_only_fields = ["balance"]
+
+
+class StaffOnlyFieldsMixin:
+    """Leave ``Meta.staff_only_fields`` out of the output unless the requesting user is staff."""
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        request = self.context.get("request")
+        if request is None or not request.user.is_staff:
+            for name in getattr(self.Meta, "staff_only_fields", ()):
+                data.pop(name, None)
+        return data
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(StaffOnlyFieldsMixin, serializers.ModelSerializer):
+    """
+    Polymorphic: each row is serialized as its concrete operation, with the
+    same fields as the withdrawals/deposits/transfers/bill-payments endpoints.
+    Use it with ``Transaction.objects.with_details()``.
+    """
     class Meta:
         model = Transaction
         fields = "__all__"
+        # The fraud score would tell a card holder how close they came to being flagged
+        staff_only_fields = ["risk_score"]
 
+    def to_representation(self, instance):
+        operation = instance.operation
+        serializer_class = OPERATION_SERIALIZERS.get(type(operation))
+        if serializer_class is None:
+            return super().to_representation(instance)
+        return serializer_class(operation, context=self.context).data
+
+
+class PostingSerializer(StaffOnlyFieldsMixin, serializers.ModelSerializer):
+    """Base for operations posted through the ledger."""
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=Decimal("0.01"))
 
-class WithdrawalSerializer(serializers.ModelSerializer):
     class Meta:
+        read_only_fields = ["transaction_type", "timestamp", "idempotency_key", "risk_score"]
+        staff_only_fields = ["risk_score"]
+
+
+class WithdrawalSerializer(PostingSerializer):
+    class Meta(PostingSerializer.Meta):
         model = Withdrawal
         fields = "__all__"
 
 
-class DepositSerializer(serializers.ModelSerializer):
-    class Meta:
+class DepositSerializer(PostingSerializer):
+    class Meta(PostingSerializer.Meta):
         model = Deposit
         fields = "__all__"
 
 
-class TransferSerializer(serializers.ModelSerializer):
-    class Meta:
+class TransferSerializer(PostingSerializer):
+    class Meta(PostingSerializer.Meta):
         model = Transfer
         fields = "__all__"
 
 
-class BillPaymentSerializer(serializers.ModelSerializer):
-    class Meta:
+class BillPaymentSerializer(PostingSerializer):
+    class Meta(PostingSerializer.Meta):
         model = BillPayment
         fields = "__all__"
+
+
+OPERATION_SERIALIZERS = {
+    Withdrawal: WithdrawalSerializer,
+    Deposit: DepositSerializer,
+    Transfer: TransferSerializer,
+    BillPayment: BillPaymentSerializer,
+}
@@ -0,0 +1,30 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from recognition.models import face_recognized
+from .fraud import get_scorer
+from .geo import atms_changed, remember_withdrawal
+from .models import ATM, Withdrawal, transaction_posted
+
+
+@receiver(transaction_posted, sender=Withdrawal)
+def observe_withdrawal(sender, record, **kwargs):
+    """Feed committed withdrawals into the fraud scorer's per-account windows."""
+    get_scorer().observe(record.account_id, record.amount, record.atm_location, record.timestamp.timestamp())
+
+
+@receiver(transaction_posted, sender=Withdrawal)
+def remember_withdrawal_location(sender, record, **kwargs):
+    remember_withdrawal(record.account_id, record.atm_location, record.timestamp.timestamp())
+
+
+@receiver(post_save, sender=ATM)
+@receiver(post_delete, sender=ATM)
+def reload_atm_registry(sender, **kwargs):
+    """Have every process reload its in-memory ATM registry."""
+    atms_changed()
+
+
+@receiver(face_recognized)
+def observe_recognition(sender, user_id, confidence, **kwargs):
+    get_scorer().recognized(str(user_id), confidence)
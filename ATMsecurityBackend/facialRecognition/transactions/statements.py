@@ -0,0 +1,207 @@
+"""
+Account statements, as a streamed CSV or a PDF built in a Celery task.
+
+Rows are read with ``.iterator(chunk_size=...)`` and written out as they
+arrive, so a CSV statement streams in flat memory however many transactions
+the period holds. A PDF is held in memory until it is saved, so it is refused
+above ``STATEMENT_PDF_MAX_ROWS`` rows. Transfers the account received are
+statement rows too: they are read from a second index-ordered iterator and
+merged in by ``(timestamp, id)``.
+
+The PDF's opening and closing balances and the row count checked against
+the limit come from the daily account summaries (``transactions.aggregates``),
+one row per day instead of one per transaction.
+"""
+import csv
+import heapq
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfgen import canvas
+
+from .aggregates import balance_at, totals
+from .models import Transaction, Transfer
+
+CHUNK_SIZE = getattr(settings, "STATEMENT_CHUNK_SIZE", 2000)
+PDF_MAX_ROWS = getattr(settings, "STATEMENT_PDF_MAX_ROWS", 10000)
+DEFAULT_PERIOD_DAYS = 30
+HEADER = ["date", "reference", "type", "description", "debit", "credit"]
+
+
+def parse_period(start, end):
+    """
+    ``(start, end)`` dates from ``YYYY-MM-DD`` strings, both inclusive. The
+    period defaults to the last ``DEFAULT_PERIOD_DAYS`` days up to today.
+    """
+    end_date = parse_date(end) if end else timezone.localdate()
+    start_date = parse_date(start) if start else end_date - timedelta(days=DEFAULT_PERIOD_DAYS - 1)
+    if start_date is None or end_date is None:
+        raise ValueError("Dates must be in YYYY-MM-DD format.")
+    if start_date > end_date:
+        raise ValueError("The start date must not be after the end date.")
+    return start_date, end_date
+
+
+def _bounds(start_date, end_date):
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(start_date, time.min), tz),
+        timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min), tz),
+    )
+
+
+def _describe(operation, received):
+    if received:
+        return f"Transfer from {operation.account.account_number}"
+    if operation.transaction_type == "withdrawal":
+        return f"ATM withdrawal at {operation.atm_location}"
+    if operation.transaction_type == "deposit":
+        return f"Deposit via {operation.source}"
+    if operation.transaction_type == "transfer":
+        return f"Transfer to {operation.recipient_account.account_number}"
+    if operation.transaction_type == "bill_payment":
+        return f"Bill payment to {operation.biller_name} ({operation.biller_account})"
+    return operation.get_transaction_type_display()
+
+
+def statement_rows(account, start_date, end_date):
+    """
+    Yield ``(timestamp, reference, type, description, debit, credit)`` for
+    every transaction of ``account`` in the period, oldest first. ``debit``
+    or ``credit`` is ``None``.
+    """
+    start, end = _bounds(start_date, end_date)
+    posted = (
+        Transaction.objects.with_details()
+        .filter(account=account, timestamp__gte=start, timestamp__lt=end)
+        .order_by("timestamp", "id")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    received = (
+        Transfer.objects.select_related("account")
+        .filter(recipient_account=account, timestamp__gte=start, timestamp__lt=end)
+        .order_by("timestamp", "id")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    merged = heapq.merge(
+        ((record, False) for record in posted),
+        ((record, True) for record in received),
+        key=lambda item: (item[0].timestamp, item[0].pk),
+    )
+    for record, is_received in merged:
+        operation = record if is_received else record.operation
+        credit = is_received or operation.transaction_type == "deposit"
+        yield (
+            operation.timestamp,
+            operation.pk,
+            operation.transaction_type,
+            _describe(operation, is_received),
+            None if credit else operation.amount,
+            operation.amount if credit else None,
+        )
+
+
+def check_pdf_size(account, start_date, end_date):
+    """Raise ``ValueError`` if the period has more rows than a PDF statement may hold."""
+    period = totals(account.pk, start_date, end_date)
+    rows = sum(value for name, value in period.items() if name.endswith("_count"))
+    if rows > PDF_MAX_ROWS:
+        raise ValueError(
+            f"The statement has {rows} transactions, more than the {PDF_MAX_ROWS} a PDF may hold: "
+            "choose a shorter period or download it as CSV."
+        )
+
+
+def statement_balances(account, start_date, end_date):
+    """The account's ``(opening, closing)`` balances for the period."""
+    return balance_at(account.pk, start_date - timedelta(days=1)), balance_at(account.pk, end_date)
+
+
+class Echo:
+    """File-like object whose write() returns the line, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(HEADER)
+    for timestamp, reference, kind, description, debit, credit in rows:
+        yield writer.writerow([
+            timezone.localtime(timestamp).isoformat(timespec="seconds"),
+            reference,
+            kind,
+            description,
+            "" if debit is None else debit,
+            "" if credit is None else credit,
+        ])
+
+
+def write_pdf(file, account, start_date, end_date, rows):
+    """
+    Draw the statement onto ``file`` page by page. The canvas keeps every
+    finished page, compressed, until ``save()``, so memory grows with the
+    number of rows; callers check it with ``check_pdf_size`` first.
+    """
+    width, height = A4
+    margin = 15 * mm
+    line_height = 5 * mm
+    columns = [margin, margin + 38 * mm, margin + 56 * mm, margin + 84 * mm, width - margin - 28 * mm, width - margin]
+
+    opening, closing = statement_balances(account, start_date, end_date)
+    pdf = canvas.Canvas(file, pagesize=A4, pageCompression=1)
+    pdf.setTitle(f"Statement {account.account_number}")
+    page = 1
+
+    def start_page():
+        pdf.setFont("Helvetica-Bold", 12)
+        pdf.drawString(margin, height - margin, f"{settings.SITENAME} account statement")
+        pdf.setFont("Helvetica", 9)
+        pdf.drawString(margin, height - margin - line_height,
+                       f"Account {account.account_number}, {start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}, "
+                       f"opening balance {opening:,.2f}")
+        pdf.drawRightString(width - margin, height - margin, f"Page {page}")
+        y = height - margin - 3 * line_height
+        pdf.setFont("Helvetica-Bold", 8)
+        for x, title in zip(columns[:4], ("Date", "Ref", "Type", "Description")):
+            pdf.drawString(x, y, title)
+        pdf.drawRightString(columns[4], y, "Debit")
+        pdf.drawRightString(columns[5], y, "Credit")
+        pdf.setFont("Helvetica", 8)
+        return y - line_height
+
+    total_debit = total_credit = 0
+    y = start_page()
+    for timestamp, reference, kind, description, debit, credit in rows:
+        if y < margin + line_height:
+            pdf.showPage()
+            page += 1
+            y = start_page()
+        pdf.drawString(columns[0], y, timezone.localtime(timestamp).strftime("%Y-%m-%d %H:%M"))
+        pdf.drawString(columns[1], y, str(reference))
+        pdf.drawString(columns[2], y, kind.replace("_", " "))
+        pdf.drawString(columns[3], y, description[:60])
+        if debit is not None:
+            pdf.drawRightString(columns[4], y, f"{debit:,.2f}")
+            total_debit += debit
+        if credit is not None:
+            pdf.drawRightString(columns[5], y, f"{credit:,.2f}")
+            total_credit += credit
+        y -= line_height
+
+    if y < margin + 3 * line_height:
+        pdf.showPage()
+        page += 1
+        y = start_page()
+    pdf.setFont("Helvetica-Bold", 8)
+    pdf.drawString(columns[3], y - line_height, "Totals")
+    pdf.drawRightString(columns[4], y - line_height, f"{total_debit:,.2f}")
+    pdf.drawRightString(columns[5], y - line_height, f"{total_credit:,.2f}")
+    pdf.drawString(columns[3], y - 2 * line_height, "Closing balance")
+    pdf.drawRightString(columns[5], y - 2 * line_height, f"{closing:,.2f}")
+    pdf.save()
@@ -0,0 +1,43 @@
+import logging
+import tempfile
+from datetime import date
+
+from celery import shared_task
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from . import limits
+from .aggregates import reconcile, recent_days
+from .models import Account
+from .statements import statement_rows, write_pdf
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def generate_statement_pdf(account_id, start, end, name):
+    """
+    Render the statement of ``account_id`` for ``start``..``end`` (ISO dates,
+    inclusive) and save it to the default storage as ``name``.
+    """
+    account = Account.objects.get(pk=account_id)
+    start_date, end_date = date.fromisoformat(start), date.fromisoformat(end)
+    # Build in a local temporary file; the storage only sees the finished PDF
+    with tempfile.TemporaryFile() as output:
+        write_pdf(output, account, start_date, end_date, statement_rows(account, start_date, end_date))
+        output.seek(0)
+        name = default_storage.save(name, File(output))
+    logger.info(f"Statement for account {account.account_number} ({start} to {end}) saved to {name}")
+    return name
+
+
+@shared_task
+def reconcile_daily_summaries(days=2):
+    """Recount the daily account summaries of the last ``days`` days (run nightly by celery beat)."""
+    return reconcile(since=recent_days(days))
+
+
+@shared_task
+def reconcile_withdrawal_limits():
+    """Rewrite closed withdrawal limit buckets from Withdrawal rows (run every few minutes by celery beat)."""
+    return limits.reconcile()
@@ -1,3 +1,867 @@
-from django.test import TestCase
+import importlib.util
+import math
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, datetime, time as clock_time, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from facialRecognition import metrics
+from facialRecognition.metrics import registry
+from userManager.models import CustomUser
+from . import aggregates, fraud, geo, ledger, limits, statements
+from .tasks import generate_statement_pdf
+from .models import ATM, Account, DailyAccountSummary, Deposit, Transaction, Transfer, Withdrawal
+
+
+def run_concurrently(target, args_list):
+    """Run ``target`` once per argument tuple, all threads released together."""
+    barrier = threading.Barrier(len(args_list))
+    results, errors = [], []
+    lock = threading.Lock()
+
+    def worker(*args):
+        try:
+            barrier.wait()
+            result = target(*args)
+            with lock:
+                results.append(result)
+        except Exception as e:
+            with lock:
+                errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+@override_settings(LEDGER_RETRIES=200)
+class LedgerConcurrencyTests(TransactionTestCase):
+    def make_account(self, number, balance):
+        user = CustomUser.objects.create(username=f"user{number}", email=f"user{number}@example.com")
+        return Account.objects.create(user=user, account_number=number, balance=Decimal(balance))
+
+    def test_hot_account_withdrawals_never_overdraw(self):
+        account = self.make_account("1001", "1000.00")
+
+        results, errors = run_concurrently(
+            ledger.withdraw, [(account.pk, "10.00", "ATM 1") for _ in range(200)]
+        )
+
+        self.assertEqual(len(results), 100)
+        self.assertEqual(len(errors), 100)
+        self.assertTrue(all(isinstance(e, ledger.InsufficientFunds) for e in errors))
+        account.refresh_from_db()
+        self.assertEqual(account.balance, Decimal("0.00"))
+        self.assertEqual(Withdrawal.objects.filter(account=account).count(), 100)
+
+    def test_opposite_transfers_conserve_money(self):
+        first = self.make_account("2001", "500.00")
+        second = self.make_account("2002", "500.00")
+        args = [(first.pk, second.pk, "7.00"), (second.pk, first.pk, "3.00")] * 40
+
+        results, errors = run_concurrently(ledger.transfer, args)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 80)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.balance + second.balance, Decimal("1000.00"))
+        self.assertEqual(first.balance, Decimal("500.00") - 40 * Decimal("4.00"))
+
+    def test_retries_with_the_same_key_post_once(self):
+        account = self.make_account("3001", "100.00")
+
+        results, errors = run_concurrently(
+            ledger.withdraw, [(account.pk, "25.00", "ATM 1", "atm-1-txn-42") for _ in range(20)]
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sum(created for _, created in results), 1)
+        self.assertEqual(len({record.pk for record, _ in results}), 1)
+        account.refresh_from_db()
+        self.assertEqual(account.balance, Decimal("75.00"))
+        self.assertEqual(Transaction.objects.filter(idempotency_key="atm-1-txn-42").count(), 1)
+
+    def test_reused_key_for_another_operation_is_rejected(self):
+        account = self.make_account("4001", "100.00")
+        ledger.withdraw(account.pk, "10.00", "ATM 1", idempotency_key="key-1")
+
+        with self.assertRaises(ledger.IdempotencyConflict):
+            ledger.withdraw(account.pk, "20.00", "ATM 1", idempotency_key="key-1")
+        with self.assertRaises(ledger.IdempotencyConflict):
+            ledger.deposit(account.pk, "10.00", "Cash", idempotency_key="key-1")
+        account.refresh_from_db()
+        self.assertEqual(account.balance, Decimal("90.00"))
+
+
+class TransactionFeedQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.first = cls.make_account("5001")
+        cls.second = cls.make_account("5002")
+        cls.admin = CustomUser.objects.create_superuser(
+            username="feedadmin", email="feedadmin@example.com", password="pass", role="admin"
+        )
+
+    @classmethod
+    def make_account(cls, number):
+        user = CustomUser.objects.create(username=f"user{number}", email=f"user{number}@example.com")
+        return Account.objects.create(user=user, account_number=number, balance=Decimal("1000.00"))
+
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin)
+
+    def post_each_type(self, times):
+        for _ in range(times):
+            ledger.deposit(self.first.pk, "5.00", "Cash Deposit")
+            ledger.withdraw(self.first.pk, "1.00", "ATM 1")
+            ledger.transfer(self.first.pk, self.second.pk, "2.00", "rent")
+            ledger.pay_bill(self.first.pk, "3.00", "Power", "P-1")
+
+    def test_feed_serializes_each_subtype(self):
+        self.post_each_type(1)
+
+        response = self.api.get(reverse("transaction-list"))
+
+        rows = {row["transaction_type"]: row for row in response.json()["results"]}
+        self.assertEqual(rows["withdrawal"]["atm_location"], "ATM 1")
+        self.assertEqual(rows["deposit"]["source"], "Cash Deposit")
+        self.assertEqual(rows["transfer"]["recipient_account"], self.second.pk)
+        self.assertEqual(rows["bill_payment"]["biller_name"], "Power")
+
+    def test_feed_query_count_is_constant(self):
+        self.post_each_type(1)
+        # One joined SELECT per page; the cursor paginator runs no COUNT
+        with self.assertNumQueries(1):
+            self.api.get(reverse("transaction-list"))
+
+        self.post_each_type(5)
+        with self.assertNumQueries(1):
+            self.api.get(reverse("transaction-list"))
+
+    def test_cursor_pages_cover_history_once_across_equal_timestamps(self):
+        self.post_each_type(5)
+        other = ledger.deposit(self.second.pk, "1.00", "Cash Deposit")[0]
+        # Force ties so only the id tie-breaker separates rows
+        Transaction.objects.filter(account=self.first, transaction_type="withdrawal").update(
+            timestamp=Transaction.objects.get(pk=other.pk).timestamp
+        )
+
+        seen, url = [], f"{reverse('transaction-list')}?account={self.first.pk}&page_size=3"
+        while url:
+            page = self.api.get(url).json()
+            seen += [row["id"] for row in page["results"]]
+            url = page["next"]
+
+        expected = list(
+            Transaction.objects.filter(account=self.first).order_by("-timestamp", "-id").values_list("id", flat=True)
+        )
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), 20)
+
+    def admin_changelist_queries(self, model_name):
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f"admin:transactions_{model_name}_changelist"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_admin_changelists_query_count_is_constant(self):
+        models = ["transaction", "withdrawal", "deposit", "transfer", "billpayment", "account"]
+        self.post_each_type(1)
+        few = {model: self.admin_changelist_queries(model) for model in models}
+
+        self.post_each_type(5)
+        many = {model: self.admin_changelist_queries(model) for model in models}
+
+        self.assertEqual(many, few)
+
+
+@override_settings(
+    WITHDRAWAL_LIMITS=[{"window": 24 * 60 * 60, "amount": "100.00", "count": 3}],
+    WITHDRAWAL_LIMIT_COUNTERS="local",
+)
+class WithdrawalLimitTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username="limits", email="limits@example.com")
+        cls.account = Account.objects.create(user=user, account_number="6001", balance=Decimal("1000.00"))
+
+    def setUp(self):
+        limits.counters().clear()
+        self.addCleanup(limits.counters().clear)
+
+    def test_count_limit(self):
+        for _ in range(3):
+            ledger.withdraw(self.account.pk, "1.00", "ATM 1")
+        with self.assertRaises(ledger.LimitExceeded):
+            ledger.withdraw(self.account.pk, "1.00", "ATM 1")
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("997.00"))
+
+    def test_amount_limit(self):
+        ledger.withdraw(self.account.pk, "60.00", "ATM 1")
+        with self.assertRaises(ledger.LimitExceeded):
+            ledger.withdraw(self.account.pk, "50.00", "ATM 1")
+        ledger.withdraw(self.account.pk, "40.00", "ATM 1")
+        self.assertEqual(limits.usage(self.account.pk)[0]["amount"], 10000)
+
+    def test_rejected_withdrawal_releases_its_reservation(self):
+        Account.objects.filter(pk=self.account.pk).update(balance=Decimal("5.00"))
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.withdraw(self.account.pk, "50.00", "ATM 1")
+        self.assertEqual(limits.usage(self.account.pk)[0]["count"], 0)
+
+    def test_retry_at_the_limit_returns_the_original_posting(self):
+        first, _ = ledger.withdraw(self.account.pk, "100.00", "ATM 1", idempotency_key="atm-1-7")
+        record, created = ledger.withdraw(self.account.pk, "100.00", "ATM 1", idempotency_key="atm-1-7")
+        self.assertFalse(created)
+        self.assertEqual(record.pk, first.pk)
+
+    def test_reconcile_rebuilds_closed_buckets_from_withdrawals(self):
+        ledger.withdraw(self.account.pk, "30.00", "ATM 1")
+        ledger.withdraw(self.account.pk, "20.00", "ATM 1")
+        limits.counters().clear()
+        # Once the withdrawals' bucket has closed, reconcile restores it
+        later = time.time() + 2 * limits.windows()[0].bucket_seconds
+        limits.reconcile(clock=lambda: later)
+
+        usage = limits.usage(self.account.pk, clock=lambda: later)[0]
+        self.assertEqual((usage["amount"], usage["count"]), (5000, 2))
+
+    def test_unreachable_counters_answer_503_with_retry_after(self):
+        unreachable = mock.Mock(**{"reserve.side_effect": ConnectionError("Connection refused")})
+        api = APIClient()
+        api.force_authenticate(self.account.user)
+        with mock.patch.object(limits, "counters", return_value=unreachable), self.assertLogs(limits.logger, "ERROR"):
+            response = api.post(reverse("withdrawal-list"),
+                                {"account": self.account.pk, "amount": "10.00", "atm_location": "ATM 1"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(limits.RETRY_AFTER))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("1000.00"))
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec("fakeredis") and importlib.util.find_spec("lupa"),
+    "fakeredis with Lua support is not installed",
+)
+@override_settings(
+    WITHDRAWAL_LIMITS=[
+        {"window": 24 * 60 * 60, "amount": "100.00", "count": 3},
+        {"window": 60 * 60, "amount": "60.00", "count": 0},
+    ],
+    WITHDRAWAL_LIMIT_COUNTERS="redis",
+)
+class RedisCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username="redis-limits", email="redis-limits@example.com")
+        cls.account = Account.objects.create(user=user, account_number="6101", balance=Decimal("1000.00"))
+
+    def setUp(self):
+        import fakeredis
+
+        self.redis = fakeredis.FakeStrictRedis()
+        self.enterContext(mock.patch.object(limits, "counters", return_value=limits.RedisCounters(self.redis)))
+        self.index_key = limits.INDEX_KEY.format(account_id=self.account.pk)
+
+    def indexed(self):
+        return {key.decode() for key in self.redis.smembers(self.index_key)}
+
+    def test_script_checks_every_window_before_counting(self):
+        now = time.time()
+        clock = lambda: now
+        limits.reserve(self.account.pk, "50.00", clock=clock)
+        with self.assertRaisesRegex(limits.LimitExceeded, "1 hour"):
+            limits.reserve(self.account.pk, "20.00", clock=clock)
+        self.assertEqual([usage["amount"] for usage in limits.usage(self.account.pk, clock=clock)], [5000, 5000])
+
+        later = now + 2 * 60 * 60
+        clock = lambda: later
+        reservation = limits.reserve(self.account.pk, "20.00", clock=clock)
+        limits.reserve(self.account.pk, "10.00", clock=clock)
+        with self.assertRaisesRegex(limits.LimitExceeded, "24 hours"):
+            limits.reserve(self.account.pk, "1.00", clock=clock)
+        limits.release(reservation, clock=clock)
+        daily = limits.usage(self.account.pk, clock=clock)[0]
+        self.assertEqual((daily["amount"], daily["count"]), (6000, 2))
+
+        # Every bucket the script wrote is indexed, and the account is listed until its buckets expire
+        self.assertEqual(self.indexed(), {key.decode() for key in self.redis.keys("limits:withdrawal:{*}:*:*")} - {self.index_key})
+        self.assertGreater(self.redis.ttl(self.index_key), 0)
+        self.assertGreater(self.redis.zscore(limits.ACCOUNTS_KEY, self.account.pk), later)
+
+    def test_reconcile_rewrites_indexed_buckets_without_scanning(self):
+        ledger.withdraw(self.account.pk, "30.00", "ATM 1")
+        # Reservations that were never posted: one in the withdrawal's bucket, one hours earlier
+        limits.reserve(self.account.pk, "25.00")
+        earlier = time.time() - 3 * 60 * 60
+        stale = limits.reserve(self.account.pk, "5.00", clock=lambda: earlier).keys[0]
+
+        later = time.time() + 2 * 60 * 60
+        with mock.patch.object(self.redis, "scan_iter", side_effect=AssertionError("reconcile scanned the keyspace")):
+            limits.reconcile(clock=lambda: later)
+
+        daily = limits.usage(self.account.pk, clock=lambda: later)[0]
+        self.assertEqual((daily["amount"], daily["count"]), (3000, 1))
+        self.assertFalse(self.redis.exists(stale))
+        self.assertNotIn(stale, self.indexed())
+
+
+class GeoVelocityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username="geo", email="geo@example.com")
+        cls.account = Account.objects.create(user=user, account_number="7001", balance=Decimal("1000.00"))
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            ATM.objects.create(code="NBO-01", name="Nairobi CBD", latitude=-1.2864, longitude=36.8172)
+            ATM.objects.create(code="NBO-02", name="Westlands", latitude=-1.2676, longitude=36.8108)
+            ATM.objects.create(code="MBA-01", name="Mombasa", latitude=-4.0435, longitude=39.6682)
+
+    def withdraw(self, location):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ledger.withdraw(self.account.pk, "10.00", location)[0]
+
+    def test_distant_withdrawal_right_after_another_is_flagged(self):
+        self.withdraw("NBO-01")
+        travel = geo.check_travel(self.account.pk, "mba-01")
+        self.assertGreater(travel.km, 400)
+        self.assertTrue(travel.impossible)
+        self.assertEqual(self.withdraw("Mombasa").risk_score, 1.0)
+
+    def test_nearby_or_unregistered_locations_are_not_flagged(self):
+        self.withdraw("NBO-01")
+        self.assertFalse(geo.check_travel(self.account.pk, "NBO-02").impossible)
+        self.assertIsNone(geo.check_travel(self.account.pk, "Somewhere else"))
+        # Enough time to have flown there
+        self.assertFalse(geo.check_travel(self.account.pk, "MBA-01", now=time.time() + 3 * 3600).impossible)
+
+    @override_settings(GEO_VELOCITY_BLOCK=True)
+    def test_blocking_refuses_the_withdrawal(self):
+        self.withdraw("NBO-01")
+        with self.assertRaises(ledger.FraudSuspected):
+            self.withdraw("MBA-01")
+
+    def test_registry_reloads_after_an_atm_changes(self):
+        self.assertEqual(geo.get_registry().locate("MBA-01"), (-4.0435, 39.6682))
+        with self.captureOnCommitCallbacks(execute=True):
+            ATM.objects.filter(code="MBA-01").get().delete()
+        self.assertIsNone(geo.get_registry().locate("MBA-01"))
+
+
+@override_settings(METRICS_TOKEN="secret")
+class MetricsTests(TestCase):
+    KEY = "metrics:test_flush_seconds::0"
+
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username="metrics", email="metrics@example.com")
+        cls.account = Account.objects.create(user=user, account_number="8001", balance=Decimal("50.00"))
+
+    def setUp(self):
+        registry.flush()
+        cache.clear()
+
+    def test_postings_are_counted_by_operation_and_outcome(self):
+        ledger.deposit(self.account.pk, "5.00", "cash", idempotency_key="m-1")
+        ledger.deposit(self.account.pk, "5.00", "cash", idempotency_key="m-1")
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.pay_bill(self.account.pk, "500.00", "Power", "42")
+
+        body = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").content.decode()
+        self.assertIn('ledger_posting_seconds_count{operation="deposit",outcome="posted"} 1\n', body)
+        self.assertIn('ledger_posting_seconds_count{operation="deposit",outcome="replayed"} 1\n', body)
+        self.assertIn('ledger_posting_seconds_count{operation="bill_payment",outcome="rejected"} 1\n', body)
+        self.assertIn('ledger_posting_seconds_bucket{operation="deposit",outcome="posted",le="+Inf"} 1\n', body)
+        self.assertIn("# TYPE recognition_phase_seconds histogram", body)
+        self.assertIn("face_inference_in_flight 0", body)
+
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_only_debug_serves_metrics_without_a_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    def test_idle_process_flushes_periodically(self):
+        process = metrics.Registry()
+        self.addCleanup(process.close)
+        with mock.patch.object(metrics, "FLUSH_INTERVAL", 0.01):
+            process.add({self.KEY: 3})
+            deadline = time.monotonic() + 5
+            while cache.get(self.KEY) is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(cache.get(self.KEY), 3)
+
+    def test_close_flushes_what_is_pending(self):
+        process = metrics.Registry()
+        process.add({self.KEY: 2})
+        self.assertIsNone(cache.get(self.KEY))
+        process.close()
+        self.assertEqual(cache.get(self.KEY), 2)
+        flusher = process._flusher
+        flusher.join(timeout=5)
+        self.assertFalse(flusher.is_alive())
+        # A closed registry starts no new flush thread
+        process.add({self.KEY: 1})
+        self.assertIs(process._flusher, flusher)
+
+
+class PostingPermissionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create(username="owner", email="owner@example.com", role="student")
+        cls.other = CustomUser.objects.create(username="other", email="other@example.com", role="student")
+        cls.teller = CustomUser.objects.create(username="teller", email="teller@example.com", role="staff")
+        cls.account = Account.objects.create(user=cls.owner, account_number="9001", balance=Decimal("100.00"))
+        cls.other_account = Account.objects.create(user=cls.other, account_number="9002", balance=Decimal("100.00"))
+
+    def setUp(self):
+        self.api = APIClient()
+
+    def deposit(self, account, user=None):
+        self.api.force_authenticate(user)
+        return self.api.post(reverse("deposit-list"), {"account": account.pk, "amount": "5.00", "source": "cash"})
+
+    def test_postings_require_a_signed_in_account_holder(self):
+        self.assertEqual(self.deposit(self.account).status_code, 401)
+        self.assertEqual(self.deposit(self.account, self.other).status_code, 403)
+        self.api.force_authenticate(self.other)
+        response = self.api.post(reverse("transfer-list"), {
+            "account": self.account.pk, "recipient_account": self.other_account.pk, "amount": "50.00",
+        })
+        self.assertEqual(response.status_code, 403)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("100.00"))
+
+        self.assertEqual(self.deposit(self.account, self.owner).status_code, 201)
+        self.assertEqual(self.deposit(self.account, self.teller).status_code, 201)
+
+    def test_users_only_see_their_own_postings(self):
+        mine, _ = ledger.deposit(self.account.pk, "1.00", "cash")
+        theirs, _ = ledger.deposit(self.other_account.pk, "1.00", "cash")
+
+        self.api.force_authenticate(self.owner)
+        rows = self.api.get(reverse("deposit-list")).json()["results"]
+        self.assertEqual([row["id"] for row in rows], [mine.pk])
+        self.assertEqual(self.api.get(reverse("deposit-detail", args=[theirs.pk])).status_code, 404)
+
+        self.api.force_authenticate(self.teller)
+        self.assertEqual(len(self.api.get(reverse("deposit-list")).json()["results"]), 2)
+
+    def test_users_only_see_their_own_transactions(self):
+        mine, _ = ledger.deposit(self.account.pk, "1.00", "cash")
+        theirs, _ = ledger.deposit(self.other_account.pk, "1.00", "cash")
+        self.assertEqual(self.api.get(reverse("transaction-list")).status_code, 401)
+
+        self.api.force_authenticate(self.owner)
+        rows = self.api.get(reverse("transaction-list")).json()["results"]
+        self.assertEqual([row["id"] for row in rows], [mine.pk])
+        rows = self.api.get(reverse("transaction-list"), {"account": self.other_account.pk}).json()["results"]
+        self.assertEqual(rows, [])
+        self.assertEqual(self.api.get(reverse("transaction-detail", args=[theirs.pk])).status_code, 404)
+
+        self.api.force_authenticate(self.teller)
+        self.assertEqual(len(self.api.get(reverse("transaction-list")).json()["results"]), 2)
+
+    def test_risk_score_is_only_shown_to_staff(self):
+        self.api.force_authenticate(self.owner)
+        response = self.api.post(reverse("deposit-list"), {
+            "account": self.account.pk, "amount": "5.00", "source": "cash", "risk_score": 0.0,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("risk_score", response.json())
+        record = Deposit.objects.get(pk=response.json()["id"])
+        # Read only: the ledger's score stands, whatever the client sent
+        self.assertNotEqual(record.risk_score, 0.0)
+        Transaction.objects.filter(pk=record.pk).update(risk_score=0.75)
+
+        for user, shown in ((self.owner, False), (self.teller, True)):
+            self.api.force_authenticate(user)
+            for url in (reverse("deposit-detail", args=[record.pk]), reverse("transaction-detail", args=[record.pk])):
+                with self.subTest(user=user.username, url=url):
+                    data = self.api.get(url).json()
+                    self.assertEqual("risk_score" in data, shown)
+                    if shown:
+                        self.assertEqual(data["risk_score"], 0.75)
+
+    def test_statements_are_only_served_to_the_account_holder_or_staff(self):
+        url = reverse("account-statement", args=[self.account.pk])
+        pdf_url = reverse("account-statement-pdf", args=[self.account.pk])
+        self.assertEqual(self.api.get(url).status_code, 401)
+        with mock.patch.object(generate_statement_pdf, "delay") as queued:
+            for user, csv_status, pdf_status in ((self.other, 403, 403), (self.owner, 200, 202), (self.teller, 200, 202)):
+                self.api.force_authenticate(user)
+                self.assertEqual(self.api.get(url).status_code, csv_status)
+                self.assertEqual(self.api.post(pdf_url).status_code, pdf_status)
+        self.assertEqual(queued.call_count, 2)
+
+
+class StatementTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create(username="stmt", email="stmt@example.com")
+        sender = CustomUser.objects.create(username="sender", email="sender@example.com")
+        cls.account = Account.objects.create(user=cls.owner, account_number="9101", balance=Decimal("500.00"))
+        cls.sender = Account.objects.create(user=sender, account_number="9102", balance=Decimal("500.00"))
+
+    def setUp(self):
+        limits.counters().clear()
+        self.addCleanup(limits.counters().clear)
+        self.api = APIClient()
+        self.api.force_authenticate(self.owner)
+
+    @staticmethod
+    def at(record, day, hour=12, minute=0):
+        moment = timezone.make_aware(datetime.combine(day, clock_time(hour, minute)))
+        Transaction.objects.filter(pk=record.pk).update(timestamp=moment)
+        return record
+
+    def deposit(self, day, hour=12, minute=0):
+        return self.at(ledger.deposit(self.account.pk, "1.00", "cash")[0], day, hour, minute)
+
+    def test_period_bounds_are_inclusive_local_days(self):
+        start, end = date(2026, 3, 1), date(2026, 3, 3)
+        self.deposit(date(2026, 2, 28), 23, 59)
+        first = self.deposit(start, 0, 0)
+        last = self.deposit(end, 23, 59)
+        self.deposit(date(2026, 3, 4), 0, 0)
+        rows = list(statements.statement_rows(self.account, start, end))
+        self.assertEqual([row[1] for row in rows], [first.pk, last.pk])
+
+    def test_received_transfers_are_merged_in_order(self):
+        day = date(2026, 3, 2)
+        withdrawal = self.at(ledger.withdraw(self.account.pk, "10.00", "ATM 1")[0], day, 10)
+        received = self.at(ledger.transfer(self.sender.pk, self.account.pk, "25.00", "rent")[0], day, 11)
+        deposit = self.deposit(day, 12)
+        sent = self.at(ledger.transfer(self.account.pk, self.sender.pk, "5.00", "change")[0], day, 13)
+
+        rows = list(statements.statement_rows(self.account, day, day))
+        self.assertEqual(
+            [(reference, description, debit, credit) for _, reference, _, description, debit, credit in rows],
+            [
+                (withdrawal.pk, "ATM withdrawal at ATM 1", Decimal("10.00"), None),
+                (received.pk, "Transfer from 9102", None, Decimal("25.00")),
+                (deposit.pk, "Deposit via cash", None, Decimal("1.00")),
+                (sent.pk, "Transfer to 9102", Decimal("5.00"), None),
+            ],
+        )
+        # The sender's statement has the same transfer as a debit
+        self.assertEqual(list(statements.statement_rows(self.sender, day, day))[0][4], Decimal("25.00"))
+
+    def test_default_period_is_the_last_30_days(self):
+        today = timezone.localdate()
+        start, end = statements.parse_period(None, None)
+        self.assertEqual(end, today)
+        self.assertEqual((end - start).days + 1, 30)
+        self.assertEqual(statements.parse_period(None, "2026-03-31"), (date(2026, 3, 2), date(2026, 3, 31)))
+        with self.assertRaises(ValueError):
+            statements.parse_period("2026-03-31", "2026-03-01")
+        with self.assertRaises(ValueError):
+            statements.parse_period("31/03/2026", None)
+
+    def test_csv_statement_is_streamed(self):
+        deposit = self.deposit(timezone.localdate())
+        response = self.api.get(reverse("account-statement", args=[self.account.pk]))
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ",".join(statements.HEADER))
+        self.assertEqual(lines[1].split(",")[1:], [str(deposit.pk), "deposit", "Deposit via cash", "", "1.00"])
+
+    def test_pdf_is_accepted_then_served_once_ready(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.deposit(timezone.localdate())
+        with override_settings(MEDIA_ROOT=media), mock.patch.object(generate_statement_pdf, "delay") as queued:
+            response = self.api.post(reverse("account-statement-pdf", args=[self.account.pk]))
+            self.assertEqual(response.status_code, 202)
+            url = response.json()["url"]
+            self.assertEqual(self.api.get(url).status_code, 404)
+
+            generate_statement_pdf(*queued.call_args.args)
+            response = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "application/pdf")
+            self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+            response.close()
+
+    def test_pdf_of_too_many_rows_is_refused(self):
+        self.deposit(timezone.localdate())
+        self.deposit(timezone.localdate())
+        with mock.patch.object(statements, "PDF_MAX_ROWS", 1), \
+                mock.patch.object(generate_statement_pdf, "delay") as queued:
+            response = self.api.post(reverse("account-statement-pdf", args=[self.account.pk]))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("CSV", response.json()["error"])
+        queued.assert_not_called()
+
+
+class DailySummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = CustomUser.objects.create(username="daily", email="daily@example.com")
+        payee = CustomUser.objects.create(username="payee", email="payee@example.com")
+        cls.account = Account.objects.create(user=owner, account_number="9201", balance=Decimal("500.00"))
+        cls.payee = Account.objects.create(user=payee, account_number="9202", balance=Decimal("500.00"))
+
+    def setUp(self):
+        limits.counters().clear()
+        self.addCleanup(limits.counters().clear)
+
+    @staticmethod
+    def moment(day, hour, minute=0):
+        return timezone.make_aware(datetime.combine(day, clock_time(hour, minute)))
+
+    def post_at(self, moment, operation, *args):
+        """Post through the ledger as if at ``moment`` (a local time)."""
+        with mock.patch("django.utils.timezone.now", return_value=moment):
+            return operation(*args)[0]
+
+    def post_history(self):
+        """Postings of every type either side of two midnights, 2026-03-01..03."""
+        first, second, third = date(2026, 3, 1), date(2026, 3, 2), date(2026, 3, 3)
+        self.post_at(self.moment(first, 9), ledger.deposit, self.account.pk, "100.00", "cash")
+        self.post_at(self.moment(first, 23, 59), ledger.withdraw, self.account.pk, "20.00", "ATM 1")
+        self.post_at(self.moment(second, 0, 0), ledger.transfer, self.account.pk, self.payee.pk, "30.00")
+        self.post_at(self.moment(second, 12), ledger.transfer, self.payee.pk, self.account.pk, "45.00")
+        self.post_at(self.moment(second, 23, 59), ledger.pay_bill, self.account.pk, "15.00", "Power", "42")
+        self.post_at(self.moment(third, 0, 0), ledger.deposit, self.account.pk, "5.00", "cash")
+        return first, second, third
+
+    def replayed_balance(self, account, day):
+        """The balance at the end of ``day`` replayed from the account's opening balance and its rows."""
+        end = self.moment(day + timedelta(days=1), 0)
+        balance = Decimal("500.00")
+        for record in Transaction.objects.filter(account=account, timestamp__lt=end):
+            balance += record.amount if record.transaction_type == "deposit" else -record.amount
+        for record in Transfer.objects.filter(recipient_account=account, timestamp__lt=end):
+            balance += record.amount
+        return balance
+
+    def test_balance_at_matches_a_replay_of_transactions(self):
+        first, second, third = self.post_history()
+        for account in (self.account, self.payee):
+            for day in (first - timedelta(days=1), first, second, third):
+                with self.subTest(account=account.account_number, day=day):
+                    self.assertEqual(aggregates.balance_at(account.pk, day), self.replayed_balance(account, day))
+        account = Account.objects.get(pk=self.account.pk)
+        self.assertEqual(aggregates.balance_at(self.account.pk, third), account.balance)
+        with self.assertRaises(Account.DoesNotExist):
+            aggregates.balance_at(0, third)
+
+    def test_totals_split_postings_at_local_midnight(self):
+        first, second, third = self.post_history()
+        day_one = aggregates.totals(self.account.pk, first, first)
+        self.assertEqual((day_one["deposit_count"], day_one["deposit_total"]), (1, Decimal("100.00")))
+        self.assertEqual((day_one["withdrawal_count"], day_one["withdrawal_total"]), (1, Decimal("20.00")))
+        self.assertEqual(day_one["transfer_out_count"], 0)
+
+        day_two = aggregates.totals(self.account.pk, second, second)
+        self.assertEqual(
+            [day_two[name] for name in ("transfer_out_total", "transfer_in_total", "bill_payment_total", "deposit_count")],
+            [Decimal("30.00"), Decimal("45.00"), Decimal("15.00"), 0],
+        )
+        period = aggregates.totals(self.account.pk, first, third)
+        self.assertEqual((period["deposit_count"], period["deposit_total"]), (2, Decimal("105.00")))
+        self.assertEqual(aggregates.totals(self.payee.pk, first, third)["transfer_in_total"], Decimal("30.00"))
+        # A period without postings has zero counts and totals rather than None
+        empty = aggregates.totals(self.account.pk, third + timedelta(days=1), third + timedelta(days=7))
+        self.assertEqual(set(empty.values()), {0})
+
+    def test_reconcile_repairs_drift_from_writes_outside_the_ledger(self):
+        first, second, third = self.post_history()
+        expected = {
+            row.day: {name: getattr(row, name) for name in aggregates.FIELDS}
+            for row in DailyAccountSummary.objects.filter(account=self.account)
+        }
+        self.assertEqual(aggregates.reconcile_account(self.account.pk), 0)
+
+        # A deposit written straight to the table, a posting moved to another day and a lost row
+        with mock.patch("django.utils.timezone.now", return_value=self.moment(second, 8)):
+            Deposit.objects.create(account=self.account, amount=Decimal("7.00"), transaction_type="deposit", source="branch")
+        moved = Transaction.objects.get(account=self.account, transaction_type="bill_payment")
+        Transaction.objects.filter(pk=moved.pk).update(timestamp=self.moment(third, 10))
+        DailyAccountSummary.objects.filter(account=self.account, day=first).delete()
+        expected[second]["deposit_count"] += 1
+        expected[second]["deposit_total"] += Decimal("7.00")
+        expected[second]["bill_payment_count"] -= 1
+        expected[second]["bill_payment_total"] -= Decimal("15.00")
+        expected[third]["bill_payment_count"] += 1
+        expected[third]["bill_payment_total"] += Decimal("15.00")
+
+        with self.assertLogs(aggregates.logger, "WARNING"):
+            self.assertEqual(aggregates.reconcile(since=first), 3)
+        stored = {
+            row.day: {name: getattr(row, name) for name in aggregates.FIELDS}
+            for row in DailyAccountSummary.objects.filter(account=self.account)
+        }
+        self.assertEqual(stored, expected)
+        self.assertEqual(aggregates.reconcile_account(self.account.pk), 0)
+
+
+    def test_reconcile_since_revisits_accounts_without_new_transactions(self):
+        first, second, third = self.post_history()
+        # The third day's only deposit is moved back before the period: its summary row is stale
+        Transaction.objects.filter(account=self.account, transaction_type="deposit", timestamp__gte=self.moment(third, 0)) \
+            .update(timestamp=self.moment(first, 10))
+        with self.assertLogs(aggregates.logger, "WARNING"):
+            self.assertEqual(aggregates.reconcile(since=third), 1)
+        self.assertFalse(DailyAccountSummary.objects.filter(account=self.account, day=third).exists())
+
+    def test_statement_balances_and_size_come_from_the_summaries(self):
+        first, second, third = self.post_history()
+        self.assertEqual(
+            statements.statement_balances(self.account, second, third),
+            (self.replayed_balance(self.account, first), self.replayed_balance(self.account, third)),
+        )
+        # Four rows on the 2nd and 3rd: a transfer out and in, a bill payment and a deposit
+        with mock.patch.object(statements, "PDF_MAX_ROWS", 4), self.assertNumQueries(1):
+            statements.check_pdf_size(self.account, second, third)
+        with mock.patch.object(statements, "PDF_MAX_ROWS", 3), self.assertRaises(ValueError):
+            statements.check_pdf_size(self.account, second, third)
+
+class FraudScoringTests(TestCase):
+    NOW = 1_800_000_000.0
+
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create(username="fraud", email="fraud@example.com")
+        cls.account = Account.objects.create(user=user, account_number="9301", balance=Decimal("1000.00"))
+
+    def setUp(self):
+        self.scorer = fraud.FraudScorer()
+        self.enterContext(mock.patch.object(fraud, "_scorer", self.scorer))
+
+    def features(self, state, amount, location, confidence=None, now=NOW):
+        return dict(zip(fraud.FEATURES, state.features(now, amount, fraud.location_id(location), confidence)))
+
+    def history(self, *withdrawals):
+        """An account state from ``(seconds ago, amount, location)`` withdrawals."""
+        state = fraud.AccountState()
+        for ago, amount, location in withdrawals:
+            state.add(self.NOW - ago, amount, fraud.location_id(location))
+        return state
+
+    def test_velocity_counts_withdrawals_in_the_window(self):
+        state = self.history((2 * fraud.WINDOW, 10, "ATM 1"), (600, 10, "ATM 1"), (300, 10, "ATM 1"))
+        self.assertEqual(self.features(state, 10, "ATM 1")["velocity"], 2 / fraud.VELOCITY_NORM)
+        self.assertEqual(self.features(fraud.AccountState(), 10, "ATM 1")["velocity"], 0)
+
+    def test_spread_counts_other_locations_in_the_window(self):
+        state = self.history((2 * fraud.WINDOW, 10, "ATM 9"), (600, 10, "ATM 1"), (300, 10, "atm 2 "))
+        self.assertEqual(self.features(state, 10, "ATM 3")["spread"], 2)
+        # Locations are compared case and whitespace insensitively
+        self.assertEqual(self.features(state, 10, "ATM 2")["spread"], 1)
+
+    def test_hop_decays_with_time_since_another_location(self):
+        state = self.history((600, 10, "ATM 1"), (60, 10, "ATM 2"))
+        self.assertAlmostEqual(self.features(state, 10, "ATM 1")["hop"], math.exp(-60 / fraud.HOP_SECONDS))
+        self.assertAlmostEqual(self.features(state, 10, "ATM 2")["hop"], math.exp(-600 / fraud.HOP_SECONDS))
+        self.assertEqual(self.features(self.history((60, 10, "ATM 1")), 10, "ATM 1")["hop"], 0)
+
+    def test_amount_is_a_capped_z_score_once_there_is_history(self):
+        self.assertEqual(self.features(self.history((600, 10, "ATM 1")), 500, "ATM 1")["amount"], 0)
+        state = self.history((3000, 8, "ATM 1"), (2000, 10, "ATM 1"), (1000, 12, "ATM 1"))
+        self.assertAlmostEqual(self.features(state, 14, "ATM 1")["amount"], 2.0)
+        self.assertEqual(self.features(state, 500, "ATM 1")["amount"], fraud.MAX_Z)
+        self.assertEqual(self.features(state, 5, "ATM 1")["amount"], 0)
+
+    def test_low_confidence_needs_a_recent_weak_match_before_an_unusual_withdrawal(self):
+        new = fraud.AccountState()
+        self.assertAlmostEqual(self.features(new, 10, "ATM 1", confidence=0.2)["low_confidence"], 0.6)
+        self.assertEqual(self.features(new, 10, "ATM 1", confidence=0.9)["low_confidence"], 0)
+        usual = self.history((3000, 8, "ATM 1"), (2000, 10, "ATM 1"), (1000, 12, "ATM 1"))
+        self.assertEqual(self.features(usual, 10, "ATM 1", confidence=0.2)["low_confidence"], 0)
+
+        # The scorer only uses a match of the account's user from the last RECOGNITION_MAX_AGE seconds
+        self.scorer.recognized("7", 0.2, now=self.NOW - fraud.RECOGNITION_MAX_AGE - 1)
+        self.assertNotIn("low_confidence", self.scorer.assess(1, 10, "ATM 1", now=self.NOW, user_id="7").reasons)
+        self.scorer.recognized("7", 0.2, now=self.NOW - 10)
+        self.assertIn("low_confidence", self.scorer.assess(1, 10, "ATM 1", now=self.NOW).reasons)
+
+    def test_state_is_capped_to_the_most_recently_used_accounts(self):
+        scorer = fraud.FraudScorer(max_accounts=2)
+        scorer.observe(1, 10, "ATM 1", now=self.NOW)
+        scorer.observe(2, 10, "ATM 1", now=self.NOW)
+        scorer.assess(1, 10, "ATM 1", now=self.NOW)
+        scorer.observe(3, 10, "ATM 1", now=self.NOW)
+        self.assertEqual(list(scorer.accounts), [1, 3])
+        for user_id in ("a", "b", "c"):
+            scorer.recognized(user_id, 0.9, now=self.NOW)
+        self.assertEqual(list(scorer.recognitions), ["b", "c"])
+
+    def hop_between_atms(self):
+        """Recent withdrawals at four ATMs, which score well above the review threshold."""
+        now = time.time()
+        for minutes, location in ((20, "ATM 1"), (15, "ATM 2"), (10, "ATM 3"), (5, "ATM 4")):
+            self.scorer.observe(self.account.pk, 10, location, now=now - 60 * minutes)
+
+    def test_withdrawals_above_the_block_threshold_are_refused(self):
+        self.hop_between_atms()
+        with mock.patch.object(fraud, "BLOCK_THRESHOLD", 0.9), self.assertRaises(ledger.FraudSuspected):
+            ledger.withdraw(self.account.pk, "10.00", "ATM 5")
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal("1000.00"))
+
+        # Without a block threshold the risk is only recorded, and logged for review at INFO
+        with self.assertLogs(fraud.logger, "INFO") as logs:
+            record, _ = ledger.withdraw(self.account.pk, "10.00", "ATM 5")
+        self.assertGreater(record.risk_score, 0.9)
+        self.assertIn(f"INFO:{fraud.logger.name}:Withdrawal of 10.00 at ATM 5", logs.output[0])
+
+    def test_budget_overruns_are_counted_and_logged_once_per_interval(self):
+        scorer = fraud.FraudScorer(budget_ms=-1)
+        with self.assertLogs(fraud.logger, "WARNING") as logs:
+            for _ in range(3):
+                scorer.assess(1, 10, "ATM 1", now=self.NOW)
+        self.assertEqual(scorer.over_budget, 3)
+        self.assertEqual(len(logs.output), 1)
+
+    def test_replay_command_scores_history_oldest_first(self):
+        start = timezone.now() - timedelta(hours=1)
+        for minutes, location in ((0, "ATM 1"), (5, "ATM 2"), (10, "ATM 3"), (15, "ATM 4"), (20, "ATM 5")):
+            record = Withdrawal.objects.create(account=self.account, transaction_type="withdrawal",
+                                               amount=Decimal("10.00"), atm_location=location)
+            Withdrawal.objects.filter(pk=record.pk).update(timestamp=start + timedelta(minutes=minutes))
+        out = StringIO()
+        call_command("replay_fraud_scoring", top=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("Replayed 5 withdrawals"))
+        self.assertIn("Flagged at risk >= ", lines[2])
+        # The last hop, at ATM 5, scores highest
+        self.assertEqual(len(lines), 4)
+        self.assertIn(f"account {self.account.pk}  10.00 at ATM 5", lines[3])
+
+        out = StringIO()
+        call_command("replay_fraud_scoring", since=(timezone.localdate() + timedelta(days=1)).isoformat(), stdout=out)
+        self.assertEqual(out.getvalue(), "No withdrawals to replay.\n")
+        with self.assertRaises(CommandError):
+            call_command("replay_fraud_scoring", since="yesterday")
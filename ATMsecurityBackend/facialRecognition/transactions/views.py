@@ -1,35 +1,241 @@
-from rest_framework import viewsets
+import base64
+import binascii
+import uuid
+from datetime import datetime
+
+from django.core.files.storage import default_storage
+from django.http import FileResponse, StreamingHttpResponse
+from django.urls import reverse
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from . import ledger
 from .models import Account, Transaction, Withdrawal, Deposit, Transfer, BillPayment
+from .permissions import IsAccountHolderOrStaff
+from .statements import check_pdf_size, csv_lines, parse_period, statement_rows
+from .tasks import generate_statement_pdf
 from .serializers import (
     AccountSerializer, TransactionSerializer, WithdrawalSerializer, 
     DepositSerializer, TransferSerializer, BillPaymentSerializer
 )
 
+# Keyset pagination for transaction history
+class TransactionCursorPagination(BasePagination):
+    """
+    Newest first, paged by a cursor on ``(timestamp, id)`` instead of OFFSET:
+    each page is an index range scan (``Transaction.Meta.indexes``) that costs
+    the same at any depth, and no COUNT(*) is run. The ``next`` link carries
+    the cursor; there is no total and no page numbers.
+    """
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    ordering = ("-timestamp", "-id")
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, instance):
+        position = f"{instance.timestamp.isoformat()}|{instance.pk}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split("|")
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            timestamp, pk = cursor
+            # timestamp <= t bounds the index range; the exclude drops ties already served
+            queryset = queryset.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=pk)
+
+        # One extra row tells whether there is a next page
+        rows = list(queryset[:page_size + 1])
+        self.next_cursor = self.encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        return rows[:page_size]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
 class AccountViewSet(viewsets.ModelViewSet):
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
 
+    @action(detail=True, methods=["get"], permission_classes=[IsAccountHolderOrStaff])
+    def statement(self, request, pk=None):
+        """Stream the statement for ``?start=`` to ``?end=`` (YYYY-MM-DD, inclusive) as CSV."""
+        account = self.get_object()
+        try:
+            start, end = parse_period(request.query_params.get("start"), request.query_params.get("end"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(csv_lines(statement_rows(account, start, end)), content_type="text/csv")
+        response["Content-Disposition"] = (
+            f'attachment; filename="statement-{account.account_number}-{start:%Y%m%d}-{end:%Y%m%d}.csv"'
+        )
+        return response
+
+    @action(detail=True, methods=["post"], url_path="statement/pdf", permission_classes=[IsAccountHolderOrStaff])
+    def statement_pdf(self, request, pk=None):
+        """Queue a PDF statement for ``start`` to ``end``; fetch it from the returned ``url`` once ready."""
+        account = self.get_object()
+        try:
+            start, end = parse_period(request.data.get("start"), request.data.get("end"))
+            check_pdf_size(account, start, end)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        statement_id = uuid.uuid4().hex
+        generate_statement_pdf.delay(account.pk, start.isoformat(), end.isoformat(), self.statement_name(account, statement_id))
+        url = reverse("account-statement-pdf-download", kwargs={"pk": account.pk, "statement_id": statement_id})
+        return Response(
+            {"statement": statement_id, "url": request.build_absolute_uri(url)},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @action(detail=True, methods=["get"], url_path=r"statement/pdf/(?P<statement_id>[0-9a-f]{32})",
+            permission_classes=[IsAccountHolderOrStaff])
+    def statement_pdf_download(self, request, pk=None, statement_id=None):
+        account = self.get_object()
+        name = self.statement_name(account, statement_id)
+        if not default_storage.exists(name):
+            return Response({"error": "Statement not found or not ready yet."}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(default_storage.open(name, "rb"), as_attachment=True,
+                            filename=f"statement-{account.account_number}.pdf", content_type="application/pdf")
+
+    @staticmethod
+    def statement_name(account, statement_id):
+        return f"statements/{account.pk}/{statement_id}.pdf"
 
-class TransactionViewSet(viewsets.ModelViewSet):
-    queryset = Transaction.objects.all()
+
+class AccountHolderQuerysetMixin:
+    """Users only see records of their own accounts; staff see all."""
+    permission_classes = [IsAccountHolderOrStaff]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_staff:
+            return queryset
+        return queryset.filter(account__user=self.request.user)
+
+
+class TransactionViewSet(AccountHolderQuerysetMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Transaction history; filter with ``?account=<id>`` for one account's feed.
+    Users only see their own accounts' transactions; staff see all.
+    """
+    queryset = Transaction.objects.with_details()
     serializer_class = TransactionSerializer
+    pagination_class = TransactionCursorPagination
+    filterset_fields = ["account", "transaction_type"]
+
+
+class PostingViewSet(AccountHolderQuerysetMixin, mixins.CreateModelMixin, mixins.ListModelMixin,
+                     mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Operations are created through the ledger, which updates balances, and are
+    never edited or deleted afterwards. Send an ``Idempotency-Key`` header to
+    make retries safe: a repeated key returns the original posting with 200.
+
+    Users only see and post operations of their own account; staff see all.
+    """
+
+    def post_to_ledger(self, data, idempotency_key):
+        """
+        Post the validated ``data`` with this operation's ledger function and
+        return its ``(record, created)``. Every subclass implements this.
+        """
+        raise NotImplementedError
 
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # The account being debited (the sender of a transfer) must be the caller's
+        self.check_object_permissions(request, serializer.validated_data["account"])
+        idempotency_key = request.headers.get("Idempotency-Key") or None
+        if idempotency_key and len(idempotency_key) > 64:
+            return Response({"error": "Idempotency-Key must be at most 64 characters."}, status=status.HTTP_400_BAD_REQUEST)
 
-class WithdrawalViewSet(viewsets.ModelViewSet):
+        try:
+            record, created = self.post_to_ledger(serializer.validated_data, idempotency_key)
+        except ledger.IdempotencyConflict as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except ledger.AccountNotFound as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except ledger.LimitsUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": str(e.retry_after)})
+        except ledger.LedgerError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_serializer(record).data,
+                        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+class WithdrawalViewSet(PostingViewSet):
     queryset = Withdrawal.objects.all()
     serializer_class = WithdrawalSerializer
 
+    def post_to_ledger(self, data, idempotency_key):
+        return ledger.withdraw(data["account"].pk, data["amount"], data["atm_location"], idempotency_key)
+
 
-class DepositViewSet(viewsets.ModelViewSet):
+class DepositViewSet(PostingViewSet):
     queryset = Deposit.objects.all()
     serializer_class = DepositSerializer
 
+    def post_to_ledger(self, data, idempotency_key):
+        return ledger.deposit(data["account"].pk, data["amount"], data["source"], idempotency_key)
 
-class TransferViewSet(viewsets.ModelViewSet):
+
+class TransferViewSet(PostingViewSet):
     queryset = Transfer.objects.all()
     serializer_class = TransferSerializer
 
+    def post_to_ledger(self, data, idempotency_key):
+        return ledger.transfer(data["account"].pk, data["recipient_account"].pk, data["amount"],
+                               data.get("note"), idempotency_key)
+
 
-class BillPaymentViewSet(viewsets.ModelViewSet):
+class BillPaymentViewSet(PostingViewSet):
     queryset = BillPayment.objects.all()
     serializer_class = BillPaymentSerializer
+
+    def post_to_ledger(self, data, idempotency_key):
+        return ledger.pay_bill(data["account"].pk, data["amount"], data["biller_name"], data["biller_account"],
+                               idempotency_key)
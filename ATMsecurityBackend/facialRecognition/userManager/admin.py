@@ -1,23 +1,47 @@
-from django.contrib import admin
+import os
+import uuid
+
+from django import forms
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
+from django.core.files.storage import default_storage
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from .models import CustomUser
+from .tasks import import_users
+
+
+class UserImportForm(forms.Form):
+    sheet = forms.FileField(help_text="CSV or XLSX with email, role, username, first_name, last_name, "
+                                      "phone_number, employee_id and photo columns.")
+    photos = forms.FileField(required=False, help_text="Zip archive of the face photos named in the photo column.")
+    send_emails = forms.BooleanField(required=False, initial=True, label="Send registration emails")
+
+    def clean_sheet(self):
+        sheet = self.cleaned_data["sheet"]
+        if os.path.splitext(sheet.name)[1].lower() not in (".csv", ".xlsx"):
+            raise forms.ValidationError("Upload a .csv or .xlsx file.")
+        return sheet
 
 
 class CustomUserAdmin(UserAdmin):
     model = CustomUser
+    change_list_template = "admin/userManager/customuser/change_list.html"
     list_display = (
         "email",
         "role",
         "is_verified",
         "is_active",
         "is_staff",
+        "face_status",
         "date_joined",
     )
-    list_filter = ("role", "is_verified", "is_active", "is_staff")
+    list_filter = ("role", "is_verified", "is_active", "is_staff", "face_status")
     search_fields = ("email", "employee_id", "phone_number")
     ordering = ("-date_joined",)
-    readonly_fields = ("face_encoding","date_joined", "last_updated")
+    readonly_fields = ("face_encoding", "face_status", "face_error", "date_joined", "last_updated")
 
     fieldsets = (
         ("Account Info", {"fields": ("email", "password")}),
@@ -25,7 +49,7 @@ class CustomUserAdmin(UserAdmin):
         ("Roles & Permissions", {"fields": ("role", "groups", "user_permissions")}),
         ("Status", {"fields": ("is_active", "is_staff", "is_superuser")}),
         ("Timestamps", {"fields": ("date_joined", "last_updated")}),
-        (" Verification details", {"fields": ("registered_face", "face_encoding")}),
+        (" Verification details", {"fields": ("registered_face", "face_status", "face_error", "face_encoding")}),
     )
 
     add_fieldsets = (
@@ -47,6 +71,40 @@ class CustomUserAdmin(UserAdmin):
 
     mark_verified.short_description = "Mark selected users as Verified"
 
+    def get_urls(self):
+        urls = [
+            path("import/", self.admin_site.admin_view(self.import_users_view), name="userManager_customuser_import"),
+        ]
+        return urls + super().get_urls()
+
+    def import_users_view(self, request):
+        """Upload a customer sheet and photo archive and run the import as a background job."""
+        if not self.has_add_permission(request):
+            return redirect("admin:userManager_customuser_changelist")
+
+        form = UserImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            folder = f"imports/{uuid.uuid4()}"
+            sheet = form.cleaned_data["sheet"]
+            sheet_name = default_storage.save(f"{folder}/{os.path.basename(sheet.name)}", sheet)
+            photos = form.cleaned_data["photos"]
+            photos_name = default_storage.save(f"{folder}/photos.zip", photos) if photos else None
+            import_users.delay(sheet_name, photos_name, form.cleaned_data["send_emails"], request.get_host())
+            self.message_user(
+                request,
+                f"Import of {sheet.name} started. Rows that could not be imported will be listed in {folder}/errors.csv.",
+                messages.SUCCESS,
+            )
+            return redirect("admin:userManager_customuser_changelist")
+
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Import users",
+            "form": form,
+        }
+        return TemplateResponse(request, "admin/userManager/customuser/import_users.html", context)
+
     filter_horizontal = ("groups", "user_permissions")
 
 
@@ -0,0 +1,98 @@
+import base64
+import logging
+import struct
+
+import numpy as np
+from django.core.exceptions import ValidationError
+from django.db import models
+
+logger = logging.getLogger(__name__)
+
+# Blob layout: b"FE" magic, format version, model id, then 128 little-endian float32 values
+MAGIC = b"FE"
+FORMAT_VERSION = 1
+MODEL_DLIB_RESNET_V1 = 1
+HEADER = struct.Struct("<2sBB")
+ENCODING_SIZE = 128
+DTYPE = np.dtype("<f4")
+
+
+def encode_face_encoding(encoding, model_id=MODEL_DLIB_RESNET_V1):
+    """Pack a 128-d encoding into a 516-byte blob."""
+    vector = np.asarray(encoding, dtype=DTYPE)
+    if vector.shape != (ENCODING_SIZE,):
+        raise ValueError(f"Face encoding must have {ENCODING_SIZE} values, got shape {vector.shape}")
+    return HEADER.pack(MAGIC, FORMAT_VERSION, model_id) + vector.tobytes()
+
+
+def decode_face_encoding(blob, model_id=MODEL_DLIB_RESNET_V1):
+    """
+    View a stored blob as a read-only float32 array without copying it.
+    Returns ``None`` for blobs written in an unknown format or by another model.
+    """
+    if len(blob) != HEADER.size + ENCODING_SIZE * DTYPE.itemsize:
+        return None
+    magic, version, stored_model = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != FORMAT_VERSION or stored_model != model_id:
+        return None
+    return np.frombuffer(blob, dtype=DTYPE, offset=HEADER.size)
+
+
+class FaceEncodingField(models.BinaryField):
+    """
+    Stores a face encoding as a compact float32 blob (516 bytes instead of
+    ~2.5 KB of JSON text) and loads it back as a NumPy array backed by the
+    database buffer.
+    """
+
+    description = "Face encoding (128 float32 values)"
+
+    def __init__(self, *args, **kwargs):
+        # Unlike a raw BinaryField, encodings are assignable from lists and arrays
+        kwargs.setdefault("editable", True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if kwargs.get("editable") is True:
+            del kwargs["editable"]
+        else:
+            kwargs["editable"] = False
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        vector = decode_face_encoding(value)
+        if vector is None:
+            logger.warning("Ignoring face encoding stored in an unknown format")
+        return vector
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, str):
+            # value_to_string() output, e.g. from dumpdata
+            value = base64.b64decode(value.encode("ascii"))
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            vector = decode_face_encoding(value)
+            if vector is None:
+                raise ValidationError("Invalid face encoding blob.")
+            return vector
+        try:
+            return np.asarray(value, dtype=DTYPE)
+        except (TypeError, ValueError) as e:
+            raise ValidationError(f"Invalid face encoding: {e}")
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value)
+        return encode_face_encoding(value)
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        if value is None:
+            return None
+        return base64.b64encode(self.get_prep_value(value)).decode("ascii")
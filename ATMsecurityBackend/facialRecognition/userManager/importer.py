@@ -0,0 +1,253 @@
+"""
+Streaming user import from a CSV or XLSX sheet and a zip of face photos.
+
+The sheet is read row by row and processed in batches, so memory stays
+bounded however many customers a branch onboards. For each batch the rows
+are validated together (see ``userManager.registration``), face photos are
+read from the zip archive one at a time and encoded in a process pool (or in
+this process with ``workers=0``, as Celery prefork workers must), and the
+users that passed are inserted in one transaction. Rows that fail are
+collected in a per-row error report instead of aborting the import; so are
+rows that collide with users registered concurrently, which the database
+rejects after validation passed. Face photos are stored only for the rows
+being inserted and deleted again if the insert fails.
+
+Columns: ``email`` and ``role`` (required), ``username``, ``first_name``,
+``last_name``, ``phone_number``, ``employee_id`` and ``photo``, the path of the
+user's face photo inside the zip archive.
+"""
+import csv
+import hashlib
+import io
+import logging
+import os
+import zipfile
+from dataclasses import dataclass, field
+from itertools import islice
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+
+from recognition.gallery import publish_rebuild
+from recognition.inference import FaceInferenceService, InferenceUnavailable, describe_enrolment
+from .models import CustomUser
+from .registration import build_user, insert_users, queue_registration_emails, registration_message, validate_rows
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = getattr(settings, "USER_IMPORT_BATCH_SIZE", 500)
+WORKERS = getattr(settings, "USER_IMPORT_WORKERS", os.cpu_count() or 1)
+ROW_KEY = "row"
+PHOTO_KEY = "photo"
+# Inserts tried per batch; each failed one re-validates the rows against users created meanwhile
+INSERT_ATTEMPTS = 2
+
+
+def read_csv(file):
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    for line, row in enumerate(csv.DictReader(text), start=2):
+        yield line, {(key or "").strip().lower(): (value or "").strip() for key, value in row.items()}
+
+
+def read_xlsx(file):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Reading .xlsx files requires openpyxl (pip install openpyxl).")
+
+    # read_only streams rows instead of loading the whole workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell or "").strip().lower() for cell in next(rows, ())]
+        for line, values in enumerate(rows, start=2):
+            if not any(value not in (None, "") for value in values):
+                continue
+            yield line, {
+                key: "" if value is None else str(value).strip()
+                for key, value in zip(header, values) if key
+            }
+    finally:
+        workbook.close()
+
+
+def read_rows(file, name):
+    """Yield ``(line_number, row)`` from a CSV or XLSX file object."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".csv":
+        return read_csv(file)
+    if extension == ".xlsx":
+        return read_xlsx(file)
+    raise ValueError(f"Unsupported sheet format {extension!r}: use .csv or .xlsx.")
+
+
+@dataclass
+class ImportReport:
+    created: int = 0
+    with_face: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, row, errors):
+        self.errors.append({"row": row.get(ROW_KEY), "email": row.get("email", ""), "errors": errors})
+
+    def write_csv(self, file):
+        writer = csv.writer(file)
+        writer.writerow(["row", "email", "errors"])
+        for error in self.errors:
+            writer.writerow([error["row"], error["email"], format_errors(error["errors"])])
+
+
+def format_errors(errors):
+    if isinstance(errors, dict):
+        return "; ".join(f"{name}: {' '.join(str(message) for message in messages)}" for name, messages in errors.items())
+    return str(errors)
+
+
+class UserImport:
+    """
+    Import users from ``sheet`` (a binary file object named ``sheet_name``)
+    with face photos from the zip archive ``photos`` (a path or binary file
+    object, optional). ``domain`` is used for the password reset links in the
+    registration emails; pass ``send_emails=False`` to skip them.
+    """
+
+    def __init__(self, sheet, sheet_name, photos=None, batch_size=BATCH_SIZE, workers=WORKERS,
+                 send_emails=True, domain=None):
+        self.sheet = sheet
+        self.sheet_name = sheet_name
+        self.photos = photos
+        self.batch_size = batch_size
+        self.send_emails = send_emails
+        self.domain = domain or settings.SITE_DOMAIN
+        # A bounded pool: submitting blocks once every worker is busy and a few photos are queued
+        self.service = FaceInferenceService(
+            workers=workers,
+            queue_size=2 * workers,
+            timeout=getattr(settings, "FACE_INFERENCE_TIMEOUT", 10),
+        )
+        self.report = ImportReport()
+
+    def run(self):
+        archive = zipfile.ZipFile(self.photos) if self.photos is not None else None
+        try:
+            rows = read_rows(self.sheet, self.sheet_name)
+            while True:
+                batch = []
+                for line, row in islice(rows, self.batch_size):
+                    row[ROW_KEY] = line
+                    batch.append(row)
+                if not batch:
+                    break
+                self.import_batch(batch, archive)
+                logger.info(
+                    f"User import: {self.report.created} created, "
+                    f"{len(self.report.errors)} rejected so far"
+                )
+        finally:
+            if archive is not None:
+                archive.close()
+            self.service.close()
+        return self.report
+
+    def import_batch(self, batch, archive):
+        rows, errors = validate_rows(batch)
+        for error in errors:
+            self.report.add_error(error["data"], error["errors"])
+
+        faces = self.encode_faces(rows, archive)
+        accepted = [(row, data) for row, data in rows if row[ROW_KEY] in faces or not row.get(PHOTO_KEY)]
+
+        for attempt in range(INSERT_ATTEMPTS):
+            if attempt:
+                # Users created since validation took some emails or employee ids: report those rows
+                accepted, errors = validate_rows([row for row, _ in accepted])
+                for error in errors:
+                    self.report.add_error(error["data"], error["errors"])
+            if not accepted:
+                return
+            try:
+                users = self.insert(accepted, faces, archive)
+            except IntegrityError as e:
+                logger.warning(f"User import: inserting {len(accepted)} rows failed: {e}")
+                continue
+            self.report.created += len(users)
+            self.report.with_face += sum(1 for user in users if user.face_encoding is not None)
+            return
+
+        for row, _ in accepted:
+            self.report.add_error(row, "Could not be inserted; another registration changed the same users.")
+
+    def insert(self, rows, faces, archive):
+        """
+        Store the photos and insert the users of ``rows`` in one transaction;
+        the stored photos are deleted again if the insert fails.
+        """
+        users, stored = [], []
+        try:
+            for row, data in rows:
+                user = build_user(data)
+                face = faces.get(row[ROW_KEY])
+                if face is not None:
+                    name, image_hash, encoding = face
+                    stored.append(default_storage.save(f"faces/{os.path.basename(name)}", ContentFile(archive.read(name))))
+                    user.registered_face = stored[-1]
+                    user.face_image_hash, user.face_encoding = image_hash, encoding
+                    user.face_status = CustomUser.FACE_READY
+                users.append(user)
+
+            with transaction.atomic():
+                insert_users(users)
+                if stored:
+                    # One gallery rebuild per batch rather than a change per enrolled user
+                    transaction.on_commit(publish_rebuild)
+                if self.send_emails:
+                    messages = [registration_message(self.domain, user) for user in users]
+                    transaction.on_commit(lambda: queue_registration_emails(messages))
+        except BaseException:
+            for name in stored:
+                default_storage.delete(name)
+            raise
+        return users
+
+    def encode_faces(self, rows, archive):
+        """
+        Encode the photo of every row that names one. Returns
+        ``{row number: (name in the archive, image hash, encoding)}``; rows
+        whose photo is missing or unusable are reported and left out. Nothing
+        is stored yet.
+        """
+        jobs = []
+        for row, _ in rows:
+            name = row.get(PHOTO_KEY)
+            if not name:
+                continue
+            if archive is None:
+                self.report.add_error(row, {PHOTO_KEY: ["No photo archive was provided."]})
+                continue
+            try:
+                image_data = archive.read(name)
+            except KeyError:
+                self.report.add_error(row, {PHOTO_KEY: [f"{name} is not in the photo archive."]})
+                continue
+            try:
+                future = self.service.submit(describe_enrolment, image_data, wait=self.service.timeout)
+            except InferenceUnavailable as e:
+                self.report.add_error(row, {PHOTO_KEY: [str(e)]})
+                continue
+            jobs.append((row, name, future))
+
+        faces = {}
+        for row, name, future in jobs:
+            try:
+                error, encoding = self.service.result(future)
+            except Exception as e:
+                error = f"Error processing face image: {e}"
+            if error is not None:
+                self.report.add_error(row, {PHOTO_KEY: [error]})
+                continue
+            # Read the photo again rather than holding a whole batch of images in memory
+            image_data = archive.read(name)
+            faces[row[ROW_KEY]] = (name, hashlib.sha256(image_data).hexdigest(), encoding)
+        return faces
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from userManager.importer import BATCH_SIZE, WORKERS, UserImport
+
+
+class Command(BaseCommand):
+    help = (
+        "Import users from a CSV or XLSX sheet, with face photos from a zip archive, "
+        "and write a per-row error report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("sheet", help="CSV or XLSX file with one user per row.")
+        parser.add_argument("--photos", help="Zip archive with the face photos named in the 'photo' column.")
+        parser.add_argument("--report", help="Write the per-row error report (CSV) here instead of stdout.")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows committed per transaction.")
+        parser.add_argument("--workers", type=int, default=WORKERS,
+                            help="Processes encoding face photos (0 = encode in this process).")
+        parser.add_argument("--domain", help="Domain for password reset links (defaults to SITE_DOMAIN).")
+        parser.add_argument("--no-email", action="store_true", help="Do not send registration emails.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            with open(options["sheet"], "rb") as sheet:
+                report = UserImport(
+                    sheet,
+                    options["sheet"],
+                    options["photos"],
+                    batch_size=options["batch_size"],
+                    workers=options["workers"],
+                    send_emails=not options["no_email"],
+                    domain=options["domain"],
+                ).run()
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if report.errors:
+            if options["report"]:
+                with open(options["report"], "w", newline="") as f:
+                    report.write_csv(f)
+            else:
+                report.write_csv(self.stdout)
+
+        message = (
+            f"Imported {report.created} users ({report.with_face} with a face), "
+            f"rejected {len(report.errors)} rows in {time.perf_counter() - started:.1f}s"
+        )
+        if report.errors and options["report"]:
+            message += f"; errors written to {options['report']}"
+        self.stdout.write(self.style.SUCCESS(message) if not report.errors else self.style.WARNING(message))
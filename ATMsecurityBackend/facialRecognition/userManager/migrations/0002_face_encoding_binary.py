@@ -0,0 +1,74 @@
+import logging
+
+import userManager.fields
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def json_to_blob(apps, schema_editor):
+    """Copy every JSON face encoding into the float32 blob column."""
+    CustomUser = apps.get_model("userManager", "CustomUser")
+    users = CustomUser.objects.filter(face_encoding__isnull=False).only("id", "face_encoding")
+    batch = []
+    dropped = []
+    for user in users.iterator(chunk_size=BATCH_SIZE):
+        try:
+            user.face_encoding_blob = userManager.fields.encode_face_encoding(user.face_encoding)
+        except (TypeError, ValueError):
+            dropped.append(str(user.id))  # Cannot be converted; the user has to re-enrol
+            continue
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            CustomUser.objects.bulk_update(batch, ["face_encoding_blob"])
+            batch = []
+    if batch:
+        CustomUser.objects.bulk_update(batch, ["face_encoding_blob"])
+    if dropped:
+        logger.warning(
+            f"{len(dropped)} users had a malformed face encoding and are no longer enrolled; "
+            f"they need to re-register their face: {', '.join(dropped)}"
+        )
+
+
+def blob_to_json(apps, schema_editor):
+    CustomUser = apps.get_model("userManager", "CustomUser")
+    users = CustomUser.objects.filter(face_encoding_blob__isnull=False).only("id", "face_encoding_blob")
+    batch = []
+    for user in users.iterator(chunk_size=BATCH_SIZE):
+        if user.face_encoding_blob is None:
+            continue
+        user.face_encoding = [float(value) for value in user.face_encoding_blob]
+        batch.append(user)
+        if len(batch) >= BATCH_SIZE:
+            CustomUser.objects.bulk_update(batch, ["face_encoding"])
+            batch = []
+    if batch:
+        CustomUser.objects.bulk_update(batch, ["face_encoding"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userManager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='face_encoding_blob',
+            field=userManager.fields.FaceEncodingField(blank=True, null=True),
+        ),
+        migrations.RunPython(json_to_blob, blob_to_json),
+        migrations.RemoveField(
+            model_name='customuser',
+            name='face_encoding',
+        ),
+        migrations.RenameField(
+            model_name='customuser',
+            old_name='face_encoding_blob',
+            new_name='face_encoding',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:42
+
+from django.db import migrations, models
+
+
+def mark_enrolled_ready(apps, schema_editor):
+    """Users enrolled before enrolment moved to Celery already have their encoding."""
+    CustomUser = apps.get_model("userManager", "CustomUser")
+    CustomUser.objects.filter(face_encoding__isnull=False).update(face_status="ready")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userManager', '0002_face_encoding_binary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='face_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='face_image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='face_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=10, null=True),
+        ),
+        migrations.RunPython(mark_enrolled_ready, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,14 @@
 import os
 from django.contrib.auth.models import AbstractUser, BaseUserManager, PermissionsMixin, Group
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DEFERRED
 import uuid
-from django.db.models.signals import post_save
-from django.dispatch import receiver
-import dlib
-import numpy as np
-from PIL import Image
-from rest_framework import serializers
+from django.dispatch import Signal
 from rest_framework.exceptions import ValidationError
 from django.core import validators
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import gettext_lazy as _
+from .fields import FaceEncodingField
 
 
 
@@ -29,6 +26,14 @@ class CustomUser(AbstractUser, PermissionsMixin):
         ("staff", "Staff"),
         ("admin", "Admin"),
     ]
+    FACE_PENDING = "pending"
+    FACE_READY = "ready"
+    FACE_FAILED = "failed"
+    FACE_STATUS_CHOICES = [
+        (FACE_PENDING, "Pending"),
+        (FACE_READY, "Ready"),
+        (FACE_FAILED, "Failed"),
+    ]
     username_validator = UnicodeUsernameValidator()
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -53,7 +58,11 @@ class CustomUser(AbstractUser, PermissionsMixin):
     registered_face = models.ImageField(
         upload_to="faces/", blank=True, null=True
     )  # Used for facial recognition authentication
-    face_encoding = models.JSONField(blank=True, null=True)  # Store face encoding as JSON
+    face_encoding = FaceEncodingField(blank=True, null=True)  # Store face encoding as a float32 blob
+    # Enrolment of registered_face runs in a Celery task (userManager.tasks.enrol_face)
+    face_status = models.CharField(max_length=10, choices=FACE_STATUS_CHOICES, blank=True, null=True)
+    face_image_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)  # SHA-256 of the enrolled image
+    face_error = models.TextField(blank=True, null=True)
 
     # Staff-specific fields
     employee_id = models.CharField(max_length=20, unique=True, blank=True, null=True)
@@ -77,71 +86,72 @@ class CustomUser(AbstractUser, PermissionsMixin):
     def is_admin(self):
         return self.role == "admin"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored role and face image so save() only reacts when they change
+        instance._saved_role = instance.__dict__.get("role", DEFERRED)
+        instance._saved_face = instance.__dict__.get("registered_face", DEFERRED)
+        return instance
+
+    def _writes_new_face(self, update_fields):
+        """Whether this save writes a different registered face file, or new content for it."""
+        if "registered_face" not in self.__dict__:
+            return False  # Deferred and untouched
+        if update_fields is not None and "registered_face" not in update_fields:
+            return False
+        face = self.registered_face
+        saved_face = getattr(self, "_saved_face", DEFERRED)
+        return self._state.adding or not face._committed or saved_face is DEFERRED or face.name != saved_face
+
     def save(self, *args, **kwargs):
-        """Override save method to dynamically assign groups."""
-        super().save(*args, **kwargs)  # Save user first
-
-        # Ensure role has a corresponding group
-        if self.role:
-            group, _ = Group.objects.get_or_create(name=self.role)  # Create if not exists
-            self.groups.set([group])  # Assign user to their respective group
-
-        # Assign is_staff automatically for admin users
-        if self.role == "admin":
-            self.is_staff = True
-            self.is_superuser = True
-        elif self.role == "staff":
-            self.is_staff = True
-        else:
-            self.is_staff = False
-
-        super().save(*args, **kwargs)  # Save user again after setting groups
-# Paths to Dlib models
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-SHAPE_PREDICTOR_PATH = os.path.join(BASE_DIR, "dlib" , "shape_predictor_68_face_landmarks.dat")
-FACE_RECOGNITION_MODEL_PATH = os.path.join(BASE_DIR, "dlib" , "dlib_face_recognition_resnet_model_v1.dat")
-
-# Ensure required model files exist
-for path in [SHAPE_PREDICTOR_PATH, FACE_RECOGNITION_MODEL_PATH]:
-    if not os.path.exists(path):
-        raise RuntimeError(f"Missing file: {path}")
-
-# Load Dlib models globally
-face_detector = dlib.get_frontal_face_detector()
-shape_predictor = dlib.shape_predictor(SHAPE_PREDICTOR_PATH)
-face_rec_model = dlib.face_recognition_model_v1(FACE_RECOGNITION_MODEL_PATH)
-# ======================== FACE ENCODING FUNCTION ========================
-def get_face_encoding(image):
-    """Extracts face encoding using dlib"""
-    try:
-        img = Image.open(image).convert("RGB")
-        img_array = np.array(img)
-        detections = face_detector(img_array)
-
-        if len(detections) == 0:
-            raise serializers.ValidationError("No face detected in the image.")
-        elif len(detections) > 1:
-            raise serializers.ValidationError("Multiple faces detected. Please upload a clear image with one face.")
-
-        shape = shape_predictor(img_array, detections[0])
-        encoding = np.array(face_rec_model.compute_face_descriptor(img_array, shape))
-
-        return encoding.tolist()  # Store as JSON-friendly format
-    except Exception as e:
-        raise serializers.ValidationError(f"Error processing face image: {str(e)}")
-@receiver(post_save, sender=CustomUser)
-def assign_user_group(sender, instance, created, **kwargs):
-    """Assign user to a group based on their role after creation"""
-    if created and instance.role:
-        group, _ = Group.objects.get_or_create(name=instance.role)
-        instance.groups.set([group])  # Assign user to their respective group
-@receiver(post_save, sender=CustomUser)
-def generate_face_encoding(sender, instance, **kwargs):
-    """Auto-generate Face encoding only if the image is modified"""
-    if instance.registered_face:
-        # Load face encoding
-        encoding = get_face_encoding(instance.registered_face)
-
-        # Prevent recursive save by updating the field directly
-        CustomUser.objects.filter(id=instance.id).update(face_encoding=encoding)
\ No newline at end of file
+        """Override save method to derive staff flags and assign the role's group."""
+        update_fields = kwargs.get("update_fields")
+        writes_role = "role" in self.__dict__ and (update_fields is None or "role" in update_fields)
+        saved_role = getattr(self, "_saved_role", None)
+        role_changed = writes_role and (self._state.adding or saved_role is DEFERRED or self.role != saved_role)
+
+        if writes_role:
+            # Assign is_staff automatically for admin users, in the same write as the role
+            if self.role == "admin":
+                self.is_staff = True
+                self.is_superuser = True
+            elif self.role == "staff":
+                self.is_staff = True
+            else:
+                self.is_staff = False
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "is_staff", "is_superuser"}
+
+        # Read by the post_save receiver that schedules face enrolment
+        self._new_face = self._writes_new_face(update_fields)
+        super().save(*args, **kwargs)
+        if "registered_face" in self.__dict__:
+            self._saved_face = self.registered_face.name
+
+        if role_changed:
+            if self.role:
+                self.groups.set([role_group(self.role)])  # Assign user to their respective group
+            self._saved_role = self.role
+
+
+_role_groups = {}
+
+
+def role_group(role):
+    """The Group named after ``role``, created if missing and cached per process."""
+    group_id = _role_groups.get(role)
+    if group_id is not None:
+        return group_id
+    group, _ = Group.objects.get_or_create(name=role)  # Create if not exists
+    # Only cache committed groups, so a rolled-back transaction cannot leave a dangling id behind
+    transaction.on_commit(lambda: _role_groups.setdefault(role, group.pk))
+    return group.pk
+
+
+def forget_role_groups():
+    _role_groups.clear()
+
+
+# Sent after a face encoding is written with QuerySet.update(), which bypasses post_save
+face_encoding_updated = Signal()
@@ -0,0 +1,161 @@
+"""
+Bulk user registration for ``UserViewSet.mass_register``.
+
+Registering users one by one through ``CustomRegisterSerializer`` costs an
+``exists()`` query, several saves, a group lookup and a Celery message per
+user. Here a whole batch is validated up front with one query per
+uniqueness check, users, e-mail addresses and group memberships are
+bulk-inserted in one transaction, and the registration emails go out as
+chunked Celery tasks once it commits. New users get an unusable password:
+nobody is ever told a generated one, so they set theirs through the emailed
+reset link, and nothing has to be hashed.
+"""
+import logging
+
+from allauth.account.models import EmailAddress
+from celery import group
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.auth.tokens import default_token_generator
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.urls import reverse
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from .models import CustomUser
+from .serializers import MassRegisterUserSerializer
+from .tasks import send_mass_registration_emails
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+# Keeps IN (...) lists below SQLite's bound-parameter limit
+LOOKUP_CHUNK_SIZE = 5000
+EMAIL_CHUNK_SIZE = getattr(settings, "MASS_REGISTER_EMAIL_CHUNK_SIZE", 200)
+
+
+def _existing(field, values, lower=False):
+    """
+    Values of ``field`` among ``values`` that already belong to a user. With
+    ``lower`` both sides are compared lowercased and lowercased values returned.
+    """
+    queryset = CustomUser.objects.all()
+    lookup = field
+    if lower:
+        lookup = f"{field}_lower"
+        queryset = queryset.annotate(**{lookup: Lower(field)})
+        values = (value.lower() for value in values)
+    values = list(values)
+    found = set()
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        chunk = values[start:start + LOOKUP_CHUNK_SIZE]
+        found.update(queryset.filter(**{f"{lookup}__in": chunk}).values_list(lookup, flat=True))
+    return found
+
+
+def validate_rows(users_data):
+    """
+    Split the submitted rows into ``(row, validated_data)`` pairs and
+    ``{"data", "errors"}`` entries, checking emails and employee ids against
+    the database and against each other.
+    """
+    valid, errors = [], []
+    for user_data in users_data:
+        serializer = MassRegisterUserSerializer(data=user_data)
+        if serializer.is_valid():
+            valid.append((user_data, serializer.validated_data))
+        else:
+            errors.append({"data": user_data, "errors": serializer.errors})
+
+    taken_emails = _existing("email", (data["email"] for _, data in valid), lower=True)
+    taken_employee_ids = _existing("employee_id", (data["employee_id"] for _, data in valid if data.get("employee_id")))
+
+    rows, seen_emails, seen_employee_ids = [], set(), set()
+    for user_data, data in valid:
+        email = data["email"].lower()
+        employee_id = data.get("employee_id")
+        if email in taken_emails or email in seen_emails:
+            errors.append({"data": user_data, "errors": {"email": ["A user with this email already exists."]}})
+        elif employee_id and (employee_id in taken_employee_ids or employee_id in seen_employee_ids):
+            errors.append({"data": user_data, "errors": {"employee_id": ["A user with this employee id already exists."]}})
+        else:
+            seen_emails.add(email)
+            if employee_id:
+                seen_employee_ids.add(employee_id)
+            rows.append((user_data, data))
+    return rows, errors
+
+
+def build_user(data):
+    role = data["role"]
+    user = CustomUser(
+        email=data["email"],
+        # Same default as single registration: the local part of the email
+        username=data.get("username") or data["email"].split("@")[0],
+        role=role,
+        phone_number=data.get("phone_number") or None,
+        employee_id=data.get("employee_id") or None,
+        first_name=data.get("first_name", ""),
+        last_name=data.get("last_name", ""),
+        # What CustomUser.save() would derive from the role
+        is_staff=role in ("admin", "staff"),
+        is_superuser=role == "admin",
+    )
+    user.set_unusable_password()
+    return user
+
+
+def insert_users(users):
+    """
+    Bulk-insert ``users`` with their role group memberships and allauth email
+    addresses. bulk_create skips save() and post_save, so this stands in for
+    ``CustomUser.save()`` and registration. Run it inside a transaction.
+    """
+    CustomUser.objects.bulk_create(users, batch_size=BATCH_SIZE)
+    groups = {role: Group.objects.get_or_create(name=role)[0] for role in {user.role for user in users}}
+    Membership = CustomUser.groups.through
+    Membership.objects.bulk_create(
+        [Membership(customuser_id=user.pk, group_id=groups[user.role].pk) for user in users],
+        batch_size=BATCH_SIZE,
+    )
+    EmailAddress.objects.bulk_create(
+        [EmailAddress(user=user, email=user.email.lower(), primary=True, verified=False) for user in users],
+        batch_size=BATCH_SIZE,
+    )
+
+
+def bulk_register(users_data, request):
+    """Register every valid row; returns ``(users, errors)`` with the created ``CustomUser`` instances."""
+    rows, errors = validate_rows(users_data)
+    if not rows:
+        return [], errors
+
+    users = [build_user(data) for _, data in rows]
+
+    with transaction.atomic():
+        insert_users(users)
+        messages = [registration_message(request.get_host(), user) for user in users]
+        transaction.on_commit(lambda: queue_registration_emails(messages))
+
+    logger.info(f"Mass registration created {len(users)} users, rejected {len(errors)} rows")
+    return users, errors
+
+
+def registration_message(domain, user):
+    """``(email, context)`` for the registration email, as built by ``CustomRegisterSerializer``."""
+    uid = urlsafe_base64_encode(force_bytes(user.pk))
+    token = default_token_generator.make_token(user)
+    reset_password_link = f"http://{domain}{reverse('password_reset_confirm', kwargs={'uidb64': uid, 'token': token})}"
+    return user.email, {
+        "user": {"email": user.email, "first_name": user.first_name, "last_name": user.last_name},
+        "reset_password_link": reset_password_link,
+        "sitename": settings.SITENAME,
+    }
+
+
+def queue_registration_emails(messages):
+    if not messages:
+        return
+    chunks = [messages[i:i + EMAIL_CHUNK_SIZE] for i in range(0, len(messages), EMAIL_CHUNK_SIZE)]
+    group(send_mass_registration_emails.s(chunk) for chunk in chunks).apply_async()
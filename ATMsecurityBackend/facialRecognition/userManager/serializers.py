@@ -88,6 +88,24 @@ class CustomRegisterSerializer(RegisterSerializer):
         return user
 
 
+class MassRegisterUserSerializer(serializers.Serializer):
+    """
+    Field validation for one row of a mass registration. Uniqueness is
+    checked for the whole batch at once by ``userManager.registration``.
+    """
+    email = serializers.EmailField()
+    role = serializers.ChoiceField(choices=CustomUser.ROLE_CHOICES)
+    username = serializers.CharField(required=False, allow_blank=True, max_length=150,
+                                     validators=[CustomUser.username_validator])
+    phone_number = serializers.CharField(required=False, allow_blank=True, max_length=15)
+    employee_id = serializers.CharField(required=False, allow_blank=True, max_length=20)
+    first_name = serializers.CharField(required=False, allow_blank=True, max_length=150)
+    last_name = serializers.CharField(required=False, allow_blank=True, max_length=150)
+
+    def validate_email(self, value):
+        return CustomUser.objects.normalize_email(value)
+
+
 # ======================== USER UPDATE ========================
 class UserUpdateSerializer(serializers.ModelSerializer):
     """Serializer for updating user details"""
@@ -97,6 +115,7 @@ class UserUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = "__all__"
+        read_only_fields = ["face_status", "face_image_hash", "face_error"]
         extra_kwargs = {
             'password': {'write_only': True},
         }
@@ -120,7 +139,7 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = "__all__"
-        read_only_fields = ["id", "role", "date_joined", "is_verified"]
+        read_only_fields = ["id", "role", "date_joined", "is_verified", "face_status", "face_image_hash", "face_error"]
         extra_kwargs = {
             'password': {'write_only': True},
             'face_encoding': {'write_only': True},
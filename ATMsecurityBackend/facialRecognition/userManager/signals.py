@@ -1,10 +1,20 @@
-from django.db.models.signals import post_migrate, post_save, pre_save
+import logging
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import Group
 from django.conf import settings
-from .models import CustomUser
+from .models import CustomUser, forget_role_groups
+from .tasks import enrol_face, hash_face_image
 from django.contrib.sites.models import Site
 
+logger = logging.getLogger(__name__)
+
+@receiver(post_migrate)
+def reset_role_groups_after_migrate(sender, **kwargs):
+    """``flush`` empties tables without delete signals, then runs post_migrate (and create_admin below)."""
+    forget_role_groups()
+
 @receiver(post_migrate)
 def update_default_site(sender, **kwargs):
     """
@@ -46,4 +56,43 @@ def create_default_user_groups(sender, **kwargs):
         for role in role_names:
             group, created = Group.objects.get_or_create(name=role)
             if created:
-                print(f"Created missing group: {role}")  # Debugging log
\ No newline at end of file
+                print(f"Created missing group: {role}")  # Debugging log
+
+@receiver(post_save, sender=CustomUser)
+def schedule_face_enrolment(sender, instance, update_fields=None, **kwargs):
+    """
+    Queue face enrolment when a save writes a new registered face file, once per
+    distinct image content; content whose last enrolment failed is tried again.
+    """
+    if not getattr(instance, "_new_face", False):
+        if update_fields is None and instance.face_status == CustomUser.FACE_PENDING and instance.face_image_hash:
+            # A full save may have written back the pending state of an enrolment that finished
+            # since the instance was loaded; the task drops the job if the enrolment still stands
+            queue_face_enrolment(instance.pk, instance.face_image_hash)
+        return
+    if not instance.registered_face:
+        return
+    try:
+        image_hash = hash_face_image(instance.registered_face)
+    except OSError as e:
+        logger.warning(f"Could not read registered face of user {instance.pk}: {e}")
+        return
+    if image_hash == instance.face_image_hash and instance.face_status != CustomUser.FACE_FAILED:
+        return  # Same content as last time: already enrolled or queued
+
+    CustomUser.objects.filter(pk=instance.pk).update(
+        face_image_hash=image_hash, face_status=CustomUser.FACE_PENDING, face_error=None
+    )
+    instance.face_image_hash, instance.face_status, instance.face_error = image_hash, CustomUser.FACE_PENDING, None
+    queue_face_enrolment(instance.pk, image_hash)
+
+
+def queue_face_enrolment(user_id, image_hash):
+    user_id = str(user_id)
+    transaction.on_commit(lambda: enrol_face.delay(user_id, image_hash))
+
+
+@receiver([post_save, post_delete], sender=Group)
+def reset_role_group_cache(sender, **kwargs):
+    """Role group ids are cached per process; drop them when a group is renamed or deleted."""
+    forget_role_groups()
@@ -1,20 +1,143 @@
+import hashlib
+import io
+import logging
+import os
+
 from celery import shared_task
-from django.core.mail import EmailMultiAlternatives
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template.loader import render_to_string
 
-@shared_task
-def send_mass_registration_email(user_email, context):
-    """Send an email with a password reset link."""
-    
+from recognition.inference import describe_enrolment
+from .models import CustomUser, face_encoding_updated
+
+logger = logging.getLogger(__name__)
+
+def registration_email(user_email, context):
     subject = f"Your Account Has Been Created on {context['sitename']} - Reset Your Password"
     from_email = f"no-reply@{context['sitename'].lower()}.com"
-    
+
     # Render email template
     html_message = render_to_string("emails/registration_email.html", context)
 
     # Create email
     email = EmailMultiAlternatives(subject, "", from_email, [user_email])
     email.attach_alternative(html_message, "text/html")
-    
-    # Send email
-    email.send()
+    return email
+
+
+@shared_task
+def send_mass_registration_email(user_email, context):
+    """Send an email with a password reset link."""
+    registration_email(user_email, context).send()
+
+
+@shared_task
+def send_mass_registration_emails(messages):
+    """Send a chunk of ``(email, context)`` registration emails over one SMTP connection."""
+    with get_connection() as connection:
+        connection.send_messages([registration_email(user_email, context) for user_email, context in messages])
+
+
+# ======================== FACE ENROLMENT ========================
+# Held while one worker encodes an image so duplicate jobs for the same content wait for it
+ENROLMENT_LOCK_KEY = "userManager:enrolment:{}"
+ENROLMENT_LOCK_TIMEOUT = 5 * 60
+
+
+def hash_face_image(image):
+    """SHA-256 of an uploaded or stored image file's content."""
+    digest = hashlib.sha256()
+    image.open("rb")
+    try:
+        for chunk in image.chunks():
+            digest.update(chunk)
+    finally:
+        image.seek(0)
+    return digest.hexdigest()
+
+
+@shared_task(bind=True, max_retries=12, default_retry_delay=5)
+def enrol_face(self, user_id, image_hash):
+    """
+    Compute the face encoding for the image a user registered, at most once per
+    distinct image: a job whose image was replaced in the meantime is dropped,
+    and an encoding already computed for the same content is reused.
+    """
+    user = CustomUser.objects.filter(id=user_id, face_image_hash=image_hash).only(
+        "id", "registered_face", "face_status"
+    ).first()
+    if user is None or user.face_status != CustomUser.FACE_PENDING:
+        return  # Superseded by a newer image, or already handled
+
+    lock = ENROLMENT_LOCK_KEY.format(image_hash)
+    if not cache.add(lock, user_id, ENROLMENT_LOCK_TIMEOUT):
+        # Someone is encoding this exact image right now; pick up their result afterwards
+        raise self.retry()
+    try:
+        encoding = (
+            CustomUser.objects.filter(face_image_hash=image_hash, face_status=CustomUser.FACE_READY)
+            .exclude(face_encoding=None)
+            .values_list("face_encoding", flat=True)
+            .first()
+        )
+        error = None
+        if encoding is None:
+            try:
+                user.registered_face.open("rb")
+                try:
+                    image_data = user.registered_face.read()
+                finally:
+                    user.registered_face.close()
+                error, encoding = describe_enrolment(image_data)
+            except Exception as e:
+                if self.request.retries < self.max_retries:
+                    logger.warning(f"Face enrolment for user {user_id} failed, retrying: {e}")
+                    raise self.retry(exc=e, countdown=30)
+                error = f"Error processing face image: {e}"
+    finally:
+        cache.delete(lock)
+
+    pending = CustomUser.objects.filter(id=user_id, face_image_hash=image_hash, face_status=CustomUser.FACE_PENDING)
+    if error is not None:
+        pending.update(face_status=CustomUser.FACE_FAILED, face_error=error)
+        return
+    if pending.update(face_encoding=encoding, face_status=CustomUser.FACE_READY, face_error=None):
+        user.face_encoding = encoding
+        face_encoding_updated.send(sender=CustomUser, instance=user)
+
+
+# ======================== USER IMPORT ========================
+@shared_task
+def import_users(sheet_name, photos_name=None, send_emails=True, domain=None):
+    """
+    Run a user import from files previously saved to the default storage and
+    store its per-row error report next to the sheet. Photos are encoded in
+    this process unless ``USER_IMPORT_TASK_WORKERS`` says otherwise.
+    """
+    from .importer import UserImport
+
+    workers = getattr(settings, "USER_IMPORT_TASK_WORKERS", 0)
+    photos = default_storage.open(photos_name, "rb") if photos_name else None
+    try:
+        with default_storage.open(sheet_name, "rb") as sheet:
+            report = UserImport(
+                sheet, sheet_name, photos, workers=workers, send_emails=send_emails, domain=domain
+            ).run()
+    finally:
+        if photos is not None:
+            photos.close()
+
+    output = io.StringIO()
+    report.write_csv(output)
+    report_name = default_storage.save(
+        f"{os.path.dirname(sheet_name)}/errors.csv", ContentFile(output.getvalue().encode("utf-8"))
+    )
+    logger.info(
+        f"User import of {sheet_name} finished: {report.created} created "
+        f"({report.with_face} with a face), {len(report.errors)} rejected, report at {report_name}"
+    )
+    return {"created": report.created, "with_face": report.with_face, "rejected": len(report.errors), "report": report_name}
@@ -1,3 +1,473 @@
-from django.test import TestCase
+import base64
+import hashlib
+import io
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from allauth.account.models import EmailAddress
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from . import importer, registration, signals, tasks
+from .fields import HEADER, MAGIC, FaceEncodingField, decode_face_encoding, encode_face_encoding
+from .models import CustomUser, forget_role_groups, role_group
+from .serializers import UserSerializer
+
+
+def encoding(seed=0):
+    return np.random.default_rng(seed).normal(size=128).astype(np.float32)
+
+
+class FaceEncodingFieldTests(SimpleTestCase):
+    def test_blob_round_trip(self):
+        vector = encoding()
+        blob = encode_face_encoding(vector)
+        self.assertEqual(len(blob), 516)
+        np.testing.assert_array_equal(decode_face_encoding(blob), vector)
+
+    def test_unknown_magic_or_model_is_rejected(self):
+        payload = encode_face_encoding(encoding())[HEADER.size:]
+        self.assertIsNone(decode_face_encoding(HEADER.pack(b"XX", 1, 1) + payload))
+        self.assertIsNone(decode_face_encoding(HEADER.pack(MAGIC, 1, 99) + payload))
+        self.assertIsNone(decode_face_encoding(HEADER.pack(MAGIC, 2, 1) + payload))
+        self.assertIsNone(decode_face_encoding(encode_face_encoding(encoding())[:-4]))
+        with self.assertRaises(ValueError):
+            encode_face_encoding(np.zeros(127))
+
+    def test_to_python(self):
+        field = FaceEncodingField()
+        vector = encoding()
+        blob = encode_face_encoding(vector)
+        np.testing.assert_array_equal(field.to_python(blob), vector)
+        np.testing.assert_array_equal(field.to_python(base64.b64encode(blob).decode()), vector)
+        np.testing.assert_array_equal(field.to_python(vector.tolist()), vector)
+        with self.assertRaises(ValidationError):
+            field.to_python(HEADER.pack(b"XX", 1, 1) + blob[HEADER.size:])
+
+    def test_unknown_stored_format_loads_as_none(self):
+        field = FaceEncodingField()
+        with self.assertLogs("userManager.fields", "WARNING"):
+            self.assertIsNone(field.from_db_value(HEADER.pack(MAGIC, 1, 99) + bytes(512), None, None))
+
+
+class FaceEncodingStorageTests(TestCase):
+    def test_database_round_trip(self):
+        vector = encoding()
+        user = CustomUser.objects.create(username="blob", email="blob@example.com", face_encoding=vector.tolist())
+        stored = CustomUser.objects.get(pk=user.pk).face_encoding
+        self.assertEqual(stored.dtype, np.float32)
+        np.testing.assert_array_equal(stored, vector)
+
+
+class FaceEncodingMigrationTests(TransactionTestCase):
+    json_state = [("userManager", "0001_initial")]
+    blob_state = [("userManager", "0002_face_encoding_binary")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_json_encodings_are_converted_and_back(self):
+        User = self.migrate(self.json_state).get_model("userManager", "CustomUser")
+        vector = encoding()
+        good = User.objects.create(username="good", email="good@example.com", face_encoding=vector.tolist())
+        short = User.objects.create(username="short", email="short@example.com", face_encoding=[0.1, 0.2])
+        text = User.objects.create(username="text", email="text@example.com", face_encoding="not a vector")
+        none = User.objects.create(username="none", email="none@example.com")
+
+        with self.assertLogs("userManager.migrations.0002_face_encoding_binary", "WARNING") as logs:
+            User = self.migrate(self.blob_state).get_model("userManager", "CustomUser")
+        self.assertIn("2 users had a malformed face encoding", logs.output[0])
+        self.assertIn(str(short.pk), logs.output[0])
+        self.assertIn(str(text.pk), logs.output[0])
+        encodings = dict(User.objects.values_list("id", "face_encoding"))
+        np.testing.assert_array_equal(encodings[good.pk], vector)
+        self.assertIsNone(encodings[short.pk])
+        self.assertIsNone(encodings[text.pk])
+        self.assertIsNone(encodings[none.pk])
+
+        User = self.migrate(self.json_state).get_model("userManager", "CustomUser")
+        encodings = dict(User.objects.values_list("id", "face_encoding"))
+        np.testing.assert_allclose(encodings[good.pk], vector)
+        self.assertIsNone(encodings[short.pk])
+
+
+class FaceEnrolmentTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.queued = self.enterContext(mock.patch.object(tasks.enrol_face, "delay"))
+        self.describe = self.enterContext(
+            mock.patch.object(tasks, "describe_enrolment", return_value=(None, encoding()))
+        )
+
+    def upload(self, content=b"face one"):
+        return SimpleUploadedFile("face.png", content, content_type="image/png")
+
+    def register(self, number, content=b"face one"):
+        with self.captureOnCommitCallbacks(execute=True):
+            return CustomUser.objects.create(
+                username=f"enrol{number}", email=f"enrol{number}@example.com", registered_face=self.upload(content)
+            )
+
+    def enrol(self, user, image_hash=None):
+        tasks.enrol_face.apply(args=[str(user.pk), image_hash or hashlib.sha256(b"face one").hexdigest()]).get()
+        return CustomUser.objects.get(pk=user.pk)
+
+    def test_new_image_is_queued_once(self):
+        user = self.register(1)
+        image_hash = hashlib.sha256(b"face one").hexdigest()
+        self.queued.assert_called_once_with(str(user.pk), image_hash)
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).face_status, CustomUser.FACE_PENDING)
+
+        user = self.enrol(user)
+        self.assertEqual(user.face_status, CustomUser.FACE_READY)
+        np.testing.assert_array_equal(user.face_encoding, encoding())
+
+        # Saving other fields does not read the image again
+        with mock.patch.object(signals, "hash_face_image") as hash_face_image:
+            with self.captureOnCommitCallbacks(execute=True):
+                user.first_name = "Ada"
+                user.save()
+        hash_face_image.assert_not_called()
+        # Uploading the same content again is not a new enrolment
+        with self.captureOnCommitCallbacks(execute=True):
+            user.registered_face = self.upload()
+            user.save()
+        self.queued.assert_called_once()
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).face_status, CustomUser.FACE_READY)
+
+    def test_failed_enrolment_is_retried_on_upload(self):
+        self.describe.return_value = ("No face found in the image", None)
+        user = self.enrol(self.register(1))
+        self.assertEqual(user.face_status, CustomUser.FACE_FAILED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.registered_face = self.upload()
+            user.save()
+        self.assertEqual(self.queued.call_count, 2)
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).face_status, CustomUser.FACE_PENDING)
+
+    def test_job_for_a_replaced_image_is_dropped(self):
+        user = self.register(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            user.registered_face = self.upload(b"face two")
+            user.save()
+        user = self.enrol(user, hashlib.sha256(b"face one").hexdigest())
+        self.describe.assert_not_called()
+        self.assertEqual(user.face_status, CustomUser.FACE_PENDING)
+        self.assertEqual(user.face_image_hash, hashlib.sha256(b"face two").hexdigest())
+
+        user = self.enrol(user, user.face_image_hash)
+        self.assertEqual(user.face_status, CustomUser.FACE_READY)
+
+    def test_encoding_of_identical_image_is_reused(self):
+        self.enrol(self.register(1))
+        twin = self.enrol(self.register(2))
+        self.describe.assert_called_once()
+        self.assertEqual(twin.face_status, CustomUser.FACE_READY)
+        np.testing.assert_array_equal(twin.face_encoding, encoding())
+
+    def test_stale_pending_state_written_back_is_enrolled_again(self):
+        user = self.register(1)
+        stale = CustomUser.objects.get(pk=user.pk)
+        self.enrol(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            stale.save()
+        self.assertEqual(self.queued.call_count, 2)
+        self.assertEqual(self.enrol(user).face_status, CustomUser.FACE_READY)
+
+    def test_save_of_a_deleted_row_inserts_it(self):
+        user = self.enrol(self.register(1))
+        CustomUser.objects.filter(pk=user.pk).delete()
+        user.save()
+        np.testing.assert_array_equal(CustomUser.objects.get(pk=user.pk).face_encoding, encoding())
+
+
+class BulkRegisterTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().post("/api/users/mass_register/")
+        self.queued = self.enterContext(mock.patch.object(registration, "queue_registration_emails"))
+
+    def register(self, rows):
+        with self.captureOnCommitCallbacks(execute=True):
+            return registration.bulk_register(rows, self.request)
+
+    def test_valid_rows_are_created_like_single_registrations(self):
+        created, errors = self.register([
+            {"email": "ada@example.com", "role": "staff", "employee_id": "E1"},
+            {"email": "bob@example.com", "role": "student", "username": "bobby"},
+        ])
+        self.assertEqual(errors, [])
+        self.assertEqual([(user.email, user.username) for user in created], [
+            ("ada@example.com", "ada"), ("bob@example.com", "bobby"),
+        ])
+
+        ada = CustomUser.objects.get(email="ada@example.com")
+        self.assertTrue(ada.is_staff)
+        self.assertFalse(ada.is_superuser)
+        self.assertFalse(ada.has_usable_password())
+        self.assertEqual(list(ada.groups.values_list("name", flat=True)), ["staff"])
+        self.assertTrue(EmailAddress.objects.filter(user=ada, email="ada@example.com", primary=True).exists())
+
+        messages = self.queued.call_args.args[0]
+        self.assertEqual([email for email, _ in messages], ["ada@example.com", "bob@example.com"])
+        self.assertTrue(messages[0][1]["reset_password_link"].startswith("http://testserver/reset/"))
+
+    def test_duplicates_are_rejected_per_row(self):
+        CustomUser.objects.create(username="taken", email="taken@example.com", employee_id="E9")
+        created, errors = self.register([
+            {"email": "Taken@example.com", "role": "student"},
+            {"email": "new@example.com", "role": "student", "employee_id": "E2"},
+            {"email": "NEW@example.com", "role": "student"},
+            {"email": "other@example.com", "role": "staff", "employee_id": "E9"},
+            {"email": "again@example.com", "role": "staff", "employee_id": "E2"},
+            {"email": "not an email", "role": "student"},
+        ])
+        self.assertEqual([user.email for user in created], ["new@example.com"])
+        self.assertEqual(
+            sorted((error["data"]["email"], *error["errors"]) for error in errors),
+            [
+                ("NEW@example.com", "email"),
+                ("Taken@example.com", "email"),
+                ("again@example.com", "employee_id"),
+                ("not an email", "email"),
+                ("other@example.com", "employee_id"),
+            ],
+        )
+        self.assertEqual(CustomUser.objects.filter(email__iexact="new@example.com").count(), 1)
+
+    def test_endpoint_returns_serialized_users(self):
+        admin = CustomUser.objects.create(username="boss", email="boss@example.com", role="admin")
+        api = APIClient()
+        api.force_authenticate(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = api.post(reverse("user-mass-register"), {"users": [
+                {"email": "cy@example.com", "role": "staff"},
+                {"email": "bad", "role": "staff"},
+            ]}, format="json")
+        self.assertEqual(response.status_code, 201)
+        cy = CustomUser.objects.get(email="cy@example.com")
+        self.assertEqual(response.json()["created_users"], [UserSerializer(cy).data])
+        self.assertEqual(response.json()["created_users"][0]["groups"], [Group.objects.get(name="staff").pk])
+        self.assertEqual(len(response.json()["errors"]), 1)
+
+    def test_nothing_is_queued_when_every_row_is_rejected(self):
+        created, errors = self.register([{"email": "x@example.com", "role": "nobody"}])
+        self.assertEqual(created, [])
+        self.assertEqual(len(errors), 1)
+        self.queued.assert_not_called()
+
+
+class UserImportTests(TestCase):
+    SHEET = (
+        "\ufeffEmail , Role,Photo,First_Name\n"
+        "ada@example.com,student,ada.jpg,Ada\n"
+        "bob@example.com,staff,,Bob\n"
+        "cy@example.com,student,missing.jpg,Cy\n"
+        "dee@example.com,student,blurry.jpg,Dee\n"
+        "not an email,student,,Eve\n"
+    )
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.enterContext(mock.patch.object(importer, "describe_enrolment", side_effect=self.describe))
+
+    @staticmethod
+    def describe(image_data):
+        if image_data == b"blurry":
+            return "No face found in the image", None
+        return None, encoding()
+
+    def files(self):
+        photos = io.BytesIO()
+        with zipfile.ZipFile(photos, "w") as archive:
+            archive.writestr("ada.jpg", b"ada")
+            archive.writestr("blurry.jpg", b"blurry")
+        photos.seek(0)
+        return io.BytesIO(self.SHEET.encode("utf-8")), photos
+
+    def run_import(self, photos=True):
+        sheet, archive = self.files()
+        return importer.UserImport(sheet, "users.csv", archive if photos else None, workers=0, send_emails=False).run()
+
+    def test_csv_header_and_cells_are_normalised(self):
+        rows = list(importer.read_rows(io.BytesIO(b"\xef\xbb\xbf Email ,ROLE\n ada@example.com , student\n"), "u.CSV"))
+        self.assertEqual(rows, [(2, {"email": "ada@example.com", "role": "student"})])
+        with self.assertRaises(ValueError):
+            importer.read_rows(io.BytesIO(), "users.ods")
+
+    def test_rows_are_imported_and_failures_reported(self):
+        report = self.run_import()
+        self.assertEqual((report.created, report.with_face), (2, 1))
+        self.assertEqual(
+            [(error["row"], error["email"], *error["errors"]) for error in report.errors],
+            [
+                (6, "not an email", "email"),
+                (4, "cy@example.com", "photo"),
+                (5, "dee@example.com", "photo"),
+            ],
+        )
+        ada = CustomUser.objects.get(email="ada@example.com")
+        self.assertEqual(ada.first_name, "Ada")
+        self.assertEqual(ada.face_status, CustomUser.FACE_READY)
+        self.assertEqual(ada.face_image_hash, hashlib.sha256(b"ada").hexdigest())
+        np.testing.assert_array_equal(ada.face_encoding, encoding())
+        self.assertIsNone(CustomUser.objects.get(email="bob@example.com").face_encoding)
+
+    def test_photos_without_an_archive_are_rejected(self):
+        report = self.run_import(photos=False)
+        self.assertEqual(report.created, 1)
+        self.assertEqual(
+            {error["email"]: importer.format_errors(error["errors"]) for error in report.errors if error["row"] != 6},
+            {
+                "ada@example.com": "photo: No photo archive was provided.",
+                "cy@example.com": "photo: No photo archive was provided.",
+                "dee@example.com": "photo: No photo archive was provided.",
+            },
+        )
+
+    def test_error_report_has_one_line_per_rejected_row(self):
+        output = io.StringIO()
+        self.run_import().write_csv(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "row,email,errors")
+        self.assertEqual(lines[2], "4,cy@example.com,photo: missing.jpg is not in the photo archive.")
+        self.assertEqual(lines[3], "5,dee@example.com,photo: No face found in the image")
+        self.assertEqual(len(lines), 4)
+
+    def stored_faces(self):
+        return sorted(default_storage.listdir("faces")[1]) if default_storage.exists("faces") else []
+
+    def test_photos_are_deleted_when_the_insert_fails(self):
+        with mock.patch.object(importer, "insert_users", side_effect=RuntimeError("database gone")):
+            with self.assertRaises(RuntimeError):
+                self.run_import()
+        self.assertEqual(self.stored_faces(), [])
+        self.assertFalse(CustomUser.objects.filter(email="bob@example.com").exists())
+
+    def test_rows_taken_by_a_concurrent_registration_are_reported(self):
+        validate_rows = registration.validate_rows
+
+        def register_bob_after_validation(rows):
+            result = validate_rows(rows)
+            if not CustomUser.objects.filter(email="bob@example.com").exists():
+                CustomUser.objects.create(username="bob2", email="bob@example.com", role="staff")
+            return result
+
+        with mock.patch.object(importer, "validate_rows", side_effect=register_bob_after_validation):
+            report = self.run_import()
+        self.assertEqual((report.created, report.with_face), (1, 1))
+        self.assertIn(
+            (3, "bob@example.com", "email: A user with this email already exists."),
+            [(error["row"], error["email"], importer.format_errors(error["errors"])) for error in report.errors],
+        )
+        ada = CustomUser.objects.get(email="ada@example.com")
+        # The photo stored by the failed attempt is gone; only the inserted user's remains
+        self.assertEqual(self.stored_faces(), [ada.registered_face.name.split("/")[-1]])
+
+    def test_rows_are_reported_when_every_insert_collides(self):
+        with mock.patch.object(importer, "insert_users", side_effect=IntegrityError("UNIQUE constraint failed")):
+            report = self.run_import()
+        self.assertEqual(report.created, 0)
+        self.assertEqual(
+            sorted(error["email"] for error in report.errors if isinstance(error["errors"], str)),
+            ["ada@example.com", "bob@example.com"],
+        )
+        self.assertEqual(self.stored_faces(), [])
+
+    def test_gallery_is_rebuilt_once_per_batch(self):
+        with mock.patch.object(importer, "publish_rebuild") as rebuild:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.run_import()
+        rebuild.assert_called_once_with()
+
+    def test_batches_without_faces_leave_the_gallery_alone(self):
+        with mock.patch.object(importer, "publish_rebuild") as rebuild:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.run_import(photos=False)
+        rebuild.assert_not_called()
+
+    def test_task_encodes_photos_in_the_worker_process(self):
+        sheet, photos = self.files()
+        sheet_name = default_storage.save("imports/users.csv", ContentFile(sheet.read()))
+        photos_name = default_storage.save("imports/photos.zip", ContentFile(photos.read()))
+        with mock.patch.object(importer, "FaceInferenceService", wraps=importer.FaceInferenceService) as service:
+            result = tasks.import_users(sheet_name, photos_name, send_emails=False)
+        self.assertEqual(service.call_args.kwargs["workers"], 0)
+        self.assertEqual((result["created"], result["with_face"], result["rejected"]), (2, 1, 3))
+        with default_storage.open(result["report"]) as report:
+            self.assertEqual(len(report.read().splitlines()), 4)
+
+
+class RoleGroupTests(TestCase):
+    def setUp(self):
+        forget_role_groups()
+        self.addCleanup(forget_role_groups)
+
+    def groups(self, user):
+        return list(user.groups.values_list("name", flat=True))
+
+    def test_create_assigns_the_role_group_and_staff_flags(self):
+        user = CustomUser.objects.create(username="role1", email="role1@example.com", role="staff")
+        self.assertEqual(self.groups(user), ["staff"])
+        user = CustomUser.objects.get(pk=user.pk)
+        self.assertTrue(user.is_staff)
+        self.assertFalse(user.is_superuser)
+
+    def test_role_change_moves_the_user_to_the_new_group(self):
+        user = CustomUser.objects.create(username="role1", email="role1@example.com", role="student")
+        user = CustomUser.objects.get(pk=user.pk)
+        user.role = "admin"
+        user.save()
+        self.assertEqual(self.groups(user), ["admin"])
+        self.assertTrue(CustomUser.objects.get(pk=user.pk).is_superuser)
+
+        user.role = "student"
+        user.save(update_fields=["role"])
+        self.assertEqual(self.groups(user), ["student"])
+        self.assertFalse(CustomUser.objects.get(pk=user.pk).is_staff)
+
+    def test_save_without_a_role_change_leaves_groups_alone(self):
+        user = CustomUser.objects.create(username="role1", email="role1@example.com", role="student")
+        with mock.patch("userManager.models.role_group") as lookup:
+            user = CustomUser.objects.get(pk=user.pk)
+            user.first_name = "Ada"
+            user.save()
+            deferred = CustomUser.objects.only("id", "last_name").get(pk=user.pk)
+            deferred.last_name = "Lovelace"
+            deferred.save(update_fields=["last_name"])
+        lookup.assert_not_called()
+        self.assertEqual(self.groups(user), ["student"])
+
+    def test_group_cache_is_cleared_when_a_group_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            staff = role_group("staff")
+        with self.assertNumQueries(0):
+            self.assertEqual(role_group("staff"), staff)
+
+        group = Group.objects.get(pk=staff)
+        group.name = "former staff"
+        group.save()
+        user = CustomUser.objects.create(username="role1", email="role1@example.com", role="staff")
+        self.assertEqual(self.groups(user), ["staff"])
+        self.assertNotEqual(user.groups.get().pk, staff)
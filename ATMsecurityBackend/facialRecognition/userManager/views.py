@@ -1,17 +1,17 @@
 from rest_framework import viewsets, permissions, status
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth import get_user_model
+from django.db.models import prefetch_related_objects
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.decorators import action
-import random
-import string
 from .serializers import (
     UserSerializer,
     CustomRegisterSerializer,
     UserUpdateSerializer,
 )
 from .filters import UserFilter
+from .registration import bulk_register
 
 # Custom pagination class for controlling page size and limits
 class CustomPagination(PageNumberPagination):
@@ -23,12 +23,6 @@ class CustomPagination(PageNumberPagination):
 User = get_user_model()
 
 
-def generate_random_password(length=12):
-    """Generate a random password with letters, digits, and special characters."""
-    characters = string.ascii_letters + string.digits + string.punctuation
-    return ''.join(random.choice(characters) for _ in range(length))
-
-
 class UserViewSet(viewsets.ModelViewSet):
     """
     Viewset for managing users.
@@ -63,44 +57,21 @@ class UserViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         user = serializer.save()
         user.set_password(self.request.data["password"])
-        face_image = self.request.FILES.get("registered_face", None)
-        if face_image:
-            encoding = self.get_face_encoding(face_image)
-            user.face_encoding = encoding
-            user.save()
-        user.save()
+        # The face encoding is computed by the enrolment task queued when the image was saved
+        user.save(update_fields=["password"])
 
     @action(detail=False, methods=["post"], permission_classes=[permissions.IsAdminUser])
     def mass_register(self, request):
         """
         Custom endpoint for mass user registration.
         - Accepts a list of users.
-        - Generates a random password for each user.
-        - Sends an email with the password reset instructions.
+        - Validates the whole batch up front and creates the valid users in bulk.
+        - Gives each user an unusable password.
+        - Sends an email with the password reset link, where they set one.
         """
         users_data = request.data.get("users", [])
-        created_users = []
-        errors = []
-
-        for user_data in users_data:
-            password = generate_random_password()
-            username = user_data.get("username", None)
-            if not username:
-                # generate username from email
-                username = user_data.get("email", "").split("@")[0]
-            user_data["username"] = username
-            user_data["password1"] = password
-            user_data["password2"] = password
-
-            serializer = CustomRegisterSerializer(data=user_data, context={"request": request})
-            if serializer.is_valid():
-                user = serializer.save(request=request)
-                user.set_password(password)
-                user.save()
-                
-                created_users.append(UserSerializer(user).data)
-            else:
-                errors.append({"data": user_data, "errors": serializer.errors})
-
+        users, errors = bulk_register(users_data, request)
+        # UserSerializer includes the many-to-many fields: one query each for the whole batch
+        prefetch_related_objects(users, "groups", "user_permissions")
+        created_users = UserSerializer(users, many=True, context={"request": request}).data
         return Response({"created_users": created_users, "errors": errors}, status=status.HTTP_201_CREATED)
-